@@ -12,6 +12,8 @@ from starlette.middleware.cors import CORSMiddleware
 # import FlaskApp
 from connexion import FlaskApp
 from flask_cors import CORS
+from events import expand_event
+from codec import decode_message
 
 
 with open('/config/analyzer_conf.yml', 'r') as f:
@@ -27,28 +29,68 @@ logger = logging.getLogger('basicLogger')
 KAFKA_HOSTNAME = app_config['events']['hostname']
 KAFKA_PORT = app_config['events']['port']
 KAFKA_TOPIC = app_config['events']['topic']
+# Warned about a partition count that doesn't match the config (once per process)
+partitions_checked = False
+
+
+def check_partitions(topic):
+    """Warns when the topic's partition count doesn't match the configured layout"""
+    global partitions_checked
+    if partitions_checked:
+        return
+    partitions_checked = True
+    expected = app_config['events'].get('partitions')
+    actual = len(topic.partitions)
+    if expected and expected != actual:
+        logger.warning(f"Expected {expected} partitions for {KAFKA_TOPIC} but the broker has {actual}")
+
+
+def scan_messages():
+    """
+    Yields every decoded message on the topic, one partition at a time in
+    partition id order. Messages of a fire all live on one partition (they are
+    keyed by fire_id), so per-fire order is kept and the index of a reading
+    doesn't depend on how the partitions happen to interleave.
+    Each partition is read up to its latest offset, so we don't sit in
+    consumer_timeout_ms waiting for messages that aren't coming.
+    """
+    client = KafkaClient(hosts=f"{KAFKA_HOSTNAME}:{KAFKA_PORT}")
+    topic = client.topics[KAFKA_TOPIC.encode()]
+    check_partitions(topic)
+
+    for partition_id in sorted(topic.partitions):
+        partition = topic.partitions[partition_id]
+        last_offset = partition.latest_available_offset() - 1
+        if last_offset < partition.earliest_available_offset():
+            continue
+
+        consumer = topic.get_simple_consumer(
+            partitions=[partition],
+            reset_offset_on_start=True,
+            consumer_timeout_ms=1000
+        )
+        try:
+            for msg in consumer:
+                yield decode_message(msg.value)
+                if msg.offset >= last_offset:
+                    break
+        finally:
+            consumer.stop()
 
 
 def get_temperature_reading(index):
     logger.info("Get Temperature Reading initiated")
     try:
-
-        client = KafkaClient(hosts=f"{KAFKA_HOSTNAME}:{KAFKA_PORT}")
-        topic= client.topics[KAFKA_TOPIC.encode()]
-
-        consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)
         counter = 0
         logger.info("Consumer Received")
-        for msg in consumer:
-            message = msg.value.decode("utf-8")
-            data = json.loads(message)
-
-            if data.get('type') == 'temperature_reading':
-                if counter == index:
-                    logger.info(f"Payload found {data['payload']}")
-                    return {"message": data['payload']}, 201
-                
-                counter+=1
+        for data in scan_messages():
+            for event_type, payload in expand_event(data):
+                if event_type == 'temperature_reading':
+                    if counter == index:
+                        logger.info(f"Payload found {payload}")
+                        return {"message": payload}, 201
+                    
+                    counter+=1
 
         # If we finish the loop without finding the index
         logger.info(f"Temperature reading at index {index} not found")
@@ -62,26 +104,17 @@ def get_temperature_reading(index):
 def get_airquality_reading(index):
     logger.info("Get Airquality Reading")
     try:
-
-        client = KafkaClient(hosts=f"{KAFKA_HOSTNAME}:{KAFKA_PORT}")
-        topic= client.topics[KAFKA_TOPIC.encode()]
-
-        consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)
         counter = 0
 
-
-
         logger.info("Consumer Received")
-        for msg in consumer:
-            message = msg.value.decode("utf-8")
-            data = json.loads(message)
-
-            if data.get('type') == 'airquality_reading':
-                if counter == index:
-                    logger.info(f"Payload found {data['payload']}")
-                    return {"message": data['payload']}, 201
-                
-                counter+=1
+        for data in scan_messages():
+            for event_type, payload in expand_event(data):
+                if event_type == 'airquality_reading':
+                    if counter == index:
+                        logger.info(f"Payload found {payload}")
+                        return {"message": payload}, 201
+                    
+                    counter+=1
         logger.info(f"Temperature reading at index {index} not found")
         return {"message": "Not Found"}, 404
 
@@ -95,10 +128,6 @@ def get_reading_stats():
 
 
     try:
-        client = KafkaClient(hosts=f"{KAFKA_HOSTNAME}:{KAFKA_PORT}")
-        topic = client.topics[KAFKA_TOPIC.encode()]
-
-        consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)
         air_count = 0
         temp_count = 0
         #Created a dictionary and shit
@@ -106,15 +135,13 @@ def get_reading_stats():
             "num_temperature_readings": 0,
             "num_airquality_readings": 0 
         }
-        for msg in consumer: 
-            message = msg.value.decode("utf-8")
-            data = json.loads(message)
+        for data in scan_messages():
+            for event_type, _ in expand_event(data):
+                if event_type == "temperature_reading":
+                    temp_count+=1
 
-            if data.get("type") == "temperature_reading":
-                temp_count+=1
-
-            elif data.get("type") == "airquality_reading":
-                air_count+=1
+                elif event_type == "airquality_reading":
+                    air_count+=1
 
 
         data_to_send["num_temperature_readings"] = temp_count
@@ -132,16 +159,11 @@ def health():
 
 def get_random_temperature_event():
     try:
-        client = KafkaClient(hosts=f"{KAFKA_HOSTNAME}:{KAFKA_PORT}")
-        topic = client.topics[KAFKA_TOPIC.encode()]
-        consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)
-        
         temperature_events = []
-        for msg in consumer:
-            message = msg.value.decode("utf-8")
-            data = json.loads(message)
-            if data.get('type') == 'temperature_reading':
-                temperature_events.append(data['payload'])
+        for data in scan_messages():
+            for event_type, payload in expand_event(data):
+                if event_type == 'temperature_reading':
+                    temperature_events.append(payload)
         
         if temperature_events:
             return random.choice(temperature_events), 200
@@ -0,0 +1,4 @@
+-- Lets storage read information_schema.innodb_trx: the /after endpoints hold
+-- back rows newer than the oldest write transaction still open.
+-- Runs once, when the mysql_data volume is first initialised.
+GRANT PROCESS ON *.* TO 'skibidi'@'%';
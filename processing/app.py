@@ -4,14 +4,21 @@ from apscheduler.schedulers.background import BackgroundScheduler
 import yaml
 from connexion import FlaskApp
 import logging.config
-import requests
-import json
-from datetime import datetime
+import atexit
+import copy
+from datetime import datetime, timezone
 import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import httpx
 from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
 # from flask_cors import CORS
 from flask_cors import CORS
+from streaming import StreamingStats
+from state import DEFAULT_STATS, load_state, save_state
+from sketches import StatsSketches
+from fetch import fetch_chunks, make_client
 # Loads the configuration files
 with open('/config/processing_conf.yml', 'r') as f:
     app_config = yaml.safe_load(f.read())
@@ -22,104 +29,205 @@ with open('/config/processing_log_conf.yml', 'r') as f:
 logging.config.dictConfig(log_config)
 logger = logging.getLogger('basicLogger')
 
+# polling: query storage every scheduler.interval seconds
+# streaming: consume the events topic directly (see streaming.py)
+MODE = app_config.get('mode', 'polling')
+streaming_stats = None
+# Percentile/mean sketches of the polling mode, loaded once at startup
+SKETCH_CONFIG = app_config.get('sketches', {})
+sketches = None
+# Keep-alive client to storage and the threads fetching both event types at once
+FETCH_CONFIG = app_config.get('fetch', {})
+http_client = None
+fetch_executor = None
+# Id of the last storage row counted, per event type
+watermarks = None
+# The polling mode's stats live in memory, loaded once at startup. populate_stats
+# updates them under stats_lock and publishes a new response dict; GET /stats
+# only reads that reference. persist_stats saves them every persist_interval_s.
+stats_lock = Lock()
+persist_lock = Lock()
+running_stats = None
+published_stats = None
+stats_dirty = False
+
 def health():
     return {"status": "healthy"}, 200
 def get_stats():
     logger.info("Started Request for Statistics")
+
+    # Served from memory, the file is only the checkpoint
+    if streaming_stats is not None:
+        stats = streaming_stats.snapshot()
+    else:
+        stats = published_stats
     
-    # Check if the statistics file exists
-    if not os.path.exists(app_config['datastore']['filename']):
+    # No stats file at startup and no processing cycle yet
+    if stats is None:
         logger.error("Statistics do not exist")
         return {"message": "Statistics do not exist"}, 404
     
-    # Read the statistics from the file
-    with open(app_config['datastore']['filename'], 'r') as f:
-        stats = json.load(f)
-    
     logger.debug(f"Statistics: {stats}")
     logger.info("Request for statistics has completed")
     
     return stats, 200
 
 
+def fetch_readings(event_type, url, after_id):
+    """
+    Reads the readings of one event type after the `after_id` watermark from
+    storage, page_rows at a time, streaming each page into sketches a chunk at
+    a time. Returns (number of readings, new watermark, sketches).
+
+    A page only counts once it was read completely: if one fails midway the
+    result stops at the previous page, whose last id is the new watermark, and
+    the next cycle carries on from there. At most max_pages pages are read per
+    cycle so a long catch-up is saved as it goes.
+    """
+    fetched = StatsSketches(**SKETCH_CONFIG)
+    num_readings = 0
+    page_rows = FETCH_CONFIG.get('page_rows', 5000)
+    for _ in range(FETCH_CONFIG.get('max_pages', 20)):
+        page = StatsSketches(**SKETCH_CONFIG)
+        last_id = after_id
+
+        def aggregate(chunk):
+            nonlocal last_id
+            page.update_readings(event_type, chunk)
+            last_id = chunk[-1]["id"]
+
+        try:
+            num_rows = fetch_chunks(
+                http_client, url, {'after_id': after_id, 'limit': page_rows},
+                FETCH_CONFIG.get('chunk_rows', 1000), aggregate,
+            )
+        except (httpx.HTTPError, ValueError, KeyError) as e:
+            logger.error(f"Failed to get {event_type} readings after id {after_id}: {e}")
+            break
+        fetched.merge(page)
+        num_readings += num_rows
+        after_id = last_id
+        if num_rows < page_rows:
+            break
+    return num_readings, after_id, fetched
+
+
 def populate_stats():
+    global published_stats, stats_dirty
     logger.info("Started Periodic Processing")
-        
-    if os.path.exists(app_config['datastore']['filename']):
-        with open(app_config['datastore']['filename'], 'r') as f:
-            stats = json.load(f)
-    else:
-        # Default statistics if file doesn't exist
-        stats = {
-            "num_temp_readings": 0,
-            "max_temperature_celsius": 0,
-            "num_airquality_readings": 0,
-            "max_air_quality": 0,
-            "last_updated": "2000-01-01T00:00:00Z"
-        }
-    
-    # Get current datetime and last update datetime
-    current_datetime = datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
-    last_updated = stats["last_updated"]
     
-    # Query temperature readings
-    temp_response = requests.get(
-        app_config['eventstores']['temperature']['url'],
-        params={'start_timestamp': last_updated, 'end_timestamp': current_datetime}
+    # Query temperature and air quality readings after their watermarks, at the same time.
+    # Only this job changes the watermarks, so they can be read without the lock.
+    temp_future = fetch_executor.submit(
+        fetch_readings, "temperature_reading", app_config['eventstores']['temperature']['url'],
+        watermarks["temperature_reading"]
     )
+    airquality_future = fetch_executor.submit(
+        fetch_readings, "airquality_reading", app_config['eventstores']['airquality']['url'],
+        watermarks["airquality_reading"]
+    )
+    num_temp_readings, temp_watermark, temp_sketches = temp_future.result()
+    logger.info(f"Received {num_temp_readings} temperature readings, up to id {temp_watermark}")
+    num_airquality_readings, airquality_watermark, airquality_sketches = airquality_future.result()
+    logger.info(f"Received {num_airquality_readings} air quality readings, up to id {airquality_watermark}")
     
-    if temp_response.status_code == 200:
-        temp_readings = temp_response.json()
-        logger.info(f"Received {len(temp_readings)} temperature readings")
-        
+    with stats_lock:
         # Update statistics
-        stats["num_temp_readings"] += len(temp_readings)
+        running_stats["num_temp_readings"] += num_temp_readings
+        running_stats["num_airquality_readings"] += num_airquality_readings
         
-        # Calculate max temperature
-        if len(temp_readings) > 0:
-            max_temp = max([reading['temperature_celsius'] for reading in temp_readings])
-            if max_temp > stats["max_temperature_celsius"]:
-                stats["max_temperature_celsius"] = max_temp
-    else:
-        logger.error(f"Failed to get temperature readings. Status code: {temp_response.status_code}")
-    
-    # Query air quality readings
-    airquality_response = requests.get(
-        app_config['eventstores']['airquality']['url'],
-        params={'start_timestamp': last_updated, 'end_timestamp': current_datetime}
-    )
-    
-    if airquality_response.status_code == 200:
-        airquality_readings = airquality_response.json()
-        logger.info(f"Received {len(airquality_readings)} air quality readings")
+        # Calculate max temperature and air quality
+        max_temp = temp_sketches.maximum("temperature_celsius")
+        if max_temp is not None and max_temp > running_stats["max_temperature_celsius"]:
+            running_stats["max_temperature_celsius"] = max_temp
+        max_aq = airquality_sketches.maximum("air_quality")
+        if max_aq is not None and max_aq > running_stats["max_air_quality"]:
+            running_stats["max_air_quality"] = max_aq
+        sketches.merge(temp_sketches)
+        sketches.merge(airquality_sketches)
+        watermarks["temperature_reading"] = temp_watermark
+        watermarks["airquality_reading"] = airquality_watermark
         
-        # Update statistics
-        stats["num_airquality_readings"] += len(airquality_readings)
+        # Update last_updated timestamp (informational, the watermarks decide what is read next)
+        running_stats["last_updated"] = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
         
-        # Calculate max air quality
-        if len(airquality_readings) > 0:
-            max_aq = max([reading['air_quality'] for reading in airquality_readings])
-            if max_aq > stats["max_air_quality"]:
-                stats["max_air_quality"] = max_aq
-    else:
-        logger.error(f"Failed to get air quality readings. Status code: {airquality_response.status_code}")
-    
-    # Update last_updated timestamp
-    stats["last_updated"] = current_datetime
+        # A new dict each time: a GET holding the previous one never sees it change
+        published_stats = {**running_stats, **sketches.summary()}
+        stats_dirty = True
     
-    # Write updated statistics to JSON file
-    with open(app_config['datastore']['filename'], 'w') as f:
-        json.dump(stats, f, indent=4)
-    
-    logger.debug(f"Updated statistics: {stats}")
+    logger.debug(f"Updated statistics: {running_stats}")
     logger.info("Periodic processing has ended")
 
 
+def persist_stats():
+    """
+    Saves the in-memory stats, sketches and watermarks, if they changed, in one
+    atomic write (temporary file, fsync, rename). They are copied together under
+    the lock, so a crash never leaves counters that disagree with the watermarks.
+    """
+    global stats_dirty
+    with persist_lock:
+        with stats_lock:
+            if not stats_dirty:
+                return
+            stats = dict(running_stats)
+            saved_watermarks = dict(watermarks)
+            saved_sketches = copy.deepcopy(sketches)
+            stats_dirty = False
+        save_state(app_config['datastore']['filename'], stats, saved_sketches, watermarks=saved_watermarks)
+        logger.debug(f"Saved statistics at watermarks {saved_watermarks}")
+
+
 def init_scheduler():
     """Initialize the background scheduler"""
+    global running_stats, published_stats, sketches, watermarks, http_client, fetch_executor
+    filename = app_config['datastore']['filename']
+    running_stats, _, watermarks, sketches = load_state(filename, SKETCH_CONFIG)
+    if watermarks is None:
+        watermarks = {"temperature_reading": 0, "airquality_reading": 0}
+        if os.path.exists(filename):
+            # Written by the streaming mode or by time-window polling: there is no
+            # row id these stats stop at, so they are rebuilt from storage once
+            logger.warning("Stats file has no watermarks, recounting every reading in storage")
+            running_stats = dict(DEFAULT_STATS)
+            sketches = StatsSketches(**SKETCH_CONFIG)
+            save_state(filename, running_stats, sketches, watermarks=watermarks)
+    if os.path.exists(filename):
+        published_stats = {**running_stats, **sketches.summary()}
+    http_client = make_client(FETCH_CONFIG)
+    fetch_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="fetch")
     sched = BackgroundScheduler(daemon=True)
     sched.add_job(populate_stats, 'interval', seconds=app_config['scheduler']['interval'])
+    sched.add_job(persist_stats, 'interval', seconds=app_config['datastore'].get('persist_interval_s', 30))
     sched.start()
+    # What was processed since the last save is kept on a clean shutdown
+    atexit.register(persist_stats)
+
+
+def init_streaming():
+    """Starts the events topic consumer of the streaming mode"""
+    global streaming_stats
+    events = app_config['events']
+    streaming_config = app_config.get('streaming', {})
+    streaming_stats = StreamingStats(
+        app_config['datastore']['filename'],
+        f"{events['hostname']}:{events['port']}",
+        events['topic'],
+        SKETCH_CONFIG,
+        checkpoint_interval_s=streaming_config.get('checkpoint_interval_s', 5),
+        start_from=streaming_config.get('start_from', 'earliest'),
+        dedupe_window=streaming_config.get('dedupe_window', 100000),
+    )
+    streaming_stats.start()
+    atexit.register(streaming_stats.checkpoint)
+
+
+def start_processing():
+    logger.info(f"Starting processing in {MODE} mode")
+    if MODE == 'streaming':
+        init_streaming()
+    else:
+        init_scheduler()
 
 
 # Create Connexion app
@@ -155,11 +263,11 @@ if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
     logger.info("CORS enabled for all origins")
 
 if __name__ == "__main__":
-    init_scheduler()
+    start_processing()
     app.run(port=8100, host="0.0.0.0")
 
 
 # app.add_api("openapi.yaml", strict_validation=True, validate_responses=True)
 if __name__ == "__main__":
-    init_scheduler()
+    start_processing()
     app.run(port=8100, host="0.0.0.0")
@@ -0,0 +1,60 @@
+# PROCESSING FETCH.PY
+# Reads readings from storage's range endpoints. One keep-alive client is
+# shared by every fetch, responses are requested as NDJSON and parsed line by
+# line, and the rows are handed over in chunks as they arrive, so a large
+# window is never held in memory as a whole.
+import json
+import logging
+from itertools import islice
+
+import httpx
+
+logger = logging.getLogger('basicLogger')
+
+NDJSON = "application/x-ndjson"
+
+
+def make_client(fetch_config):
+    """Pooled client with connect/read timeouts from the fetch config"""
+    return httpx.Client(
+        timeout=httpx.Timeout(
+            fetch_config.get('read_timeout_s', 30),
+            connect=fetch_config.get('connect_timeout_s', 2),
+        ),
+        limits=httpx.Limits(
+            max_connections=fetch_config.get('max_connections', 4),
+            max_keepalive_connections=fetch_config.get('max_connections', 4),
+        ),
+        headers={"Accept": NDJSON},
+    )
+
+
+def iter_rows(response):
+    """Rows of a streamed response: parsed line by line for NDJSON, whole for a JSON array"""
+    if response.headers.get("Content-Type", "").startswith(NDJSON):
+        for line in response.iter_lines():
+            if line:
+                yield json.loads(line)
+    else:
+        yield from json.loads(response.read())
+
+
+def fetch_chunks(client, url, params, chunk_rows, on_chunk):
+    """
+    Streams the readings of `url` and calls on_chunk with each list of up to
+    chunk_rows rows. Returns the number of rows, raises on an HTTP error or timeout.
+    """
+    num_rows = 0
+    with client.stream("GET", url, params=params) as response:
+        if response.status_code != 200:
+            response.read()
+            raise httpx.HTTPStatusError(
+                f"Status code {response.status_code}", request=response.request, response=response
+            )
+        rows = iter_rows(response)
+        while True:
+            chunk = list(islice(rows, chunk_rows))
+            if not chunk:
+                return num_rows
+            on_chunk(chunk)
+            num_rows += len(chunk)
@@ -0,0 +1,228 @@
+# PROCESSING SKETCHES.PY
+# Constant-memory, mergeable statistics of the reading metrics: count, mean and
+# variance (Welford, merged with Chan's formula), min/max, and a log-bucket
+# histogram for percentiles with a bounded relative error. Kept globally and
+# per fire_id; every update is a NumPy operation over a whole batch of readings.
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+# Metrics of each event type
+METRICS = {
+    "temperature_reading": ("temperature_celsius", "humidity_level"),
+    "airquality_reading": ("air_quality", "smoke_opacity"),
+}
+ALL_METRICS = ("temperature_celsius", "humidity_level", "air_quality", "smoke_opacity")
+METRIC_INDEX = {metric: i for i, metric in enumerate(ALL_METRICS)}
+PERCENTILES = (("p50", 0.50), ("p95", 0.95), ("p99", 0.99))
+
+# Columns of Sketch.moments
+COUNT, MEAN, M2, MIN, MAX = range(5)
+
+
+class LogBuckets:
+    """
+    Histogram bucket layout. Bucket i holds values in (gamma^(i-1), gamma^i], so
+    any value inside it is within `relative_accuracy` of the bucket's
+    representative value. Magnitudes below min_magnitude share a zero bucket and
+    those above max_magnitude fall in the last bucket, so the number of buckets
+    (and the memory of a sketch) is fixed.
+    """
+
+    def __init__(self, relative_accuracy=0.02, min_magnitude=0.01, max_magnitude=100000.0):
+        self.params = np.array([relative_accuracy, min_magnitude, max_magnitude])
+        gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = np.log(gamma)
+        self.min_magnitude = min_magnitude
+        self.min_index = int(np.ceil(np.log(min_magnitude) / self.log_gamma))
+        self.per_sign = int(np.ceil(np.log(max_magnitude) / self.log_gamma)) - self.min_index + 1
+        # Negative buckets (most negative first), zero, positive buckets: ascending by value
+        self.zero = self.per_sign
+        self.size = 2 * self.per_sign + 1
+        magnitudes = 2 * gamma ** (np.arange(self.per_sign) + self.min_index) / (gamma + 1)
+        self.values = np.concatenate([-magnitudes[::-1], [0.0], magnitudes])
+
+    def index(self, values):
+        magnitude = np.abs(values)
+        indices = np.full(values.shape, self.zero, dtype=np.int64)
+        large = magnitude >= self.min_magnitude
+        offsets = np.ceil(np.log(magnitude[large]) / self.log_gamma).astype(np.int64) - self.min_index
+        offsets = np.clip(offsets, 0, self.per_sign - 1)
+        indices[large] = np.where(values[large] > 0, self.zero + 1 + offsets, self.zero - 1 - offsets)
+        return indices
+
+
+class Sketch:
+    """Moments and histogram of every metric for one scope (all readings, or one fire)"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.moments = np.zeros((len(ALL_METRICS), 5))
+        self.moments[:, MIN] = np.inf
+        self.moments[:, MAX] = -np.inf
+        self.counts = np.zeros((len(ALL_METRICS), buckets.size), dtype=np.int64)
+
+    def update(self, metric, values):
+        """Adds an array of values (NaN = no value) to one metric"""
+        values = values[~np.isnan(values)]
+        if not values.size:
+            return
+        i = METRIC_INDEX[metric]
+        batch_mean = values.mean()
+        self._merge_moments(i, values.size, batch_mean, ((values - batch_mean) ** 2).sum(), values.min(), values.max())
+        self.counts[i] += np.bincount(self.buckets.index(values), minlength=self.buckets.size)
+
+    def merge(self, other):
+        for i in range(len(ALL_METRICS)):
+            if other.moments[i, COUNT]:
+                self._merge_moments(i, *other.moments[i])
+        self.counts += other.counts
+
+    def _merge_moments(self, i, count, mean, m2, low, high):
+        """Chan et al. parallel update of count/mean/M2 with another set of moments"""
+        moments = self.moments[i]
+        total = moments[COUNT] + count
+        delta = mean - moments[MEAN]
+        moments[MEAN] += delta * count / total
+        moments[M2] += m2 + delta * delta * moments[COUNT] * count / total
+        moments[COUNT] = total
+        moments[MIN] = min(moments[MIN], low)
+        moments[MAX] = max(moments[MAX], high)
+
+    def summary(self):
+        """{metric: count, mean, stddev, min, max, p50, p95, p99} for the metrics with values"""
+        results = {}
+        for metric, i in METRIC_INDEX.items():
+            count, mean, m2, low, high = self.moments[i]
+            if not count:
+                continue
+            cumulative = np.cumsum(self.counts[i])
+            result = {
+                "count": int(count),
+                "mean": float(mean),
+                "stddev": float(np.sqrt(m2 / count)),
+                "min": float(low),
+                "max": float(high),
+            }
+            for name, q in PERCENTILES:
+                bucket = int(np.searchsorted(cumulative, q * (count - 1), side="right"))
+                # The exact min/max are known, the bucket value can't be outside them
+                result[name] = float(np.clip(self.buckets.values[bucket], low, high))
+            results[metric] = result
+        return results
+
+
+class StatsSketches:
+    """
+    Sketches of all readings plus one per fire_id. At most max_fires fires are
+    tracked; when a new one arrives the least recently updated fire is merged
+    into `other`, so memory stays bounded however many fires show up.
+    """
+
+    def __init__(self, relative_accuracy=0.02, max_fires=500, min_magnitude=0.01, max_magnitude=100000.0):
+        self.buckets = LogBuckets(relative_accuracy, min_magnitude, max_magnitude)
+        self.max_fires = max_fires
+        self.total = Sketch(self.buckets)
+        self.other = Sketch(self.buckets)
+        self.evicted_fires = 0
+        self.fires = OrderedDict()
+
+    def _fire(self, fire_id):
+        sketch = self.fires.get(fire_id)
+        if sketch is not None:
+            self.fires.move_to_end(fire_id)
+            return sketch
+        if len(self.fires) >= self.max_fires:
+            _, evicted = self.fires.popitem(last=False)
+            self.other.merge(evicted)
+            self.evicted_fires += 1
+        sketch = self.fires[fire_id] = Sketch(self.buckets)
+        return sketch
+
+    def update(self, event_type, fire_ids, columns):
+        """
+        Adds a batch of readings of one event type. fire_ids is an array of the
+        readings' fire_id, columns maps each metric to a float array (NaN = no value).
+        """
+        for metric in METRICS[event_type]:
+            self.total.update(metric, columns[metric])
+        fires, inverse = np.unique(fire_ids, return_inverse=True)
+        for i, fire_id in enumerate(fires):
+            rows = inverse == i
+            sketch = self._fire(str(fire_id))
+            for metric in METRICS[event_type]:
+                sketch.update(metric, columns[metric][rows])
+
+    def update_readings(self, event_type, readings):
+        """update() from a list of reading dicts, e.g. the rows returned by storage"""
+        if not readings:
+            return
+        fire_ids = np.array([reading["fire_id"] for reading in readings])
+        columns = {
+            metric: np.array([reading.get(metric) for reading in readings], dtype=float)
+            for metric in METRICS[event_type]
+        }
+        self.update(event_type, fire_ids, columns)
+
+    def maximum(self, metric):
+        """Largest value of a metric over all readings, None before the first one"""
+        moments = self.total.moments[METRIC_INDEX[metric]]
+        return float(moments[MAX]) if moments[COUNT] else None
+
+    def merge(self, other):
+        """Adds the sketches of `other` (same bucket settings), e.g. one fetched batch"""
+        self.total.merge(other.total)
+        self.other.merge(other.other)
+        self.evicted_fires += other.evicted_fires
+        for fire_id, sketch in other.fires.items():
+            self._fire(fire_id).merge(sketch)
+
+    def summary(self):
+        summary = {
+            "metrics": self.total.summary(),
+            "fires": {fire_id: sketch.summary() for fire_id, sketch in self.fires.items()},
+        }
+        if self.evicted_fires:
+            summary["other_fires"] = {"num_fires": self.evicted_fires, "metrics": self.other.summary()}
+        return summary
+
+    def save(self, path):
+        """Saves the sketches to a compressed .npz file (temporary file, fsync, rename)"""
+        scopes = [self.total, self.other] + list(self.fires.values())
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(
+                f,
+                params=self.buckets.params,
+                evicted_fires=np.array([self.evicted_fires]),
+                fire_ids=np.array(list(self.fires), dtype=str),
+                moments=np.stack([scope.moments for scope in scopes]),
+                counts=np.stack([scope.counts for scope in scopes]),
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, **params):
+        """Sketches saved by save(), or None when they were made with different bucket settings"""
+        sketches = cls(**params)
+        with np.load(path) as data:
+            if not np.allclose(data["params"], sketches.buckets.params):
+                return None
+            scopes = []
+            for moments, counts in zip(data["moments"], data["counts"]):
+                scope = Sketch(sketches.buckets)
+                scope.moments[:] = moments
+                scope.counts[:] = counts
+                scopes.append(scope)
+            sketches.total, sketches.other = scopes[0], scopes[1]
+            sketches.evicted_fires = int(data["evicted_fires"][0])
+            for fire_id, scope in zip(data["fire_ids"], scopes[2:]):
+                sketches.fires[str(fire_id)] = scope
+        # max_fires may have been lowered since the file was saved
+        while len(sketches.fires) > sketches.max_fires:
+            sketches.other.merge(sketches.fires.popitem(last=False)[1])
+            sketches.evicted_fires += 1
+        return sketches
@@ -0,0 +1,87 @@
+# PROCESSING STATE.PY
+# The stats file (datastore.filename): the stats JSON served by /stats, plus the
+# name of the sketch file saved with it and the position both of them cover:
+# partition offsets in streaming mode, the last storage row id per event type
+# in polling mode. Sketch files are written under a new name every time and
+# the JSON is replaced atomically afterwards, so the JSON always points at a
+# complete sketch file taken at the same moment as its stats and position.
+import glob
+import json
+import logging
+import os
+import time
+
+from sketches import StatsSketches
+
+logger = logging.getLogger('basicLogger')
+
+DEFAULT_STATS = {
+    "num_temp_readings": 0,
+    "max_temperature_celsius": 0,
+    "num_airquality_readings": 0,
+    "max_air_quality": 0,
+    "last_updated": "2000-01-01T00:00:00Z",
+}
+# Bookkeeping kept in the file but not part of the /stats response
+INTERNAL_KEYS = ("offsets", "watermarks", "sketch_file")
+# Written from the sketches on every save
+SUMMARY_KEYS = ("metrics", "fires", "other_fires")
+
+
+def public_stats(stats):
+    return {key: value for key, value in stats.items() if key not in INTERNAL_KEYS}
+
+
+def load_state(filename, sketch_config):
+    """
+    (stats, offsets, watermarks, sketches) from the stats file. offsets and
+    watermarks are None when the file doesn't track them (written by the other
+    mode, or no file yet). Sketches start empty when there is no sketch file or
+    its bucket settings changed.
+    """
+    if not os.path.exists(filename):
+        return dict(DEFAULT_STATS), None, None, StatsSketches(**sketch_config)
+    with open(filename, 'r') as f:
+        saved = json.load(f)
+    stats = {key: value for key, value in saved.items() if key not in INTERNAL_KEYS + SUMMARY_KEYS}
+
+    offsets = saved.get("offsets")
+    if offsets is not None:
+        offsets = {int(partition_id): offset for partition_id, offset in offsets.items()}
+    watermarks = saved.get("watermarks")
+
+    sketches = None
+    sketch_file = saved.get("sketch_file")
+    if sketch_file is not None:
+        sketches = StatsSketches.load(os.path.join(os.path.dirname(filename), sketch_file), **sketch_config)
+        if sketches is None:
+            logger.warning(f"Sketch settings changed since {sketch_file} was saved, percentiles start over")
+    return stats, offsets, watermarks, sketches or StatsSketches(**sketch_config)
+
+
+def save_state(filename, stats, sketches, offsets=None, watermarks=None):
+    """
+    Saves the sketches to a new file, then atomically replaces the stats JSON
+    (stats, the sketch summaries, the sketch file name and the offsets or
+    watermarks) and
+    removes older sketch files.
+    """
+    sketch_file = f"{os.path.basename(filename)}.sketches-{time.time_ns()}.npz"
+    sketch_path = os.path.join(os.path.dirname(filename), sketch_file)
+    sketches.save(sketch_path)
+
+    state = {**stats, **sketches.summary(), "sketch_file": sketch_file}
+    if offsets is not None:
+        state["offsets"] = {str(partition_id): offset for partition_id, offset in offsets.items()}
+    if watermarks is not None:
+        state["watermarks"] = watermarks
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, 'w') as f:
+        json.dump(state, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+
+    for old_path in glob.glob(f"{filename}.sketches-*.npz"):
+        if old_path != sketch_path:
+            os.remove(old_path)
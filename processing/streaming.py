@@ -0,0 +1,222 @@
+# PROCESSING STREAMING.PY
+# Streaming mode: the stats are kept as running aggregates over the events
+# topic, consumed directly, instead of polling storage for every new row.
+# The stats and sketches are checkpointed together with the next offset of
+# every partition, so after a restart consumption resumes exactly where the
+# saved stats stop and no message is applied twice. The receiver delivers at
+# least once, though: a reading it sends again (spool replay, failed delivery)
+# is skipped when its trace_id is among the last dedupe_window seen on its
+# partition. Copies further apart, or on both sides of a restart, count twice.
+import copy
+import logging
+import os
+import time
+from collections import deque
+from datetime import datetime, timezone
+from threading import Lock, Thread
+
+import numpy as np
+from pykafka import KafkaClient
+from pykafka.common import OffsetType
+from pykafka.exceptions import KafkaException
+
+from codec import decode_message
+from events import expand_event
+from sketches import METRICS
+from state import load_state, public_stats, save_state
+
+logger = logging.getLogger('basicLogger')
+
+# Readings buffered before they are added to the sketches in one NumPy batch
+SKETCH_BATCH_ROWS = 5000
+
+
+class RecentIds:
+    """The last `size` ids added, for duplicate checks in constant memory"""
+
+    def __init__(self, size):
+        self._ids = set()
+        self._order = deque()
+        self.size = size
+
+    def add(self, trace_id):
+        """Adds an id, returns False when it is already in the window"""
+        if trace_id in self._ids:
+            return False
+        self._ids.add(trace_id)
+        self._order.append(trace_id)
+        if len(self._order) > self.size:
+            self._ids.discard(self._order.popleft())
+        return True
+
+
+class StreamingStats:
+    """
+    Consumes the events topic in a background thread and keeps the stats up to
+    date in memory. Offsets live in the checkpoint, not in a Kafka consumer
+    group, so the stats and the position they cover can never disagree.
+    """
+
+    def __init__(self, filename, hostname, topic, sketch_config, checkpoint_interval_s=5, start_from="earliest",
+                 dedupe_window=100000):
+        self.filename = filename
+        self.hostname = hostname
+        self.topic = topic
+        self.checkpoint_interval_s = checkpoint_interval_s
+        self.dedupe_window = dedupe_window
+        # Recent trace_ids per partition; readings are keyed by fire_id, so a copy lands on the same one
+        self._recent = {}
+        self._lock = Lock()
+        self.stats, self.offsets, _, self.sketches = load_state(filename, sketch_config)
+        if self.offsets is None:
+            if os.path.exists(filename):
+                # The polling mode already counted everything in storage, reading the
+                # topic from the start would count it again
+                logger.warning("Stats file has no offsets (written by the polling mode), streaming from the latest offsets")
+                start_from = "latest"
+            self.offsets = {}
+        self.start_from = OffsetType.LATEST if start_from == "latest" else OffsetType.EARLIEST
+        self.messages = 0
+        self.skipped = 0
+        self.duplicates = 0
+        self._dirty = False
+        # Readings not yet added to the sketches: fire_ids and metric values per event type
+        self._pending = {event_type: {"fire_id": [], **{metric: [] for metric in metrics}}
+                         for event_type, metrics in METRICS.items()}
+        self._pending_rows = 0
+
+    def apply(self, msg):
+        """Adds one Kafka message to the stats. Undecodable messages are skipped."""
+        try:
+            readings = list(expand_event(decode_message(msg.value)))
+        except Exception as e:
+            logger.warning(f"Skipping undecodable message at partition {msg.partition_id} offset {msg.offset}: {e}")
+            readings = []
+            self.skipped += 1
+
+        with self._lock:
+            recent = self._recent.get(msg.partition_id)
+            if recent is None:
+                recent = self._recent[msg.partition_id] = RecentIds(self.dedupe_window)
+            for event_type, payload in readings:
+                if event_type not in METRICS:
+                    continue
+                try:
+                    # Raises on a bad reading before anything is counted
+                    fire_id, values = self._parse(event_type, payload)
+                    trace_id = payload.get("trace_id")
+                    if trace_id is not None and not recent.add((event_type, trace_id)):
+                        self.duplicates += 1
+                        continue
+                    if event_type == "temperature_reading":
+                        self.stats["num_temp_readings"] += 1
+                        self.stats["max_temperature_celsius"] = max(self.stats["max_temperature_celsius"], values[0])
+                    else:
+                        self.stats["num_airquality_readings"] += 1
+                        self.stats["max_air_quality"] = max(self.stats["max_air_quality"], values[0])
+                    self._buffer(event_type, fire_id, values)
+                except (KeyError, TypeError, ValueError) as e:
+                    logger.warning(f"Skipping bad {event_type} at partition {msg.partition_id} offset {msg.offset}: {e}")
+                    self.skipped += 1
+            self.offsets[msg.partition_id] = msg.offset + 1
+            self.stats["last_updated"] = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+            self.messages += 1
+            self._dirty = True
+            if self._pending_rows >= SKETCH_BATCH_ROWS:
+                self._flush_sketches()
+
+    def _parse(self, event_type, payload):
+        """(fire_id, metric values) of a reading. Only the first metric is required, missing ones are NaN."""
+        metrics = METRICS[event_type]
+        values = [float(payload[metrics[0]])]
+        values += [float(payload[metric]) if payload.get(metric) is not None else np.nan for metric in metrics[1:]]
+        return str(payload["fire_id"]), values
+
+    def _buffer(self, event_type, fire_id, values):
+        """Queues a reading for the sketches"""
+        pending = self._pending[event_type]
+        pending["fire_id"].append(fire_id)
+        for metric, value in zip(METRICS[event_type], values):
+            pending[metric].append(value)
+        self._pending_rows += 1
+
+    def _flush_sketches(self):
+        """Adds the buffered readings to the sketches. Called with the lock held."""
+        for event_type, pending in self._pending.items():
+            if pending["fire_id"]:
+                self.sketches.update(
+                    event_type,
+                    np.array(pending["fire_id"]),
+                    {metric: np.array(pending[metric], dtype=float) for metric in METRICS[event_type]},
+                )
+                for values in pending.values():
+                    values.clear()
+        self._pending_rows = 0
+
+    def snapshot(self):
+        with self._lock:
+            self._flush_sketches()
+            return {**public_stats(self.stats), **self.sketches.summary()}
+
+    def checkpoint(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            self._flush_sketches()
+            stats = dict(self.stats)
+            offsets = dict(self.offsets)
+            sketches = copy.deepcopy(self.sketches)
+            self._dirty = False
+        save_state(self.filename, stats, sketches, offsets)
+        logger.debug(f"Checkpointed stats at offsets {offsets}")
+
+    def make_consumer(self):
+        client = KafkaClient(hosts=self.hostname)
+        topic = client.topics[str.encode(self.topic)]
+        consumer = topic.get_simple_consumer(
+            auto_commit_enable=False,
+            reset_offset_on_start=False,
+            auto_offset_reset=self.start_from,
+            consumer_timeout_ms=1000,
+            auto_start=False,
+        )
+        # reset_offsets takes the last consumed offset, the checkpoint holds the next one
+        consumer.reset_offsets([
+            (partition, self.offsets[partition_id] - 1 if partition_id in self.offsets else self.start_from)
+            for partition_id, partition in topic.partitions.items()
+        ])
+        consumer.start()
+        logger.info(f"Streaming stats from {len(topic.partitions)} partitions, resuming at {self.offsets or self.start_from}")
+        return consumer
+
+    def run(self):
+        last_checkpoint = time.monotonic()
+        while True:
+            consumer = None
+            try:
+                consumer = self.make_consumer()
+                while True:
+                    # Iteration ends after consumer_timeout_ms without a message
+                    for msg in consumer:
+                        self.apply(msg)
+                        if time.monotonic() - last_checkpoint >= self.checkpoint_interval_s:
+                            break
+                    if time.monotonic() - last_checkpoint >= self.checkpoint_interval_s:
+                        self.checkpoint()
+                        last_checkpoint = time.monotonic()
+            except KafkaException as e:
+                logger.warning(f"Kafka issue in the stats consumer: {e}, reconnecting")
+            except Exception as e:
+                logger.exception(f"Stats consumer crashed: {e}")
+            finally:
+                if consumer is not None:
+                    consumer.stop()
+            # Whatever was applied is saved before resuming from those offsets
+            self.checkpoint()
+            last_checkpoint = time.monotonic()
+            time.sleep(1)
+
+    def start(self):
+        thread = Thread(target=self.run, daemon=True)
+        thread.start()
+        return thread
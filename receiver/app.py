@@ -7,7 +7,14 @@ from connexion import NoContent
 import time
 import yaml
 import logging.config
+import os
 from pykafka import KafkaClient
+from producer import EventProducer
+from drainer import produce_all, run_drain_loop
+from events import build_messages, TraceIdGenerator, default_node_id
+from codec import compression_type
+from spool import open_spool
+from threading import Thread
 
 # Loads External Configuration File. This is used specifically for LOGGING agent. 
 with open("/config/receiver_log_conf.yml", "r") as f:
@@ -26,14 +33,60 @@ logger.info("File read successful")
 KAFKA_HOSTNAME = app_config['events']['hostname']
 KAFKA_PORT = app_config['events']['port']
 KAFKA_TOPIC = app_config['events']['topic']
+# "reading" sends one message per reading, "batch" one message per POSTed batch
+MESSAGE_FORMAT = app_config['events'].get('message_format', 'reading')
+# Wire format (json/msgpack) and producer-side compression (none/gzip/snappy/lz4)
+ENCODING = app_config['events'].get('encoding', 'json')
+COMPRESSION = compression_type(app_config['events'].get('compression', 'none'))
+
+# Trace ids must be unique across replicas, storage deduplicates on them.
+# RECEIVER_NODE_ID pins the node id, otherwise it comes from the container address.
+NODE_ID = int(os.environ.get("RECEIVER_NODE_ID", default_node_id()))
+trace_ids = TraceIdGenerator(NODE_ID)
+PRODUCER_CONFIG = app_config.get('producer', {})
+SPOOL_CONFIG = app_config.get('spool', {})
+
+def check_partitions(topic):
+    """Warns when the topic's partition count doesn't match the configured layout"""
+    expected = app_config['events'].get('partitions')
+    actual = len(topic.partitions)
+    logger.info(f"Topic {KAFKA_TOPIC} has {actual} partitions, producing keyed by fire_id")
+    if expected and expected != actual:
+        logger.warning(f"Expected {expected} partitions for {KAFKA_TOPIC} but the broker has {actual}")
+
+
+# Local spool that accepts readings while Kafka is down (or the producer queue is full)
+spool = None
+if SPOOL_CONFIG.get('enabled', False):
+    spool = open_spool(
+        SPOOL_CONFIG['directory'],
+        segment_bytes=SPOOL_CONFIG.get('segment_bytes', 16777216),
+        max_bytes=SPOOL_CONFIG.get('max_bytes', 1073741824),
+        fsync_every=SPOOL_CONFIG.get('fsync_every', 100),
+        fsync_interval_ms=SPOOL_CONFIG.get('fsync_interval_ms', 200),
+    )
+
+
+def respool_failed(messages):
+    """
+    Called with the (partition_key, message) pairs Kafka finally refused after
+    the producer's retries. They were already acknowledged with 201, so they go
+    back to the spool to be sent again.
+    """
+    if spool is not None and spool.append(messages):
+        logger.warning(f"Spooled {len(messages)} messages that failed delivery, they will be retried")
+    else:
+        logger.error(f"Lost {len(messages)} messages that failed delivery, the spool is disabled or full")
+
 
 # Create Kafka client and producer once at startup (REUSE IT!)
 # This prevents the threading errors and improves performance
 try:
     client = KafkaClient(hosts=f'{KAFKA_HOSTNAME}:{KAFKA_PORT}')
     topic = client.topics[str.encode(KAFKA_TOPIC)]
-    producer = topic.get_producer(sync=True)
+    producer = EventProducer(topic, PRODUCER_CONFIG, COMPRESSION, on_failure=respool_failed)
     logger.info(f"Successfully connected to Kafka at {KAFKA_HOSTNAME}:{KAFKA_PORT}")
+    check_partitions(topic)
 except Exception as e:
     logger.error(f"Failed to connect to Kafka: {e}")
     producer = None
@@ -45,8 +98,9 @@ def connect_to_kafka_with_retry(max_retries=5):
         try:
             client = KafkaClient(hosts=f'{KAFKA_HOSTNAME}:{KAFKA_PORT}')
             topic = client.topics[str.encode(KAFKA_TOPIC)]
-            producer = topic.get_producer(sync=True)
+            producer = EventProducer(topic, PRODUCER_CONFIG, COMPRESSION, on_failure=respool_failed)
             logger.info(f"Successfully connected to Kafka at {KAFKA_HOSTNAME}:{KAFKA_PORT}")
+            check_partitions(topic)
             return producer
         except Exception as e:
             wait_time = (2 ** attempt) + random.uniform(0, 1)
@@ -58,6 +112,60 @@ def connect_to_kafka_with_retry(max_retries=5):
                 logger.error("Max retries reached. Kafka producer unavailable.")
                 return None
 
+def send_to_kafka(messages, event_type):
+    """
+    Hands a whole batch of encoded messages to the producer.
+    When Kafka is down, the producer queue is saturated or older messages are
+    still waiting in the spool, the batch goes to the spool instead (keeping
+    the order). Returns 503 right away only when neither can take it.
+    """
+    sent = 0
+    if producer and (spool is None or spool.depth == 0):
+        sent = produce_all(producer, messages)
+        if sent == len(messages):
+            logger.debug(f"Queued {len(messages)} {event_type} messages for Kafka")
+            return NoContent, 201
+
+    remaining = messages[sent:]
+    if spool is not None and spool.append(remaining):
+        logger.info(f"Spooled {len(remaining)} {event_type} messages to disk")
+        return NoContent, 201
+
+    logger.warning(f"Producer queue is full and spool unavailable, rejecting {len(remaining)} {event_type} messages")
+    return NoContent, 503
+
+
+def reconnect_producer():
+    global producer
+    producer = connect_to_kafka_with_retry()
+
+
+def drop_producer():
+    """Forgets a producer that failed, the drainer connects a new one"""
+    global producer
+    producer = None
+
+
+def drain_spool():
+    """Background loop that (re)connects to Kafka and drains the spool into it (see drainer.py)"""
+    run_drain_loop(
+        spool,
+        lambda: producer,
+        reconnect_producer,
+        drop_producer,
+        batch_size=SPOOL_CONFIG.get('drain_batch', 500),
+        idle_seconds=SPOOL_CONFIG.get('drain_idle_ms', 200) / 1000,
+    )
+
+
+def setup_spool_thread():
+    """Starts the spool drainer, which also reconnects a missing producer"""
+    t1 = Thread(target=drain_spool)
+    t1.daemon = True
+    t1.start()
+    logger.info("Spool drain thread started")
+
+
 def report_temperature_readings(body):
     """
     Receives temperature reading batches and sends them to Kafka
@@ -66,20 +174,21 @@ def report_temperature_readings(body):
     readings = body.get("readings", [])
     logger.info(f"Received body: {json.dumps(body, indent=2)}")
     
-    if not producer:
+    if not producer and spool is None:
         logger.error("Kafka producer is not available")
         return NoContent, 503  # Service Unavailable
     
     try:
+        payloads = []
         # Loop through the readings in the "readings" array
         for r in readings:
-            # Autogenerate the trace_id using time in nanoseconds
-            trace_id = time.time_ns()
+            # Autogenerate a trace_id that is unique across receiver replicas
+            trace_id = trace_ids.next_id()
             
             # Log when event is received
             logger.info(f"Received event temperature_reading with a trace id of {trace_id}")
             
-            data = {
+            payloads.append({
                 "trace_id": trace_id,
                 "fire_id": body["fire_id"],
                 "latitude": body["latitude"],
@@ -88,33 +197,35 @@ def report_temperature_readings(body):
                 "humidity_level": r.get("humidity_level"),
                 "batch_timestamp": body["reporting_timestamp"],
                 "reading_timestamp": r["recorded_timestamp"],
-            }
-            
-            # Create message for Kafka
-            msg = {
-                "type": "temperature_reading",
-                "datetime": datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
-                "payload": data
-            }
-            msg_str = json.dumps(msg)
-            
-            # Send to Kafka (this works even if storage is down!)
-            producer.produce(msg_str.encode('utf-8'))
-            
-            # Log successful send
-            logger.debug(f"Sent temperature_reading (trace_id: {trace_id}) to Kafka")
+            })
+        
+        # Create the messages for Kafka, one per reading or one for the whole batch
+        messages = build_messages("temperature_reading", payloads, MESSAGE_FORMAT, ENCODING)
+        
+        # Send to Kafka (this works even if storage is down!)
+        return send_to_kafka(messages, "temperature_reading")
             
     except Exception as e:
         logger.error(f"Error processing temperature readings: {e}")
         return NoContent, 500
-    
-    return NoContent, 201
 
 def get_check():
     current_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     return {"status_datetime": current_time}, 200
 
 
+def get_stats():
+    """Returns the producer queue, delivery report and spool counters"""
+    if not producer and spool is None:
+        return {"message": "Kafka producer is not available"}, 503
+    stats = {}
+    if producer:
+        stats["producer"] = producer.stats()
+    if spool is not None:
+        stats["spool"] = spool.stats()
+    return stats, 200
+
+
 def report_airquality_reading(body):
     """
     Receives air quality reading batches and sends them to Kafka
@@ -123,19 +234,20 @@ def report_airquality_reading(body):
     readings = body.get("readings", [])
     logger.info(f"Received body: {json.dumps(body, indent=2)}")
 
-    if not producer:
+    if not producer and spool is None:
         logger.error("Kafka producer is not available")
         return NoContent, 503  # Service Unavailable
 
     try:
+        payloads = []
         for r in readings:
             # Generate trace_id
-            trace_id = time.time_ns()
+            trace_id = trace_ids.next_id()
             
             # Log the event
             logger.info(f"Received event airquality_reading with a trace id of {trace_id}")
             
-            data = {
+            payloads.append({
                 "trace_id": trace_id,
                 "fire_id": body["fire_id"],
                 "location_name": body["location_name"],
@@ -144,28 +256,18 @@ def report_airquality_reading(body):
                 "smoke_opacity": r["smoke_opacity"],
                 "batch_timestamp": body["reporting_timestamp"],
                 "reading_timestamp": r["recorded_timestamp"],
-            }
-
-            # Create message for Kafka
-            msg = {
-                "type": "airquality_reading",
-                "datetime": datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
-                "payload": data
-            }
-            msg_str = json.dumps(msg)
-            
-            # Send to Kafka (this works even if storage is down!)
-            producer.produce(msg_str.encode('utf-8'))
-            
-            # Log successful send
-            logger.debug(f"Sent airquality_reading (trace_id: {trace_id}) to Kafka")
+            })
+
+        # Create the messages for Kafka, one per reading or one for the whole batch
+        messages = build_messages("airquality_reading", payloads, MESSAGE_FORMAT, ENCODING)
+        
+        # Send to Kafka (this works even if storage is down!)
+        return send_to_kafka(messages, "airquality_reading")
             
     except Exception as e:
         logger.error(f"Error processing airquality readings: {e}")
         return NoContent, 500
 
-    return NoContent, 201
-
 
 
 #========================== ASSIGNMENT 1
@@ -198,7 +300,6 @@ app.add_api("lab1.yaml",
             base_path="/receiver",  # <--- ADD THIS LINE
             strict_validation=True, 
             validate_responses=True)
-import os
 # Conditional CORS
 if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
     from flask_cors import CORS
@@ -206,6 +307,7 @@ if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
     logger.info("CORS enabled for all origins")
 
 if __name__ == "__main__":
+    setup_spool_thread()
     try:
         app.run(port=8080, host="0.0.0.0")
     finally:
@@ -215,4 +317,6 @@ if __name__ == "__main__":
                 producer.stop()
                 logger.info("Kafka producer stopped cleanly")
             except Exception as e:
-                logger.error(f"Error stopping producer: {e}")
\ No newline at end of file
+                logger.error(f"Error stopping producer: {e}")
+        if spool is not None:
+            spool.close()
\ No newline at end of file
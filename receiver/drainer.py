@@ -0,0 +1,77 @@
+# RECEIVER DRAINER.PY
+# Background loop that sends the messages waiting in the spool to Kafka.
+import logging
+import time
+
+from pykafka.exceptions import ProducerQueueFullError
+
+logger = logging.getLogger('basicLogger')
+
+
+def produce_all(producer, messages):
+    """
+    Produces messages in order. Returns how many were handed to the producer
+    before its queue filled up.
+    """
+    for i, (key, msg_bytes) in enumerate(messages):
+        try:
+            producer.produce(msg_bytes, partition_key=key)
+        except ProducerQueueFullError:
+            return i
+    return len(messages)
+
+
+def drain_batch(spool, producer, batch_size):
+    """
+    Sends one batch from the spool and commits what reached the producer.
+    Returns True when the drainer should wait before the next batch (spool
+    empty or producer queue full).
+    """
+    messages, position, num_bytes, skipped = spool.read_batch(batch_size)
+    if not messages:
+        if not skipped:
+            return True
+        # Nothing but corrupt records, move past them
+        spool.commit(position, 0, num_bytes, skipped)
+        return False
+
+    sent = produce_all(producer, messages)
+    queue_full = sent < len(messages)
+    if queue_full:
+        logger.warning(f"Producer queue filled while draining spool ({sent}/{len(messages)} sent)")
+        if not sent:
+            return True
+        # Only the prefix that reached the producer is committed, the rest is read again
+        messages, position, num_bytes, skipped = spool.read_batch(sent)
+
+    spool.commit(position, len(messages), num_bytes, skipped)
+    logger.debug(f"Drained {len(messages)} messages from the spool, {spool.depth} left")
+    return queue_full
+
+
+def run_drain_loop(spool, get_producer, connect, drop_producer, batch_size=500, idle_seconds=0.2, max_backoff_s=30):
+    """
+    Drains the spool into Kafka forever, (re)connecting a missing producer
+    (also when the spool is disabled, spool=None).
+    Delivery is at-least-once: a batch is sent again if the receiver dies
+    between producing it and committing the spool position.
+
+    Any error (lost broker, stopped producer, unreadable spool record) drops
+    the producer so it is reconnected, and the batch is retried after a
+    backoff, so a failure never stops the drain for good.
+    """
+    backoff = idle_seconds
+    while True:
+        try:
+            producer = get_producer()
+            if producer is None:
+                connect()
+                continue
+            if spool is None or spool.depth == 0 or drain_batch(spool, producer, batch_size):
+                time.sleep(idle_seconds)
+            backoff = idle_seconds
+        except Exception as e:
+            logger.exception(f"Spool drain failed, reconnecting and retrying in {backoff:.1f}s: {e}")
+            drop_producer()
+            time.sleep(backoff)
+            backoff = min(backoff * 2, max_backoff_s)
@@ -0,0 +1,156 @@
+# RECEIVER PRODUCER.PY
+# Wraps the pykafka producer so the request thread never waits on the broker.
+import logging
+import time
+import zlib
+from queue import Empty
+from threading import Lock, Thread, current_thread
+
+from pykafka.exceptions import InvalidMessageSize, MessageSizeTooLarge, ProducerQueueFullError
+
+logger = logging.getLogger('basicLogger')
+
+
+def fire_id_partitioner(partitions, key):
+    """
+    Picks the partition for a message keyed by fire_id.
+    pykafka's hashing_partitioner uses Python's hash(), which is salted per
+    process, so our receiver replicas would disagree on where a fire goes.
+    crc32 over partitions sorted by id gives every replica the same answer.
+    """
+    partitions = sorted(partitions, key=lambda p: p.id)
+    if key is None:
+        return partitions[0]
+    return partitions[zlib.crc32(key) % len(partitions)]
+
+
+class EventProducer:
+    """
+    Async, linger-and-batch Kafka producer with a bounded queue.
+
+    Messages are handed to pykafka's background worker and sent once
+    `min_queued_messages` have built up or `linger_ms` has passed, whichever
+    comes first. pykafka bounds its own queue with `max_queued_messages` and
+    raises ProducerQueueFullError instead of blocking when it is full.
+
+    pykafka posts each delivery report to a queue belonging to the thread that
+    called produce(), and request threads never ask for them. Every thread's
+    queue is therefore registered here on its first produce() and a separate
+    thread drains them all. Messages that could not be delivered are handed to
+    `on_failure` as (partition_key, message) pairs, e.g. to spool them again.
+    """
+
+    def __init__(self, topic, producer_config, compression=0, on_failure=None):
+        self.sync = producer_config.get('sync', False)
+        self.max_queued = producer_config.get('max_queued_messages', 10000)
+        self.report_timeout = producer_config.get('delivery_report_interval_ms', 100) / 1000
+        self.on_failure = on_failure
+
+        self._lock = Lock()
+        self.produced = 0
+        self.delivered = 0
+        self.failed = 0
+        self.rejected = 0
+        # Delivery report queue of every thread that produced: {id(queue): (thread, queue)}
+        self._report_queues = {}
+
+        self._producer = topic.get_producer(
+            sync=self.sync,
+            partitioner=fire_id_partitioner,
+            compression=compression,
+            linger_ms=producer_config.get('linger_ms', 50),
+            min_queued_messages=producer_config.get('min_queued_messages', 500),
+            max_queued_messages=self.max_queued,
+            block_on_queue_full=False,
+            delivery_reports=not self.sync,
+        )
+
+        self._running = True
+        if not self.sync:
+            self._report_thread = Thread(target=self._drain_delivery_reports, daemon=True)
+            self._report_thread.start()
+
+    def produce(self, message, partition_key=None):
+        """
+        Queues one message. Blocks on the broker only in sync mode. Raises
+        ProducerQueueFullError when pykafka's queue is full.
+        """
+        try:
+            msg = self._producer.produce(message, partition_key=partition_key)
+        except ProducerQueueFullError:
+            with self._lock:
+                self.rejected += 1
+            raise
+        with self._lock:
+            self.produced += 1
+            if self.sync:
+                # Sync mode has no delivery reports, produce() returning means it was acked
+                self.delivered += 1
+            elif id(msg.delivery_report_q) not in self._report_queues:
+                self._report_queues[id(msg.delivery_report_q)] = (current_thread(), msg.delivery_report_q)
+
+    def _collect_reports(self):
+        """
+        Takes every waiting report off the registered queues. Returns (delivered,
+        dropped, [failed (partition_key, message)]); dropped ones can never be delivered.
+        """
+        delivered = dropped = 0
+        failed = []
+        with self._lock:
+            queues = list(self._report_queues.items())
+        for key, (thread, report_queue) in queues:
+            while True:
+                try:
+                    msg, exc = report_queue.get_nowait()
+                except Empty:
+                    break
+                if exc is None:
+                    delivered += 1
+                elif isinstance(exc, (InvalidMessageSize, MessageSizeTooLarge)):
+                    # Sending it again can't succeed
+                    logger.error(f"Dropping message Kafka refuses: {exc!r}")
+                    dropped += 1
+                else:
+                    logger.error(f"Failed to deliver message to Kafka: {exc!r}")
+                    failed.append((msg.partition_key, msg.value))
+            if not thread.is_alive() and report_queue.empty():
+                # Request threads come and go; a dead thread's queue gets no new reports
+                with self._lock:
+                    self._report_queues.pop(key, None)
+        return delivered, dropped, failed
+
+    def _handle_reports(self):
+        delivered, dropped, failed = self._collect_reports()
+        with self._lock:
+            self.delivered += delivered
+            self.failed += dropped + len(failed)
+        if failed and self.on_failure is not None:
+            self.on_failure(failed)
+
+    def _drain_delivery_reports(self):
+        """Background loop that collects the delivery reports of every producing thread"""
+        while self._running:
+            try:
+                self._handle_reports()
+            except Exception as e:
+                logger.warning(f"Error reading delivery reports: {e}")
+            time.sleep(self.report_timeout)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "mode": "sync" if self.sync else "async",
+                "in_flight": self.produced - self.delivered - self.failed,
+                "max_in_flight": self.max_queued,
+                "produced": self.produced,
+                "delivered": self.delivered,
+                "failed": self.failed,
+                "rejected_batches": self.rejected,
+            }
+
+    def stop(self):
+        """Flushes whatever is still queued, then handles the last delivery reports"""
+        self._producer.stop()
+        self._running = False
+        if not self.sync:
+            self._handle_reports()
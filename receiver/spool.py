@@ -0,0 +1,320 @@
+# RECEIVER SPOOL.PY
+# Disk-backed append-only spool that holds messages while Kafka is unreachable.
+import fcntl
+import logging
+import os
+import socket
+import struct
+import time
+import zlib
+from threading import Lock, Thread
+
+logger = logging.getLogger('basicLogger')
+
+# Every record is: message length, key length, crc32 of key + message, key bytes, message bytes
+RECORD_HEADER = struct.Struct('>IHI')
+SEGMENT_SUFFIX = '.seg'
+# Unreadable bytes of an old segment are copied to <segment>.bad for inspection
+QUARANTINE_SUFFIX = '.bad'
+
+
+class SpoolError(Exception):
+    """A spool record can't be read back"""
+
+
+class Spool:
+    """
+    Append-only spool made of numbered segment files.
+
+    Messages are appended sequentially to the newest segment, and fsync is
+    batched: it runs after `fsync_every` records or every `fsync_interval_ms`,
+    whichever comes first. A checkpoint file records how far the drainer got,
+    and fully drained segments are deleted.
+    """
+
+    def __init__(self, directory, lock_file=None, segment_bytes=16777216, max_bytes=1073741824,
+                 fsync_every=100, fsync_interval_ms=200):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval_ms / 1000
+        self._lock_file = lock_file
+        self._lock = Lock()
+
+        self.checkpoint_path = os.path.join(directory, 'checkpoint')
+        self.read_seq, self.read_offset = self._load_checkpoint()
+        # Old segments whose records stop being readable at some byte: {seq: byte}
+        self._readable_end = {}
+
+        self.depth = 0
+        self.size_bytes = 0
+        self.appended = 0
+        self.drained = 0
+        self.rejected = 0
+        self.drain_rate = 0.0
+        self._last_drain = time.monotonic()
+
+        self._recover()
+
+        self._writer = open(self._segment_path(self.write_seq), 'ab')
+        self.write_offset = self._writer.tell()
+        self._unsynced = 0
+
+        self._running = True
+        self._fsync_thread = Thread(target=self._fsync_loop, daemon=True)
+        self._fsync_thread.start()
+
+    # ------------------------------------------------------------------ files
+    def _segment_path(self, seq):
+        return os.path.join(self.directory, f"{seq:010d}{SEGMENT_SUFFIX}")
+
+    def _segments(self):
+        return sorted(
+            int(name[:-len(SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.endswith(SEGMENT_SUFFIX)
+        )
+
+    def _load_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path):
+            return 0, 0
+        with open(self.checkpoint_path, 'r') as f:
+            seq, offset = f.read().split()
+        return int(seq), int(offset)
+
+    def _write_checkpoint(self):
+        """Writes the read position to a temp file and renames it over the old one"""
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(f"{self.read_seq} {self.read_offset}")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def _recover(self):
+        """
+        Counts the undrained records left from a previous run. A torn record in
+        the last segment (a crash between write and fsync) is truncated; it is
+        the only segment a crash can leave half-written. Older segments were
+        fsynced when they rolled over and are never cut: a record with a bad
+        checksum is skipped (read_batch() skips it too), and when a length
+        field is damaged the records can't be told apart any more, so reading
+        stops there and the rest of the segment is copied to a quarantine file.
+        """
+        segments = [seq for seq in self._segments() if seq >= self.read_seq]
+        for seq in self._segments():
+            if seq < self.read_seq:
+                os.remove(self._segment_path(seq))
+
+        if not segments:
+            self.read_offset = 0
+            self.write_seq = self.read_seq
+            return
+
+        if segments[0] > self.read_seq:
+            self.read_seq, self.read_offset = segments[0], 0
+        for seq in segments:
+            start = self.read_offset if seq == self.read_seq else 0
+            path = self._segment_path(seq)
+            with open(path, 'rb') as f:
+                f.seek(start)
+                good_end = start
+                while True:
+                    header = f.read(RECORD_HEADER.size)
+                    if len(header) < RECORD_HEADER.size:
+                        break
+                    length, key_length, crc = RECORD_HEADER.unpack(header)
+                    data = f.read(key_length + length)
+                    if len(data) < key_length + length:
+                        break
+                    if zlib.crc32(data) != crc:
+                        if seq == segments[-1]:
+                            break
+                        logger.error(f"Corrupt spool record in {path} at byte {good_end}, it will be skipped")
+                    good_end += RECORD_HEADER.size + key_length + length
+                    self.depth += 1
+                    self.size_bytes += RECORD_HEADER.size + key_length + length
+            size = os.path.getsize(path)
+            if good_end < size and seq == segments[-1]:
+                logger.warning(f"Truncating torn spool record in {path} at byte {good_end}")
+                with open(path, 'r+b') as f:
+                    f.truncate(good_end)
+            elif good_end < size:
+                self._quarantine(path, good_end)
+                self._readable_end[seq] = good_end
+
+        self.write_seq = segments[-1]
+        if self.depth:
+            logger.info(f"Spool recovered {self.depth} undrained messages from {self.directory}")
+
+    def _quarantine(self, path, start):
+        """Copies the unreadable end of an old segment, from byte `start`, next to it"""
+        quarantine_path = path + QUARANTINE_SUFFIX
+        with open(path, 'rb') as f, open(quarantine_path, 'wb') as out:
+            f.seek(start)
+            out.write(f.read())
+        logger.error(f"Spool segment {path} is unreadable from byte {start}, "
+                     f"the rest of it was copied to {quarantine_path} and won't be sent")
+
+    # ----------------------------------------------------------------- writes
+    def append(self, messages):
+        """
+        Appends a batch of (partition_key, message) pairs. Returns False (and
+        writes nothing) when the spool is already at max_bytes.
+        """
+        data = b''.join(
+            RECORD_HEADER.pack(len(m), len(k), zlib.crc32(k + m)) + k + m
+            for k, m in messages
+        )
+        with self._lock:
+            if self.size_bytes + len(data) > self.max_bytes:
+                self.rejected += 1
+                return False
+
+            self._writer.write(data)
+            self._writer.flush()
+            self.write_offset += len(data)
+            self.size_bytes += len(data)
+            self.depth += len(messages)
+            self.appended += len(messages)
+
+            self._unsynced += len(messages)
+            if self._unsynced >= self.fsync_every:
+                self._fsync()
+            if self.write_offset >= self.segment_bytes:
+                self._roll()
+        return True
+
+    def _fsync(self):
+        os.fsync(self._writer.fileno())
+        self._unsynced = 0
+
+    def _roll(self):
+        """Closes the current segment and starts the next one"""
+        self._fsync()
+        self._writer.close()
+        self.write_seq += 1
+        self._writer = open(self._segment_path(self.write_seq), 'ab')
+        self.write_offset = 0
+
+    def _fsync_loop(self):
+        while self._running:
+            time.sleep(self.fsync_interval)
+            with self._lock:
+                if self._unsynced:
+                    self._fsync()
+
+    # ------------------------------------------------------------------ reads
+    def read_batch(self, max_records):
+        """
+        Reads up to max_records (partition_key, message) pairs from the read
+        position without consuming them. Corrupt records are skipped.
+        Returns (messages, position, num_bytes, skipped); pass the last three to
+        commit() once the messages have been handed to Kafka.
+        """
+        with self._lock:
+            seq, offset = self.read_seq, self.read_offset
+            messages = []
+            num_bytes = 0
+            skipped = 0
+            while len(messages) < max_records:
+                if seq == self.write_seq:
+                    end = self.write_offset
+                else:
+                    end = self._readable_end.get(seq)
+                    if end is None:
+                        end = os.path.getsize(self._segment_path(seq))
+                if offset >= end:
+                    if seq >= self.write_seq:
+                        break
+                    seq, offset = seq + 1, 0
+                    continue
+                with open(self._segment_path(seq), 'rb') as f:
+                    f.seek(offset)
+                    while offset < end and len(messages) < max_records:
+                        header = f.read(RECORD_HEADER.size)
+                        if len(header) < RECORD_HEADER.size:
+                            raise SpoolError(f"Short record header in spool segment {seq} at byte {offset}")
+                        length, key_length, crc = RECORD_HEADER.unpack(header)
+                        data = f.read(key_length + length)
+                        if len(data) < key_length + length:
+                            raise SpoolError(f"Spool record in segment {seq} at byte {offset} runs past the end of the file")
+                        offset += RECORD_HEADER.size + key_length + length
+                        num_bytes += RECORD_HEADER.size + key_length + length
+                        if zlib.crc32(data) != crc:
+                            logger.error(f"Skipping corrupt spool record in segment {seq}")
+                            skipped += 1
+                            continue
+                        messages.append((data[:key_length], data[key_length:]))
+            return messages, (seq, offset), num_bytes, skipped
+
+    def commit(self, position, count, num_bytes, skipped=0):
+        """Moves the read position past a batch returned by read_batch()"""
+        with self._lock:
+            old_seq = self.read_seq
+            self.read_seq, self.read_offset = position
+            self.depth -= count + skipped
+            self.size_bytes -= num_bytes
+            self.drained += count
+            self._write_checkpoint()
+            for seq in range(old_seq, self.read_seq):
+                try:
+                    os.remove(self._segment_path(seq))
+                except FileNotFoundError:
+                    pass
+
+            # Exponentially weighted drain rate in messages per second
+            now = time.monotonic()
+            elapsed = max(now - self._last_drain, 1e-6)
+            self.drain_rate = 0.8 * self.drain_rate + 0.2 * (count / elapsed)
+            self._last_drain = now
+
+    def stats(self):
+        with self._lock:
+            return {
+                "directory": self.directory,
+                "depth": self.depth,
+                "size_bytes": self.size_bytes,
+                "max_bytes": self.max_bytes,
+                "appended": self.appended,
+                "drained": self.drained,
+                "rejected_batches": self.rejected,
+                "drain_rate": round(self.drain_rate, 2),
+            }
+
+    def close(self):
+        self._running = False
+        with self._lock:
+            self._fsync()
+            self._writer.close()
+
+
+def open_spool(root, **kwargs):
+    """
+    Opens a spool directory under `root` for this process.
+
+    Every directory is guarded by an exclusive flock, so replicas never share
+    one. An unlocked directory left behind by a replaced container is adopted
+    first so its messages still get drained; otherwise a directory named after
+    this host is used.
+    """
+    os.makedirs(root, exist_ok=True)
+    hostname = socket.gethostname()
+    candidates = sorted(name for name in os.listdir(root) if os.path.isdir(os.path.join(root, name)))
+    if hostname not in candidates:
+        candidates.append(hostname)
+
+    for name in candidates:
+        directory = os.path.join(root, name)
+        os.makedirs(directory, exist_ok=True)
+        lock_file = open(os.path.join(directory, 'lock'), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            continue
+        logger.info(f"Using spool directory {directory}")
+        return Spool(directory, lock_file=lock_file, **kwargs)
+
+    raise RuntimeError(f"No spool directory available under {root}")
@@ -0,0 +1,57 @@
+import threading
+import time
+
+from drainer import run_drain_loop
+from spool import Spool
+
+
+class FlakyProducer:
+    """Fails with a generic error on its fail_at-th produce() call"""
+
+    def __init__(self, sent, fail_at=None):
+        self.sent = sent
+        self.fail_at = fail_at
+        self.calls = 0
+
+    def produce(self, message, partition_key=None):
+        self.calls += 1
+        if self.calls == self.fail_at:
+            raise RuntimeError("broker connection lost")
+        self.sent.append(message)
+
+
+def test_drain_recovers_after_producer_error(tmp_path):
+    spool = Spool(str(tmp_path))
+    messages = [(b"fire", b"message-%03d" % i) for i in range(50)]
+    spool.append(messages)
+
+    sent = []
+    producers = {"current": FlakyProducer(sent, fail_at=15)}
+    dropped = []
+
+    def connect():
+        producers["current"] = FlakyProducer(sent)
+
+    def drop():
+        dropped.append(producers["current"])
+        producers["current"] = None
+
+    thread = threading.Thread(
+        target=run_drain_loop,
+        args=(spool, lambda: producers["current"], connect, drop),
+        kwargs={"batch_size": 10, "idle_seconds": 0.01},
+        daemon=True,
+    )
+    thread.start()
+
+    deadline = time.monotonic() + 5
+    while spool.depth and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert thread.is_alive()
+    assert spool.depth == 0
+    assert len(dropped) == 1
+    # At-least-once: the batch that failed halfway is sent again in full
+    assert sorted(set(sent)) == [message for _, message in messages]
+    assert len(sent) == 54
+    spool.close()
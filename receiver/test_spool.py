@@ -0,0 +1,53 @@
+import os
+
+import pytest
+
+from spool import RECORD_HEADER, QUARANTINE_SUFFIX, Spool, SpoolError
+
+
+def fill(directory, count, segment_bytes=200):
+    spool = Spool(directory, segment_bytes=segment_bytes)
+    for i in range(count):
+        spool.append([(b"k", b"message-%02d" % i)])
+    spool.close()
+    return sorted(name for name in os.listdir(directory) if name.endswith(".seg"))
+
+
+def drain(spool):
+    messages = []
+    while spool.depth:
+        batch, position, num_bytes, skipped = spool.read_batch(5)
+        spool.commit(position, len(batch), num_bytes, skipped)
+        messages += [message for _, message in batch]
+    return messages
+
+
+def test_damaged_length_in_old_segment_is_quarantined_not_truncated(tmp_path):
+    segments = fill(str(tmp_path), 12)
+    old = tmp_path / segments[0]
+    size = old.stat().st_size
+    data = bytearray(old.read_bytes())
+    # Second record's message length now points past the end of the segment
+    second = RECORD_HEADER.size + 1 + len(b"message-00")
+    data[second:second + 4] = (10 ** 6).to_bytes(4, "big")
+    old.write_bytes(bytes(data))
+
+    spool = Spool(str(tmp_path), segment_bytes=200)
+
+    assert old.stat().st_size == size
+    assert (tmp_path / (segments[0] + QUARANTINE_SUFFIX)).read_bytes() == bytes(data[second:])
+    messages = drain(spool)
+    # Only the records of the first segment after the damaged one are held back
+    assert messages[0] == b"message-00"
+    assert b"message-11" in messages
+    assert spool.depth == 0 and spool.size_bytes == 0
+    spool.close()
+
+
+def test_short_header_raises_spool_error(tmp_path):
+    fill(str(tmp_path), 1, segment_bytes=1 << 20)
+    spool = Spool(str(tmp_path))
+    spool.write_offset += 3  # the spool believes 3 more bytes were written
+    with pytest.raises(SpoolError):
+        spool.read_batch(10)
+    spool.close()
@@ -0,0 +1,110 @@
+# SHARED CODEC.PY
+# Wire format of the messages on the events topic.
+# shared/ is copied into the receiver, storage, processing and analyzer images
+# (an extra build context in docker-compose.yml), so every service runs this one file.
+import json
+
+try:
+    import msgpack
+except ImportError:  # msgpack is optional, JSON keeps working without it
+    msgpack = None
+
+from pykafka.common import CompressionType
+
+# Binary messages start with MAGIC, then a schema version byte, then an encoding byte.
+# Old JSON messages always start with '{' so the two can't be confused.
+MAGIC = 0xFE
+SCHEMA_VERSION = 1
+ENCODING_MSGPACK = 1
+
+# Schema for the compact encoding: known keys are sent as their index in this
+# tuple instead of the full name. Only ever append to it; removing or reordering
+# keys needs a new SCHEMA_VERSION.
+SCHEMA_KEYS = (
+    "type",
+    "datetime",
+    "payload",
+    "trace_id",
+    "fire_id",
+    "latitude",
+    "longitude",
+    "temperature_celsius",
+    "humidity_level",
+    "batch_timestamp",
+    "reading_timestamp",
+    "location_name",
+    "particulate_level",
+    "air_quality",
+    "smoke_opacity",
+    "readings",
+)
+KEY_INDEX = {key: index for index, key in enumerate(SCHEMA_KEYS)}
+
+COMPRESSION_TYPES = {
+    "none": CompressionType.NONE,
+    "gzip": CompressionType.GZIP,
+    "snappy": CompressionType.SNAPPY,
+    "lz4": CompressionType.LZ4,
+}
+
+
+class CodecError(ValueError):
+    """Raised when a message can't be decoded"""
+
+
+def compression_type(name):
+    """Maps the `compression` setting of the events config to pykafka's CompressionType"""
+    try:
+        return COMPRESSION_TYPES[(name or "none").lower()]
+    except KeyError:
+        raise CodecError(f"Unknown compression '{name}', expected one of {', '.join(COMPRESSION_TYPES)}")
+
+
+def _shorten(value):
+    if isinstance(value, dict):
+        return {KEY_INDEX.get(key, key): _shorten(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_shorten(item) for item in value]
+    return value
+
+
+def _expand(value):
+    if isinstance(value, dict):
+        return {SCHEMA_KEYS[key] if isinstance(key, int) else key: _expand(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_expand(item) for item in value]
+    return value
+
+
+def encode_message(msg, encoding="json"):
+    """
+    Encodes a message dict for the topic.
+    "json" is the original text format, "msgpack" the compact binary one.
+    """
+    if encoding == "msgpack":
+        if msgpack is None:
+            raise CodecError("encoding is msgpack but the msgpack package is not installed")
+        return bytes((MAGIC, SCHEMA_VERSION, ENCODING_MSGPACK)) + msgpack.packb(_shorten(msg), use_bin_type=True)
+    if encoding != "json":
+        raise CodecError(f"Unknown encoding '{encoding}', expected json or msgpack")
+    return json.dumps(msg).encode('utf-8')
+
+
+def decode_message(raw):
+    """Decodes a message from the topic, detecting the format from its first byte"""
+    if not raw:
+        raise CodecError("empty message")
+
+    if raw[0] != MAGIC:
+        return json.loads(raw.decode('utf-8'))
+
+    if len(raw) < 3:
+        raise CodecError("truncated binary message header")
+    version, encoding = raw[1], raw[2]
+    if version != SCHEMA_VERSION:
+        raise CodecError(f"unsupported schema version {version}")
+    if encoding != ENCODING_MSGPACK:
+        raise CodecError(f"unsupported encoding {encoding}")
+    if msgpack is None:
+        raise CodecError("received a msgpack message but the msgpack package is not installed")
+    return _expand(msgpack.unpackb(raw[3:], raw=False, strict_map_key=False))
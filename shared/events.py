@@ -0,0 +1,133 @@
+# SHARED EVENTS.PY
+# Messages on the events topic: the receiver builds them, storage, processing
+# and analyzer read them. Copied into every service image (see codec.py).
+import datetime
+import socket
+import time
+import zlib
+from threading import Lock
+
+from codec import encode_message
+
+# Fields that are the same for every reading in a POSTed batch
+SHARED_FIELDS = {
+    "temperature_reading": ("fire_id", "latitude", "longitude", "batch_timestamp"),
+    "airquality_reading": ("fire_id", "location_name", "particulate_level", "batch_timestamp"),
+}
+
+# Message type used when a whole batch is sent as one message
+BATCH_TYPES = {
+    "temperature_reading": "temperature_batch",
+    "airquality_reading": "airquality_batch",
+}
+# Batch envelope types and the per-reading type they expand to
+READING_TYPES = {batch_type: event_type for event_type, batch_type in BATCH_TYPES.items()}
+
+
+def build_messages(event_type, readings, message_format="reading", encoding="json"):
+    """
+    Turns a list of flattened reading payloads into (partition_key, message)
+    pairs ready for Kafka. The key is the fire_id, so every reading of a fire
+    lands on the same partition and keeps its order.
+
+    "reading" (default) sends one message per reading, the original format.
+    "batch" sends one message per POSTed batch: the shared fields are written
+    once and only the per-reading fields go into the readings array.
+    `encoding` picks the wire format, see codec.py.
+    """
+    if not readings:
+        return []
+
+    created = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+
+    if message_format == "batch":
+        shared_keys = SHARED_FIELDS[event_type]
+        payload = {key: readings[0][key] for key in shared_keys}
+        payload["readings"] = [
+            {key: value for key, value in r.items() if key not in shared_keys}
+            for r in readings
+        ]
+        msg = {"type": BATCH_TYPES[event_type], "datetime": created, "payload": payload}
+        return [(partition_key(payload), encode_message(msg, encoding))]
+
+    return [
+        (partition_key(r), encode_message({"type": event_type, "datetime": created, "payload": r}, encoding))
+        for r in readings
+    ]
+
+
+def partition_key(payload):
+    return str(payload["fire_id"]).encode('utf-8')
+
+
+def expand_event(msg_data):
+    """
+    Yields (event_type, payload) for every reading carried by a message.
+
+    Per-reading messages yield themselves once. Batch envelopes carry the
+    shared fields once plus a readings array, so each reading is merged back
+    with the shared fields into the same flat payload a per-reading message has.
+    """
+    msg_type = msg_data.get("type")
+    payload = msg_data.get("payload")
+
+    if msg_type in READING_TYPES:
+        shared = {key: value for key, value in payload.items() if key != "readings"}
+        for reading in payload.get("readings", []):
+            yield READING_TYPES[msg_type], {**shared, **reading}
+    else:
+        yield msg_type, payload
+
+
+class TraceIdGenerator:
+    """
+    Snowflake-style 63-bit trace ids: 41 bits of milliseconds since TRACE_EPOCH_MS,
+    10 bits of node id and a 12-bit sequence within the millisecond.
+
+    time.time_ns() alone can give two receiver replicas the same id. With a
+    node id per replica, ids can only repeat if two replicas share a node id.
+    """
+
+    TRACE_EPOCH_MS = 1704067200000  # 2024-01-01T00:00:00Z
+    NODE_BITS = 10
+    SEQUENCE_BITS = 12
+
+    def __init__(self, node_id):
+        self.node_id = node_id % (1 << self.NODE_BITS)
+        self._lock = Lock()
+        self._last_ms = -1
+        self._sequence = 0
+
+    def next_id(self):
+        with self._lock:
+            now_ms = int(time.time() * 1000)
+            # Never go back in time if the clock is adjusted backwards
+            now_ms = max(now_ms, self._last_ms)
+            if now_ms == self._last_ms:
+                self._sequence = (self._sequence + 1) & ((1 << self.SEQUENCE_BITS) - 1)
+                if self._sequence == 0:
+                    # 4096 ids used up in this millisecond, move on to the next one
+                    now_ms += 1
+            else:
+                self._sequence = 0
+            self._last_ms = now_ms
+
+            return (
+                ((now_ms - self.TRACE_EPOCH_MS) << (self.NODE_BITS + self.SEQUENCE_BITS))
+                | (self.node_id << self.SEQUENCE_BITS)
+                | self._sequence
+            )
+
+
+def default_node_id():
+    """
+    Node id for this replica: the low 10 bits of its IPv4 address. Containers
+    on one compose network get distinct, sequentially assigned addresses, so
+    live replicas don't collide. Falls back to a hash of the hostname.
+    """
+    hostname = socket.gethostname()
+    try:
+        address = socket.gethostbyname(hostname)
+        return int(address.split('.')[-1]) | (int(address.split('.')[-2]) << 8)
+    except (OSError, ValueError, IndexError):
+        return zlib.crc32(hostname.encode('utf-8'))
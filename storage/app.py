@@ -1,16 +1,39 @@
 # STORAGE APP.PY
 import os
 import connexion
-from sqlalchemy import create_engine, Integer, String, Float, DateTime, func, BigInteger, text, select
+from connexion.datastructures import MediaTypeDict
+from connexion.validators import VALIDATOR_MAP
+from sqlalchemy import create_engine, Integer, String, Float, DateTime, func, BigInteger, Index, text, select, insert
+from sqlalchemy.dialects import mysql as mysql_dialect, sqlite as sqlite_dialect
 from sqlalchemy.orm import DeclarativeBase, mapped_column, sessionmaker
-from datetime import datetime
+from sqlalchemy.exc import OperationalError, InterfaceError, DBAPIError, TimeoutError as PoolTimeoutError
+from datetime import datetime, timedelta, timezone
 import pymysql
 import yaml
 import logging.config
 from pykafka import KafkaClient
 from pykafka.common import OffsetType
-from threading import Thread
+from threading import Thread, Event, Lock
+import multiprocessing
 import json
+import base64
+import heapq
+from itertools import islice
+from operator import itemgetter
+from collections import Counter
+from flask import Response
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from events import expand_event
+from codec import decode_message
+import serialize
+from pools import make_engine, mysql_url, pool_snapshot
+from embedded import apply_pragmas, SQLiteWriter
+import rollups
+import geo
+import archive
+from cache import ResponseCache
+import migrate
+import deadletter
 
 
 #================= Lab 4 Code Added ==============================
@@ -31,28 +54,66 @@ logger = logging.getLogger('basicLogger')
 #This is where we set up the database connection details.
 # This is where the database, like the user and such is created and set.
 db_config = app_config['datastore']
+INGEST_CONFIG = app_config.get('ingest', {})
+CONSUMER_CONFIG = app_config.get('consumer', {})
+CONSUMER_GROUP = CONSUMER_CONFIG.get('group', 'event_group').encode()
+QUERY_CONFIG = app_config.get('query', {})
+API_CONFIG = app_config.get('api', {})
+RETENTION_CONFIG = app_config.get('retention', {})
+ARCHIVE_DIR = RETENTION_CONFIG.get('archive_dir', '/data/archive')
+CACHE_CONFIG = app_config.get('cache', {})
+DEAD_LETTER_CONFIG = app_config.get('dead_letter', {})
 
 
 
 # This verifies the connection to the database using the configuration details provided. 
-try:
-    #Uses "keys" to grab the value and to create the things needed to connect to the network. 
-    connection_string = f"mysql+pymysql://{db_config['user']}:{db_config['password']}@{db_config['hostname']}:{db_config['port']}/{db_config['db']}"
-    # mysql = create_engine(connection_string, future=True)
-    # Lab12
-    mysql = create_engine(
-        connection_string,
-        pool_size=10,
-        pool_recycle=3600,
-        pool_pre_ping=True
-    )
-    # Logs that the connection is successful and is connected
-    logger.info("Connected to the database")
-except Exception as e:
-    logger.error(f"Error: {e}")
-    mysql = create_engine("sqlite:///storage.db", future=True)
+# Writes (ingest, migrations, retention) and the GET endpoints use separate engines
+# with their own pools, so a heavy range query can't take the connections inserts need.
+POOL_CONFIG = db_config.get('pools', {})
+# backend: sqlite runs storage on an embedded SQLite file instead of MySQL
+EMBEDDED = db_config.get('backend', 'mysql') == 'sqlite'
+SQLITE_CONFIG = db_config.get('sqlite', {})
+
+
+def make_sqlite_engines(path):
+    """
+    Engines for the embedded backend. Writes get a single connection (SQLite
+    has one writer at a time anyway, see SQLiteWriter); reads get a pool of
+    read-only connections that run alongside it thanks to WAL.
+    """
+    url = f"sqlite:///{path}"
+    write_engine = make_engine(url, {**POOL_CONFIG.get('write', {}), "size": 1, "max_overflow": 0},
+                               connect_args={"check_same_thread": False})
+    apply_pragmas(write_engine, SQLITE_CONFIG)
+    read_engine = make_engine(url, POOL_CONFIG.get('read', {}), connect_args={"check_same_thread": False})
+    apply_pragmas(read_engine, SQLITE_CONFIG, read_only=True)
+    return write_engine, read_engine
+
+
+if EMBEDDED:
+    mysql, mysql_read = make_sqlite_engines(SQLITE_CONFIG.get('path', '/data/storage.db'))
+    logger.info(f"Using the embedded SQLite backend at {SQLITE_CONFIG.get('path', '/data/storage.db')}")
+else:
+    try:
+        #Uses "keys" to grab the value and to create the things needed to connect to the network. 
+        connection_string = mysql_url(db_config)
+        # mysql = create_engine(connection_string, future=True)
+        # Lab12
+        mysql = make_engine(connection_string, POOL_CONFIG.get('write', {}))
+        # read_url points the reads at a replica (any SQLAlchemy URL); without it they use the primary
+        mysql_read = make_engine(db_config.get('read_url') or connection_string, POOL_CONFIG.get('read', {}))
+        # Logs that the connection is successful and is connected
+        logger.info("Connected to the database" + (" (reads go to the replica)" if db_config.get('read_url') else ""))
+    except Exception as e:
+        logger.error(f"Error: {e}")
+        mysql, mysql_read = make_sqlite_engines("storage.db")
 
 SessionLocal = sessionmaker(bind=mysql)
+ReadSession = sessionmaker(bind=mysql_read)
+
+# MySQL's FLOAT columns are single precision: geo_cell is computed from the value
+# as stored, the one the area query checks and migration 0006 backfills from
+STORED_AS_FLOAT32 = mysql.dialect.name == "mysql"
 
 #Required for the MySQL Mapping. (Received a little help for this one.)
 # Without the base declarative I receive the error of failure. 
@@ -62,8 +123,15 @@ class Base(DeclarativeBase):
 # I don't know where you'd want this to be in so I just added in app.py storage
 class Temperature(Base):
     __tablename__ = "temperature"
+    # Indexes are created by the migrations in migrations/, keep the two in sync
+    __table_args__ = (
+        Index("ix_temperature_date_created", "date_created"),
+        Index("ix_temperature_fire_id_date_created", "fire_id", "date_created"),
+        Index("ix_temperature_geo_cell_reading_timestamp", "geo_cell", "reading_timestamp"),
+    )
     id = mapped_column(Integer, primary_key=True)
-    trace_id = mapped_column(BigInteger, nullable=False)
+    # Unique so a redelivered event can never be stored twice
+    trace_id = mapped_column(BigInteger, nullable=False, unique=True, index=True)
     fire_id = mapped_column(String(250), nullable=False)
     latitude = mapped_column(Float, nullable=False)
     longitude = mapped_column(Float, nullable=False)
@@ -72,6 +140,8 @@ class Temperature(Base):
     batch_timestamp = mapped_column(DateTime, nullable=False)
     reading_timestamp = mapped_column(DateTime, nullable=False)
     date_created = mapped_column(DateTime, nullable=False, default=func.now())
+    # Grid cell of (latitude, longitude), see geo.py
+    geo_cell = mapped_column(BigInteger, nullable=True)
 
     def to_dict(self):
         """Convert Temperature object to dictionary matching the OpenAPI schema"""
@@ -89,8 +159,14 @@ class Temperature(Base):
 
 class AirQuality(Base):
     __tablename__ = "airquality"
+    # Indexes are created by the migrations in migrations/, keep the two in sync
+    __table_args__ = (
+        Index("ix_airquality_date_created", "date_created"),
+        Index("ix_airquality_fire_id_date_created", "fire_id", "date_created"),
+    )
     id = mapped_column(Integer, primary_key=True)
-    trace_id = mapped_column(BigInteger, nullable=False)
+    # Unique so a redelivered event can never be stored twice
+    trace_id = mapped_column(BigInteger, nullable=False, unique=True, index=True)
     fire_id = mapped_column(String(250), nullable=False)
     location_name = mapped_column(String(250), nullable=False)
     particulate_level = mapped_column(Float, nullable=False)
@@ -113,29 +189,76 @@ class AirQuality(Base):
             "reading_timestamp": self.reading_timestamp.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
         }
 
-Base.metadata.create_all(mysql)
-logger.info("Database tables created/verified")
-def create_temperature_reading(body):
-    session = SessionLocal()
-    logger.debug(f"Storing {body['trace_id']} to the database")
 
+class EventCounter(Base):
+    """Stored events per type and fire, maintained by write_batch (see migrations/0004_event_counters.py)"""
+    __tablename__ = "event_counters"
+    event_type = mapped_column(String(32), primary_key=True)
+    fire_id = mapped_column(String(250), primary_key=True)
+    count = mapped_column(BigInteger, nullable=False)
+    last_ingested = mapped_column(DateTime, nullable=False)
+
+
+# event_type recorded in event_counters for each table
+EVENT_TYPES = {Temperature: "temperature_reading", AirQuality: "airquality_reading"}
+
+# The schema is managed by migrate.py (python3 migrate.py upgrade) instead of create_all,
+# so every process doesn't race to create tables and indexes at import.
+if db_config.get('auto_migrate', False):
+    migrate.upgrade(mysql)
+else:
+    pending = migrate.pending_migrations(mysql)
+    if pending:
+        logger.warning(f"Database schema is behind, run 'python3 migrate.py upgrade' ({len(pending)} pending: {', '.join(m.revision for m in pending)})")
+    else:
+        logger.info("Database schema is up to date")
+
+def parse_timestamp(value):
+    """Time stamps are formatted differently, so this converts them into the datetime format to remove any conflicts"""
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def temperature_row(body):
+    """Converts a temperature_reading payload into a row for the temperature table"""
     humidity = None
     if "humidity_level" in body and body["humidity_level"] is not None:
         humidity = float(body["humidity_level"])
-    # Time stamps are formatted differently, so I added this to convert them into the datetime format to remove any conflicts
-    batch_timestamp = datetime.fromisoformat(body["batch_timestamp"].replace('Z', '+00:00'))
-    reading_timestamp = datetime.fromisoformat(body["reading_timestamp"].replace('Z', '+00:00'))
-        
-    event = Temperature(
-        trace_id=int(body["trace_id"]),
-        fire_id=body["fire_id"],
-        latitude=float(body["latitude"]),
-        longitude=float(body["longitude"]),
-        temperature_celsius=float(body["temperature_celsius"]),
-        humidity_level=humidity,
-        batch_timestamp=batch_timestamp,
-        reading_timestamp=reading_timestamp,
-    )
+
+    latitude = float(body["latitude"])
+    longitude = float(body["longitude"])
+    return {
+        "trace_id": int(body["trace_id"]),
+        "fire_id": body["fire_id"],
+        "latitude": latitude,
+        "longitude": longitude,
+        "temperature_celsius": float(body["temperature_celsius"]),
+        "humidity_level": humidity,
+        "batch_timestamp": parse_timestamp(body["batch_timestamp"]),
+        "reading_timestamp": parse_timestamp(body["reading_timestamp"]),
+        "geo_cell": geo.cell_id(geo.float32(latitude), geo.float32(longitude)) if STORED_AS_FLOAT32
+                    else geo.cell_id(latitude, longitude),
+    }
+
+
+def airquality_row(body):
+    """Converts an airquality_reading payload into a row for the airquality table"""
+    return {
+        "trace_id": int(body["trace_id"]),
+        "fire_id": body["fire_id"],
+        "location_name": body["location_name"],
+        "particulate_level": float(body["particulate_level"]),
+        "air_quality": float(body["air_quality"]),
+        "smoke_opacity": float(body["smoke_opacity"]),
+        "batch_timestamp": parse_timestamp(body["batch_timestamp"]),
+        "reading_timestamp": parse_timestamp(body["reading_timestamp"]),
+    }
+
+
+def create_temperature_reading(body):
+    session = SessionLocal()
+    logger.debug(f"Storing {body['trace_id']} to the database")
+
+    event = Temperature(**temperature_row(body))
     session.add(event)
     session.commit()
     session.close()
@@ -148,19 +271,7 @@ def create_airquality_reading(body):
     session = SessionLocal()
     logger.debug(f"Storing {body['trace_id']} to the database")
 
-    batch_timestamp = datetime.fromisoformat(body["batch_timestamp"].replace('Z', '+00:00'))
-    reading_timestamp = datetime.fromisoformat(body["reading_timestamp"].replace('Z', '+00:00'))
-    
-    event = AirQuality(
-        trace_id=int(body["trace_id"]),
-        fire_id=body["fire_id"],
-        location_name=body["location_name"],
-        particulate_level=float(body["particulate_level"]),
-        air_quality=float(body["air_quality"]),
-        smoke_opacity=float(body["smoke_opacity"]),
-        batch_timestamp=batch_timestamp,
-        reading_timestamp=reading_timestamp,
-    )
+    event = AirQuality(**airquality_row(body))
     session.add(event)
     session.commit()
     session.close()
@@ -212,12 +323,18 @@ def create_airquality_reading(body):
 # ======================= LAB 12 
 import time
 import random
+from threading import Lock
 from pykafka.exceptions import KafkaException
 
 class KafkaWrapper:
-    def __init__(self, hostname, topic):
+    def __init__(self, hostname, topic, consumer_timeout_ms=-1, balanced=False, on_rebalance=None):
         self.hostname = hostname
         self.topic = topic
+        # How long the consumer waits for a message before messages() yields an idle None
+        self.consumer_timeout_ms = consumer_timeout_ms
+        # Balanced consumers split the partitions between every member of the group
+        self.balanced = balanced
+        self.on_rebalance = on_rebalance
         self.client = None
         self.consumer = None
         self.connect()
@@ -250,6 +367,13 @@ class KafkaWrapper:
             self.consumer = None
             return False
     
+    def check_partitions(self, topic):
+        """Warns when the topic's partition count doesn't match the configured layout"""
+        expected = app_config['events'].get('partitions')
+        actual = len(topic.partitions)
+        if expected and expected != actual:
+            logger.warning(f"Expected {expected} partitions for {self.topic} but the broker has {actual}")
+
     def make_consumer(self):
         """
         Runs once, makes a consumer and sets it on the instance.
@@ -261,12 +385,29 @@ class KafkaWrapper:
             return False
         try:
             topic = self.client.topics[str.encode(self.topic)]
+            self.check_partitions(topic)
+            if self.balanced:
+                # Kafka's group membership (managed=True) assigns each member a share
+                # of the partitions; order is kept per partition, i.e. per fire_id
+                self.consumer = topic.get_balanced_consumer(
+                    consumer_group=CONSUMER_GROUP,
+                    managed=True,
+                    auto_commit_enable=False,
+                    reset_offset_on_start=False,
+                    auto_offset_reset=OffsetType.LATEST,
+                    consumer_timeout_ms=self.consumer_timeout_ms,
+                    post_rebalance_callback=self.on_rebalance
+                )
+                logger.info(f"Balanced Kafka consumer joined group {CONSUMER_GROUP.decode()} ({len(topic.partitions)} partitions)")
+                return True
             self.consumer = topic.get_simple_consumer(
-                consumer_group=b'event_group',
+                consumer_group=CONSUMER_GROUP,
                 reset_offset_on_start=False,
-                auto_offset_reset=OffsetType.LATEST
+                auto_offset_reset=OffsetType.LATEST,
+                consumer_timeout_ms=self.consumer_timeout_ms
             )
-            logger.info("Kafka consumer created!")
+            # One consumer reads every partition; order is kept per partition, i.e. per fire_id
+            logger.info(f"Kafka consumer created for {len(topic.partitions)} partitions!")
             return True
         except KafkaException as e:
             msg = f"Kafka error when making consumer: {e}"
@@ -276,13 +417,18 @@ class KafkaWrapper:
             return False
     
     def messages(self):
-        """Generator method that catches exceptions in the consumer loop"""
+        """
+        Generator method that catches exceptions in the consumer loop.
+        Yields None whenever consumer_timeout_ms passes without a message so
+        the caller gets a chance to flush time-based batches.
+        """
         if self.consumer is None:
             self.connect()
         while True:
             try:
                 for msg in self.consumer:
                     yield msg
+                yield None
             except KafkaException as e:
                 msg = f"Kafka issue in consumer: {e}"
                 logger.warning(msg)
@@ -291,139 +437,987 @@ class KafkaWrapper:
                 self.connect()
 
 
-def process_messages():
-    """ Process event messages from Kafka """
+class IngestMetrics:
+    """Batch size, flush latency and throughput of the batched ingest path"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.batches = 0
+        self.messages = 0
+        self.rows = 0
+        self.last_batch_size = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.rows_per_sec = 0.0
+        self.duplicates = 0
+        self.offset_commits = 0
+        self.dead_lettered = 0
+        self.db_retries = 0
+        self.batch_fallbacks = 0
+        self.worker_restarts = 0
+        self.last_error = None
+        self._last_flush = time.monotonic()
+
+    def record_commit(self):
+        with self._lock:
+            self.offset_commits += 1
+
+    def record_dead_letter(self, error):
+        with self._lock:
+            self.dead_lettered += 1
+            self.last_error = f"{type(error).__name__}: {error}"
+
+    def record_retry(self):
+        with self._lock:
+            self.db_retries += 1
+
+    def record_fallback(self):
+        with self._lock:
+            self.batch_fallbacks += 1
+
+    def record_restart(self, error):
+        with self._lock:
+            self.worker_restarts += 1
+            self.last_error = f"{type(error).__name__}: {error}"
+
+    def record(self, messages, rows, flush_ms, duplicates=0):
+        with self._lock:
+            now = time.monotonic()
+            elapsed = max(now - self._last_flush, 1e-6)
+            self._last_flush = now
+
+            self.batches += 1
+            self.messages += messages
+            self.rows += rows
+            self.duplicates += duplicates
+            self.last_batch_size = rows
+            self.last_flush_ms = flush_ms
+            self.max_flush_ms = max(self.max_flush_ms, flush_ms)
+            # Smoothed rows/sec, measured from the end of the previous flush
+            self.rows_per_sec = 0.8 * self.rows_per_sec + 0.2 * (rows / elapsed)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "batches": self.batches,
+                "messages": self.messages,
+                "rows": self.rows,
+                "avg_batch_size": round(self.rows / self.batches, 2) if self.batches else 0,
+                "last_batch_size": self.last_batch_size,
+                "last_flush_ms": round(self.last_flush_ms, 2),
+                "max_flush_ms": round(self.max_flush_ms, 2),
+                "rows_per_sec": round(self.rows_per_sec, 2),
+                "duplicates_skipped": self.duplicates,
+                "offset_commits": self.offset_commits,
+                "dead_lettered": self.dead_lettered,
+                "db_retries": self.db_retries,
+                "batch_fallbacks": self.batch_fallbacks,
+                "worker_restarts": self.worker_restarts,
+                "last_error": self.last_error,
+            }
+
+
+ingest_metrics = IngestMetrics()
+
+# Counters of the snapshot that add up across workers; the rest are combined below
+ADDITIVE_METRICS = ("batches", "messages", "rows", "rows_per_sec", "duplicates_skipped", "offset_commits",
+                    "dead_lettered", "db_retries", "batch_fallbacks", "worker_restarts")
+# Latest IngestMetrics snapshot of every process worker, sent over worker_metrics_queue
+worker_metrics = {}
+worker_metrics_queue = None
+
+
+def combine_snapshots(snapshots):
+    """One IngestMetrics snapshot for several workers"""
+    combined = {key: sum(snapshot[key] for snapshot in snapshots) for key in ADDITIVE_METRICS}
+    combined["rows_per_sec"] = round(combined["rows_per_sec"], 2)
+    combined["avg_batch_size"] = round(combined["rows"] / combined["batches"], 2) if combined["batches"] else 0
+    combined["max_flush_ms"] = max(snapshot["max_flush_ms"] for snapshot in snapshots)
+    latest = max(snapshots, key=lambda snapshot: snapshot["batches"])
+    combined["last_batch_size"] = latest["last_batch_size"]
+    combined["last_flush_ms"] = latest["last_flush_ms"]
+    combined["last_error"] = next((snapshot["last_error"] for snapshot in snapshots if snapshot["last_error"]), None)
+    return combined
+
+
+def report_worker_metrics(worker_id, queue, interval=1.0):
+    """Runs in a process worker: sends its ingest metrics to the parent every interval seconds"""
+    while True:
+        time.sleep(interval)
+        queue.put((worker_id, ingest_metrics.snapshot()))
+
+
+def collect_worker_metrics(queue):
+    """Runs in the parent: keeps the latest snapshot of every process worker"""
+    while True:
+        worker_id, snapshot = queue.get()
+        worker_metrics[worker_id] = snapshot
+
+
+def insert_ignore(model):
+    """
+    Multi-row INSERT that skips rows whose trace_id is already stored.
+    Only duplicate keys are ignored, any other error still fails the batch.
+    """
+    if mysql.dialect.name == "mysql":
+        statement = mysql_dialect.insert(model)
+        return statement.on_duplicate_key_update(trace_id=statement.inserted.trace_id)
+    if mysql.dialect.name == "sqlite":
+        return sqlite_dialect.insert(model).on_conflict_do_nothing(index_elements=["trace_id"])
+    return insert(model)
+
+
+def new_rows(session, model, rows):
+    """Drops rows whose trace_id is already stored or repeated within the batch"""
+    trace_ids = [row["trace_id"] for row in rows]
+    seen = set(session.execute(select(model.trace_id).where(model.trace_id.in_(trace_ids))).scalars())
+    fresh = []
+    for row in rows:
+        if row["trace_id"] not in seen:
+            seen.add(row["trace_id"])
+            fresh.append(row)
+    return fresh
+
+
+def inserted_rows(session, model, rows):
+    """
+    The rows of `rows` this transaction actually inserted. Another writer may
+    have committed some of the trace_ids after new_rows() looked: the insert
+    skipped those, and this transaction's snapshot (REPEATABLE READ, taken by
+    new_rows()) doesn't see the other writer's rows, so only ours come back.
+    """
+    trace_ids = [row["trace_id"] for row in rows]
+    mine = set(session.execute(select(model.trace_id).where(model.trace_id.in_(trace_ids))).scalars())
+    if len(mine) == len(rows):
+        return rows
+    return [row for row in rows if row["trace_id"] in mine]
+
+
+def upsert_counters():
+    """INSERT into event_counters that adds to the count when the (event_type, fire_id) row exists"""
+    statement = (mysql_dialect.insert if mysql.dialect.name == "mysql" else sqlite_dialect.insert)(EventCounter)
+    statement = statement.values(last_ingested=func.now())
+    if mysql.dialect.name == "mysql":
+        return statement.on_duplicate_key_update(
+            count=EventCounter.count + statement.inserted.count,
+            last_ingested=statement.inserted.last_ingested,
+        )
+    return statement.on_conflict_do_update(
+        index_elements=["event_type", "fire_id"],
+        set_={"count": EventCounter.count + statement.excluded.count, "last_ingested": statement.excluded.last_ingested},
+    )
+
+
+def count_events(session, model, rows):
+    """
+    Adds the rows of a batch to event_counters, one upsert row per fire.
+    Runs in the batch's transaction, so the counters move with the data. A fire
+    always lands on the same partition, so workers don't contend for a counter row.
+    """
+    per_fire = Counter(row["fire_id"] for row in rows)
+    session.execute(upsert_counters(), [
+        {"event_type": EVENT_TYPES[model], "fire_id": fire_id, "count": count}
+        for fire_id, count in per_fire.items()
+    ])
+
+
+def write_rows(session, temperature_rows, airquality_rows):
+    """
+    Writes one batch with a multi-row insert per table inside the session's
+    open transaction, along with its event counters and rollups.
+    Rows already stored (replays after a crash or rebalance) are skipped, and
+    only the rows actually inserted are counted, even with concurrent writers.
+    Returns how many rows were actually inserted.
+    """
+    inserted = 0
+    for model, rows in ((Temperature, temperature_rows), (AirQuality, airquality_rows)):
+        if not rows:
+            continue
+        rows = new_rows(session, model, rows)
+        if rows:
+            session.execute(insert_ignore(model), rows)
+            rows = inserted_rows(session, model, rows)
+        if rows:
+            count_events(session, model, rows)
+            rollups.write_rollups(session.connection(), EVENT_TYPES[model], rows)
+            inserted += len(rows)
+    return inserted
+
+
+_sqlite_writer = None
+_sqlite_writer_lock = Lock()
+
+
+def sqlite_writer():
+    """The embedded backend's writer thread, started on first use"""
+    global _sqlite_writer
+    with _sqlite_writer_lock:
+        if _sqlite_writer is None:
+            _sqlite_writer = SQLiteWriter(SessionLocal, write_rows, SQLITE_CONFIG.get('max_group_batches', 32))
+        return _sqlite_writer
+
+
+def write_batch(temperature_rows, airquality_rows):
+    """
+    Writes one batch in a single transaction and returns how many rows were inserted.
+    With the embedded backend the batch is handed to the writer thread, which
+    may commit it together with other workers' batches.
+    """
+    if EMBEDDED:
+        return sqlite_writer().write(temperature_rows, airquality_rows)
+
+    session = SessionLocal()
+    try:
+        if mysql.dialect.name == "mysql":
+            # inserted_rows() relies on one snapshot for the whole transaction
+            session.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+        inserted = write_rows(session, temperature_rows, airquality_rows)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    return inserted
+
+
+def is_transient(error):
+    """
+    Database errors worth retrying: lost connections, deadlocks, lock wait
+    timeouts (OperationalError), pool timeouts. Anything else (bad values,
+    constraint violations) fails the same way every time.
+    """
+    if isinstance(error, (OperationalError, InterfaceError, PoolTimeoutError)):
+        return True
+    return isinstance(error, DBAPIError) and error.connection_invalidated
+
+
+def write_with_retry(temperature_rows, airquality_rows):
+    """
+    write_batch, retrying transient database errors up to `max_retries` times
+    with exponential backoff (plus jitter, so workers don't retry in lockstep).
+    """
+    max_retries = INGEST_CONFIG.get('max_retries', 5)
+    backoff_ms = INGEST_CONFIG.get('retry_backoff_ms', 200)
+    max_backoff_ms = INGEST_CONFIG.get('retry_max_backoff_ms', 10000)
+    attempt = 0
+    while True:
+        try:
+            return write_batch(temperature_rows, airquality_rows)
+        except Exception as e:
+            if not is_transient(e) or attempt >= max_retries:
+                raise
+            delay = min(backoff_ms * 2 ** attempt, max_backoff_ms) / 1000
+            attempt += 1
+            ingest_metrics.record_retry()
+            logger.warning(f"Transient database error ({e}), retry {attempt}/{max_retries} in {delay:.2f}s")
+            time.sleep(delay * random.uniform(0.5, 1.5))
+
+
+def store_batch(temperature_rows, airquality_rows, dead_letters):
+    """
+    Writes a batch, isolating rows the database rejects.
+
+    Transient errors that outlast the retries are raised: the worker restarts
+    and the rows come back from Kafka, nothing is dead-lettered for an outage.
+    Any other error means some row can't be stored, so the batch is written
+    again one row at a time and the rows that still fail go to the dead letters.
+    Returns (rows inserted, rows dead-lettered).
+    """
+    try:
+        return write_with_retry(temperature_rows, airquality_rows), 0
+    except Exception as e:
+        if is_transient(e):
+            raise
+        logger.warning(f"Batch of {len(temperature_rows) + len(airquality_rows)} rows failed ({e}), writing it row by row")
+        ingest_metrics.record_fallback()
+
+    inserted = 0
+    failed = 0
+    for event_type, rows in (("temperature_reading", temperature_rows), ("airquality_reading", airquality_rows)):
+        for row in rows:
+            try:
+                if event_type == "temperature_reading":
+                    inserted += write_with_retry([row], [])
+                else:
+                    inserted += write_with_retry([], [row])
+            except Exception as e:
+                if is_transient(e):
+                    raise
+                dead_letters.send(deadletter.dead_letter_record("write", e, event_type=event_type, payload=row))
+                ingest_metrics.record_dead_letter(e)
+                failed += 1
+    return inserted, failed
+
+
+def collect_rows(msg, temperature_rows, airquality_rows, dead_letters, label):
+    """
+    Decodes one Kafka message and appends its readings to the row lists.
+    A message that can't be decoded or a reading that can't be converted goes
+    to the dead letter sink instead, so the rest of the batch carries on.
+    """
+    try:
+        # JSON or compact binary, detected from the first byte
+        msg_data = decode_message(msg.value)
+        logger.debug(f"Message: {msg_data}")
+        # A batch envelope carries many readings, a plain message just one
+        readings = list(expand_event(msg_data))
+    except Exception as e:
+        logger.warning(f"{label} dead-lettering undecodable message at offset {msg.offset}: {e}")
+        dead_letters.send(deadletter.dead_letter_record(
+            "decode", e, raw=msg.value, partition=msg.partition_id, offset=msg.offset))
+        ingest_metrics.record_dead_letter(e)
+        return
+
+    for event_type, payload in readings:
+        try:
+            if event_type == "temperature_reading":
+                temperature_rows.append(temperature_row(payload))
+            elif event_type == "airquality_reading":
+                airquality_rows.append(airquality_row(payload))
+        except Exception as e:
+            logger.warning(f"{label} dead-lettering bad {event_type} at offset {msg.offset}: {e}")
+            dead_letters.send(deadletter.dead_letter_record(
+                "convert", e, event_type=event_type, payload=payload, partition=msg.partition_id, offset=msg.offset))
+            ingest_metrics.record_dead_letter(e)
+
+
+def process_messages(worker_id=0):
+    """
+    Process event messages from Kafka in micro-batches.
+
+    Rows are buffered until `batch_size` rows are pending or `flush_ms` has
+    passed since the first one, whichever comes first. Each flush commits the
+    DB transaction; Kafka offsets are committed lazily, every
+    `commit_interval_ms`. Messages replayed after a crash are harmless because
+    rows whose trace_id is already stored are skipped (at-least-once delivery,
+    exactly-once rows).
+
+    After a rebalance the consumer restarts every partition it now owns from
+    the last committed offset, so rows buffered before the rebalance are
+    dropped instead of written: they will be delivered again, either to this
+    worker or to the one that took over their partition.
+
+    Messages that can't be decoded or stored go to the dead letter sink (file
+    or topic, see `dead_letter`), see collect_rows and store_batch.
+    """
     hostname = f"{app_config['events']['hostname']}:{app_config['events']['port']}"
     topic_name = app_config['events']['topic']
+    batch_size = INGEST_CONFIG.get('batch_size', 500)
+    flush_ms = INGEST_CONFIG.get('flush_ms', 200)
+    commit_interval = INGEST_CONFIG.get('commit_interval_ms', 5000) / 1000
     
-    logger.info(f"Connecting to Kafka at {hostname}")
+    dead_letters = deadletter.make_sink(DEAD_LETTER_CONFIG, hostname)
+    rebalanced = Event()
+
+    def on_rebalance(consumer, old_offsets, new_offsets):
+        logger.info(f"Worker {worker_id} rebalanced: partitions {sorted(old_offsets)} -> {sorted(new_offsets)}")
+        rebalanced.set()
+        # Returning None resumes from the committed offsets
+        return None
+
+    logger.info(f"Worker {worker_id} connecting to Kafka at {hostname}")
     
-    kafka_wrapper = KafkaWrapper(hostname, topic_name)
+    kafka_wrapper = KafkaWrapper(
+        hostname,
+        topic_name,
+        consumer_timeout_ms=flush_ms,
+        balanced=CONSUMER_CONFIG.get('balanced', True),
+        on_rebalance=on_rebalance
+    )
     
-    logger.info("Kafka consumer started, waiting for messages...")
+    logger.info(f"Worker {worker_id} Kafka consumer started, waiting for messages...")
     
+    temperature_rows = []
+    airquality_rows = []
+    pending_messages = 0
+    batch_started = None
+    uncommitted = False
+    last_commit = time.monotonic()
+
     # Use the wrapper's messages generator
     for msg in kafka_wrapper.messages():
-        msg_str = msg.value.decode('utf-8')
-        msg_data = json.loads(msg_str)
-        logger.info(f"Message: {msg_data}")
-        
-        payload = msg_data["payload"]
-        
-        if msg_data["type"] == "temperature_reading":
-            create_temperature_reading(payload)
-            logger.info(f"Stored temperature_reading event with trace_id: {payload['trace_id']}")
-            
-        elif msg_data["type"] == "airquality_reading":
-            create_airquality_reading(payload)
-            logger.info(f"Stored airquality_reading event with trace_id: {payload['trace_id']}")
-        
-        # Commit the new message as being read
-        kafka_wrapper.consumer.commit_offsets()
+        if rebalanced.is_set():
+            rebalanced.clear()
+            if pending_messages:
+                logger.info(f"Worker {worker_id} dropping {pending_messages} uncommitted messages after rebalance")
+            temperature_rows = []
+            airquality_rows = []
+            pending_messages = 0
+            batch_started = None
+            uncommitted = False
+
+        if msg is not None:
+            collect_rows(msg, temperature_rows, airquality_rows, dead_letters, f"Worker {worker_id}")
+            pending_messages += 1
+            if batch_started is None:
+                batch_started = time.monotonic()
+
+        if pending_messages:
+            num_rows = len(temperature_rows) + len(airquality_rows)
+            if num_rows >= batch_size or (time.monotonic() - batch_started) * 1000 >= flush_ms:
+                flush_started = time.monotonic()
+                inserted, failed = store_batch(temperature_rows, airquality_rows, dead_letters)
+                elapsed_ms = (time.monotonic() - flush_started) * 1000
+                uncommitted = True
+
+                ingest_metrics.record(pending_messages, inserted, elapsed_ms, duplicates=num_rows - inserted - failed)
+                logger.info(f"Worker {worker_id} stored {inserted} of {num_rows} readings from {pending_messages} messages in {elapsed_ms:.1f} ms")
+
+                temperature_rows = []
+                airquality_rows = []
+                pending_messages = 0
+                batch_started = None
+
+        # Offsets are only committed for rows that are already in the database
+        if uncommitted and not pending_messages and time.monotonic() - last_commit >= commit_interval:
+            kafka_wrapper.consumer.commit_offsets()
+            ingest_metrics.record_commit()
+            uncommitted = False
+            last_commit = time.monotonic()
+
+
+def run_consumer_worker(worker_id, in_child_process=False, metrics_queue=None):
+    """Runs one consumer worker, restarting it with a backoff if it crashes"""
+    global ingest_metrics
+    if in_child_process:
+        # Connections inherited from the parent process can't be shared, start a fresh pool
+        mysql.dispose(close=False)
+        # Counts of its own only, the parent adds up the workers' snapshots
+        ingest_metrics = IngestMetrics()
+    if metrics_queue is not None:
+        Thread(target=report_worker_metrics, args=(worker_id, metrics_queue), daemon=True).start()
+
+    backoff = 1
+    while True:
+        try:
+            process_messages(worker_id)
+        except Exception as e:
+            logger.exception(f"Consumer worker {worker_id} crashed: {e}")
+            ingest_metrics.record_restart(e)
+        logger.info(f"Restarting consumer worker {worker_id} in {backoff} seconds")
+        time.sleep(backoff)
+        backoff = min(backoff * 2, 60)
 
 
 def setup_kafka_thread():
-    """Setup Kafka consumer thread"""
-    t1 = Thread(target=process_messages)
-    t1.setDaemon(True)
+    """
+    Starts the pool of Kafka consumer workers.
+    `consumer.workers` sets how many, `consumer.worker_type` whether they are
+    threads in this process or separate processes (to use more than one core).
+    """
+    num_workers = CONSUMER_CONFIG.get('workers', 1)
+    worker_type = CONSUMER_CONFIG.get('worker_type', 'thread')
+    if EMBEDDED and worker_type == 'process':
+        # All writes have to go through this process's single SQLite writer thread
+        logger.warning("The embedded SQLite backend needs thread workers, ignoring worker_type: process")
+        worker_type = 'thread'
+
+    global worker_metrics_queue
+    if worker_type == 'process' and worker_metrics_queue is None:
+        worker_metrics_queue = multiprocessing.Queue()
+        Thread(target=collect_worker_metrics, args=(worker_metrics_queue,), daemon=True).start()
+
+    workers = []
+    for worker_id in range(num_workers):
+        if worker_type == 'process':
+            worker = multiprocessing.Process(target=run_consumer_worker,
+                                             args=(worker_id, True, worker_metrics_queue), daemon=True)
+        else:
+            worker = Thread(target=run_consumer_worker, args=(worker_id,), daemon=True)
+        worker.start()
+        workers.append(worker)
+
+    logger.info(f"Started {num_workers} Kafka consumer {worker_type} workers")
+    return workers
+
+
+def run_retention_loop():
+    """Archives rows older than hot_days every interval_s seconds"""
+    while True:
+        try:
+            archive.run_retention(
+                mysql,
+                [Temperature.__table__, AirQuality.__table__],
+                ARCHIVE_DIR,
+                RETENTION_CONFIG.get('hot_days', 30),
+                chunk_rows=RETENTION_CONFIG.get('chunk_rows', 5000),
+                delete_batch=RETENTION_CONFIG.get('delete_batch', 1000),
+                logger=logger,
+            )
+        except Exception as e:
+            logger.error(f"Retention pass failed: {e}")
+        time.sleep(RETENTION_CONFIG.get('interval_s', 3600))
+
+
+def setup_retention_thread():
+    t1 = Thread(target=run_retention_loop)
+    t1.daemon = True
     t1.start()
-    logger.info("Kafka consumer thread started")
+    logger.info(f"Retention job started, rows older than {RETENTION_CONFIG.get('hot_days', 30)} days go to {ARCHIVE_DIR}")
+    return t1
 
 
 # ==============================FINALS================================
 
 
 def get_events_stats():
-    session = SessionLocal()
+    """
+    Event counts from the event_counters table, overall and per fire_id.
+    The table has one row per (event type, fire), so this doesn't grow with the number of readings.
+    """
+    session = ReadSession()
     
-    logger.info("STATS event initiated: COUNTING EVENTS ON DATABASE")
-    
-    temp_count = session.execute(select(func.count()).select_from(Temperature)).scalar()
-    airq_count = session.execute(select(func.count()).select_from(AirQuality)).scalar()
+    logger.info("STATS event initiated: READING EVENT COUNTERS")
     
+    counters = session.execute(select(EventCounter)).scalars().all()
     
     session.close()
     
-    stats = {
-        "num_temp": temp_count,
-        "num_airquality": airq_count
-    }
+    keys = {"temperature_reading": "num_temp", "airquality_reading": "num_airquality"}
+    stats = {"num_temp": 0, "num_airquality": 0, "last_ingested": None, "fires": {}}
+    for counter in counters:
+        key = keys[counter.event_type]
+        fire = stats["fires"].setdefault(counter.fire_id, {"num_temp": 0, "num_airquality": 0, "last_ingested": None})
+        fire[key] += counter.count
+        stats[key] += counter.count
+        fire["last_ingested"] = max(filter(None, (fire["last_ingested"], counter.last_ingested)))
+        stats["last_ingested"] = max(filter(None, (stats["last_ingested"], counter.last_ingested)))
+
+    for item in (stats, *stats["fires"].values()):
+        if item["last_ingested"] is not None:
+            item["last_ingested"] = serialize.format_timestamp(item["last_ingested"])
     
-    logger.info(f"Event statistics: {stats}")
+    logger.info(f"Event statistics: {stats['num_temp']} temperature, {stats['num_airquality']} air quality, {len(stats['fires'])} fires")
     
     return stats, 200
 
 
 # ==============================FINALS================================
-def get_temperature_readings(start_timestamp, end_timestamp):
-    """Gets temperature readings between the start and end timestamps"""
-    session = SessionLocal()
-    
-    logger.info(f"Query for Temperature readings between {start_timestamp} and {end_timestamp}")
-    
+NDJSON = "application/x-ndjson"
+
+
+def encode_cursor(last_id):
+    """Opaque page cursor: the id of the last row returned, base64 encoded"""
+    return base64.urlsafe_b64encode(json.dumps({"after_id": last_id}).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        return int(json.loads(base64.urlsafe_b64decode(padded))["after_id"])
+    except (ValueError, TypeError, KeyError):
+        raise ValueError(f"Invalid cursor '{cursor}'")
+
+
+# Columns returned by the range endpoints, in response order. Rows are read as
+# plain tuples (id first, for the cursor) and turned into dicts by a precompiled serializer.
+READ_COLUMNS = {
+    Temperature: ("trace_id", "fire_id", "latitude", "longitude", "temperature_celsius",
+                  "humidity_level", "batch_timestamp", "reading_timestamp"),
+    AirQuality: ("trace_id", "fire_id", "location_name", "particulate_level", "air_quality",
+                 "smoke_opacity", "batch_timestamp", "reading_timestamp"),
+}
+SERIALIZERS = {
+    model: serialize.make_serializer(columns, ("batch_timestamp", "reading_timestamp"))
+    for model, columns in READ_COLUMNS.items()
+}
+# The id-range endpoints return the id as well, it is the client's watermark
+ID_SERIALIZERS = {
+    model: serialize.make_serializer(("id",) + columns, ("batch_timestamp", "reading_timestamp"))
+    for model, columns in READ_COLUMNS.items()
+}
+
+
+def stream_rows(statement):
+    """
+    Yields the rows of `statement` from a server-side cursor, stream_batch_size
+    rows at a time, so memory doesn't grow with the window.
+    """
+    with mysql_read.connect() as conn:
+        result = conn.execution_options(
+            stream_results=True, yield_per=QUERY_CONFIG.get('stream_batch_size', 1000)
+        ).execute(statement)
+        yield from result
+
+
+def stream_ndjson(rows, serializer):
+    """Yields NDJSON chunks of stream_batch_size rows as `rows` is consumed"""
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, QUERY_CONFIG.get('stream_batch_size', 1000)))
+        if not chunk:
+            return
+        yield serialize.dumps_lines([serializer(row[1:]) for row in chunk])
+
+
+response_cache = ResponseCache(
+    int(CACHE_CONFIG.get('max_mb', 64) * 1024 * 1024),
+    int(CACHE_CONFIG.get('max_entry_mb', 8) * 1024 * 1024),
+)
+
+
+def is_closed_window(end_datetime):
+    """
+    A window is closed once its end is older than the ingest watermark: now
+    minus cache.grace_s, which covers the delay between date_created being set
+    and the batch committing. No new row can land in a closed window.
+    """
+    watermark = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(seconds=CACHE_CONFIG.get('grace_s', 60))
+    return rollups.to_utc(end_datetime) <= watermark
+
+
+def query_readings(model, label, start_timestamp, end_timestamp, limit=None, cursor=None):
+    """
+    Gets the readings of `model` created between the start and end timestamps, ordered by id.
+
+    With `limit`, one page is returned and the X-Next-Cursor header holds the
+    cursor for the next one (keyset on id, so deep pages cost the same as the
+    first). Without it the whole window is returned. Clients that send
+    "Accept: application/x-ndjson" get the rows streamed as NDJSON instead of a JSON array.
+    Rows already moved to the archive by the retention job are included transparently.
+    Responses for closed windows are served from response_cache when possible.
+    """
+    logger.info(f"Query for {label} readings between {start_timestamp} and {end_timestamp}")
+
     # Convert ISO format timestamps to datetime objects
     start_datetime = datetime.fromisoformat(start_timestamp.replace('Z', '+00:00'))
     end_datetime = datetime.fromisoformat(end_timestamp.replace('Z', '+00:00'))
-    
+
+    try:
+        after_id = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return {"message": str(e)}, 400, {"Content-Type": "application/json"}
+
+    ndjson = NDJSON in connexion.request.headers.get("Accept", "")
+    cache_key = None
+    # Unlimited NDJSON is streamed and never held in memory, so it is never cached
+    if CACHE_CONFIG.get('enabled', False) and not (ndjson and not limit):
+        if is_closed_window(end_datetime):
+            cache_key = (model.__tablename__, rollups.to_utc(start_datetime), rollups.to_utc(end_datetime), limit, after_id, ndjson)
+            cached = response_cache.get(cache_key)
+            if cached is not None:
+                body, mimetype, headers = cached
+                return Response(body, status=200, mimetype=mimetype, headers=headers)
+        else:
+            response_cache.bypass()
+
     # Query the database for readings within the timestamp range
-    statement = select(Temperature).where(
-        Temperature.date_created >= start_datetime
+    statement = select(model.id, *[getattr(model, column) for column in READ_COLUMNS[model]]).where(
+        model.date_created >= start_datetime
     ).where(
-        Temperature.date_created < end_datetime
+        model.date_created < end_datetime
     )
-    
-    results = [
-        result.to_dict()
-        for result in session.execute(statement).scalars().all()
-    ]
-    
-    session.close()
-    
-    logger.info(f"Query for Temperature readings returns {len(results)} results")
-    
-    return results, 200
+    if after_id is not None:
+        statement = statement.where(model.id > after_id)
+    statement = statement.order_by(model.id)
+    if limit:
+        statement = statement.limit(limit + 1)
+
+    database_rows = stream_rows(statement)
+    rows = database_rows
+    if RETENTION_CONFIG.get('enabled', False):
+        # Archived rows are merged in by id. Only segments of days inside the window are
+        # looked at, so windows within the hot horizon cost a directory listing.
+        archived_rows = archive.iter_archived(
+            ARCHIVE_DIR, model.__tablename__, ("id",) + READ_COLUMNS[model], start_datetime, end_datetime, after_id
+        )
+        rows = archive.drop_repeated_ids(heapq.merge(archived_rows, database_rows, key=itemgetter(0)))
+
+    headers = {}
+    if limit:
+        # A page is at most `limit` rows, so it is read up front to know the next cursor
+        rows = list(islice(rows, limit + 1))
+        database_rows.close()
+        if len(rows) > limit:
+            rows = rows[:limit]
+            headers["X-Next-Cursor"] = encode_cursor(rows[-1][0])
+
+    serializer = SERIALIZERS[model]
+    if ndjson and not limit:
+        return Response(stream_ndjson(rows, serializer), status=200, mimetype=NDJSON, headers=headers)
+
+    if ndjson:
+        body, mimetype = b"".join(stream_ndjson(rows, serializer)), NDJSON
+        logger.info(f"Query for {label} readings returns {len(rows)} results")
+    else:
+        results = [serializer(row[1:]) for row in rows]
+        logger.info(f"Query for {label} readings returns {len(results)} results")
+        # Encoded here (orjson when available) instead of by connexion's JSON provider
+        body, mimetype = serialize.dumps(results), "application/json"
 
+    if cache_key is not None:
+        response_cache.put(cache_key, body, mimetype, headers)
+    return Response(body, status=200, mimetype=mimetype, headers=headers)
 
-def get_airquality_readings(start_timestamp, end_timestamp):
+
+def get_temperature_readings(start_timestamp, end_timestamp, limit=None, cursor=None):
+    """Gets temperature readings between the start and end timestamps"""
+    return query_readings(Temperature, "Temperature", start_timestamp, end_timestamp, limit, cursor)
+
+
+def get_airquality_readings(start_timestamp, end_timestamp, limit=None, cursor=None):
     """Gets air quality readings between the start and end timestamps"""
-    session = SessionLocal()
-    
-    logger.info(f"Query for Air Quality readings between {start_timestamp} and {end_timestamp}")
-    
-    # Convert ISO format timestamps to datetime objects
+    return query_readings(AirQuality, "Air Quality", start_timestamp, end_timestamp, limit, cursor)
+
+
+# Start of the oldest open transaction that has written rows (needs the PROCESS privilege)
+OLDEST_WRITE_TRX = text(
+    "SELECT MIN(trx_started) FROM information_schema.innodb_trx "
+    "WHERE trx_rows_modified > 0 AND trx_mysql_thread_id <> CONNECTION_ID()"
+)
+oldest_trx_readable = True
+
+
+def commit_cutoff(conn):
+    """
+    Newest date_created the /after endpoints may return. Ids are handed out at
+    insert, so a transaction still open can hold smaller ids than rows already
+    visible; its rows were created after it started (date_created is NOW() of
+    the INSERT), so everything created before the oldest open write transaction
+    is safe. query.commit_grace_s on top covers an INSERT that has its ids but
+    hasn't counted its rows yet. Without access to innodb_trx only the grace
+    applies, and a transaction open longer than that can still be skipped.
+    """
+    global oldest_trx_readable
+    now = conn.execute(select(func.now())).scalar()
+    cutoff = now - timedelta(seconds=QUERY_CONFIG.get('commit_grace_s', 10))
+    # SQLite has one writer and commits ids in order, rows never show up out of order
+    if EMBEDDED or not oldest_trx_readable:
+        return cutoff
+    try:
+        oldest = conn.execute(OLDEST_WRITE_TRX).scalar()
+    except DBAPIError as e:
+        oldest_trx_readable = False
+        logger.warning(f"Can't read information_schema.innodb_trx ({e}), the /after endpoints only hold back "
+                       f"rows younger than query.commit_grace_s")
+        conn.rollback()
+        return cutoff
+    return min(cutoff, oldest) if oldest is not None else cutoff
+
+
+def query_after_id(model, label, after_id, limit=1000):
+    """
+    Gets up to `limit` readings of `model` with an id greater than after_id, in
+    id order and including the id: a primary key range scan. Clients keep the
+    last id they got as a watermark and ask for the rows after it, so no row is
+    missed or counted twice whatever the clocks say.
+
+    Rows created after commit_cutoff() are left for a later call, so a
+    transaction still committing smaller ids doesn't get skipped by the
+    watermark. Archived rows are included when after_id is older than the
+    oldest row still in the database.
+    """
+    logger.info(f"Query for {label} readings after id {after_id}, up to {limit}")
+
+    # The primary engine: on a lagging replica, rows could show up out of id order.
+    # Embedded, both engines read the same file and the primary one is the writer's.
+    with (mysql_read if EMBEDDED else mysql).connect() as conn:
+        cutoff = commit_cutoff(conn)
+        statement = select(model.id, *[getattr(model, column) for column in READ_COLUMNS[model]]).where(
+            model.id > after_id
+        ).where(
+            model.date_created < cutoff
+        ).order_by(model.id).limit(limit)
+        rows = conn.execute(statement).all()
+        oldest_id = conn.execute(select(func.min(model.id))).scalar() if RETENTION_CONFIG.get('enabled', False) else None
+
+    if oldest_id is not None and after_id + 1 < oldest_id:
+        archived_rows = archive.iter_archived(
+            ARCHIVE_DIR, model.__tablename__, ("id",) + READ_COLUMNS[model], datetime.min, cutoff, after_id
+        )
+        rows = list(islice(archive.drop_repeated_ids(heapq.merge(archived_rows, rows, key=itemgetter(0))), limit))
+
+    serializer = ID_SERIALIZERS[model]
+    logger.info(f"Query for {label} readings after id {after_id} returns {len(rows)} results")
+    if NDJSON in connexion.request.headers.get("Accept", ""):
+        return Response(serialize.dumps_lines([serializer(row) for row in rows]), status=200, mimetype=NDJSON)
+    return Response(serialize.dumps([serializer(row) for row in rows]), status=200, mimetype="application/json")
+
+
+def get_temperature_after(after_id, limit=1000):
+    """Gets the temperature readings after an id"""
+    return query_after_id(Temperature, "Temperature", after_id, limit)
+
+
+def get_airquality_after(after_id, limit=1000):
+    """Gets the air quality readings after an id"""
+    return query_after_id(AirQuality, "Air Quality", after_id, limit)
+
+
+def get_temperature_area(min_latitude, max_latitude, min_longitude, max_longitude, start_timestamp, end_timestamp,
+                         min_temperature=None, summary=False, limit=1000, cursor=None):
+    """
+    Gets the temperature readings inside a bounding box with reading_timestamp
+    between the start and end timestamps, optionally only those at or above min_temperature.
+
+    The box is turned into grid cells (geo.py) so the database reads the
+    (geo_cell, reading_timestamp) index; the exact box is then checked on the
+    candidate rows. With `summary` one aggregate per grid cell is returned instead
+    of the readings. Only rows still in the database are searched, not the archive.
+    """
+    logger.info(f"Query for temperature readings in [{min_latitude}, {min_longitude}] - [{max_latitude}, {max_longitude}] "
+                f"between {start_timestamp} and {end_timestamp}")
+    if min_latitude > max_latitude or min_longitude > max_longitude:
+        return {"message": "min_latitude/min_longitude must not be greater than max_latitude/max_longitude"}, 400
+
     start_datetime = datetime.fromisoformat(start_timestamp.replace('Z', '+00:00'))
     end_datetime = datetime.fromisoformat(end_timestamp.replace('Z', '+00:00'))
-    
-    # Query the database for readings within the timestamp range
-    statement = select(AirQuality).where(
-        AirQuality.date_created >= start_datetime
-    ).where(
-        AirQuality.date_created < end_datetime
-    )
-    
-    results = [
-        result.to_dict()
-        for result in session.execute(statement).scalars().all()
+    try:
+        after_id = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return {"message": str(e)}, 400
+
+    ranges = geo.cell_ranges(min_latitude, min_longitude, max_latitude, max_longitude)
+    conditions = [
+        geo.cell_condition(Temperature.geo_cell, ranges, QUERY_CONFIG.get('area_max_cells', 2000)),
+        Temperature.reading_timestamp >= rollups.to_utc(start_datetime),
+        Temperature.reading_timestamp < rollups.to_utc(end_datetime),
+        Temperature.latitude.between(min_latitude, max_latitude),
+        Temperature.longitude.between(min_longitude, max_longitude),
     ]
-    
-    session.close()
-    
-    logger.info(f"Query for Air Quality readings returns {len(results)} results")
-    
+    if min_temperature is not None:
+        conditions.append(Temperature.temperature_celsius >= min_temperature)
+
+    if summary:
+        statement = select(
+            Temperature.geo_cell,
+            func.count(),
+            func.min(Temperature.temperature_celsius),
+            func.max(Temperature.temperature_celsius),
+            func.avg(Temperature.temperature_celsius),
+        ).where(*conditions).group_by(Temperature.geo_cell).order_by(Temperature.geo_cell)
+        with mysql_read.connect() as conn:
+            rows = conn.execute(statement).all()
+        results = []
+        for cell, count, low, high, mean in rows:
+            cell_min_latitude, cell_min_longitude, cell_max_latitude, cell_max_longitude = geo.cell_bounds(cell)
+            results.append({
+                "geo_cell": cell,
+                "min_latitude": round(cell_min_latitude, 6),
+                "min_longitude": round(cell_min_longitude, 6),
+                "max_latitude": round(cell_max_latitude, 6),
+                "max_longitude": round(cell_max_longitude, 6),
+                "count": count,
+                "min": low,
+                "max": high,
+                "mean": float(mean),
+            })
+        logger.info(f"Query for temperature area summary returns {len(results)} cells")
+        return results, 200
+
+    statement = select(Temperature.id, *[getattr(Temperature, column) for column in READ_COLUMNS[Temperature]]).where(*conditions)
+    if after_id is not None:
+        statement = statement.where(Temperature.id > after_id)
+    statement = statement.order_by(Temperature.id).limit(limit + 1)
+    with mysql_read.connect() as conn:
+        rows = conn.execute(statement).all()
+
+    headers = {}
+    if len(rows) > limit:
+        rows = rows[:limit]
+        headers["X-Next-Cursor"] = encode_cursor(rows[-1][0])
+    serializer = SERIALIZERS[Temperature]
+    results = [serializer(row[1:]) for row in rows]
+    logger.info(f"Query for temperature area readings returns {len(results)} results")
+    return Response(serialize.dumps(results), status=200, mimetype="application/json", headers=headers)
+
+
+def get_rollups(metric, start_timestamp, end_timestamp, resolution="hour", fire_id=None):
+    """Gets the pre-aggregated buckets of one metric between the start and end timestamps"""
+    logger.info(f"Query for {resolution} rollups of {metric} between {start_timestamp} and {end_timestamp}")
+
+    start_datetime = datetime.fromisoformat(start_timestamp.replace('Z', '+00:00'))
+    end_datetime = datetime.fromisoformat(end_timestamp.replace('Z', '+00:00'))
+
+    with mysql_read.connect() as conn:
+        results = rollups.query_rollups(conn, resolution, metric, start_datetime, end_datetime, fire_id)
+    for result in results:
+        result["bucket_start"] = serialize.format_timestamp(result["bucket_start"])
+
+    logger.info(f"Query for {resolution} rollups of {metric} returns {len(results)} buckets")
+
     return results, 200
 
 
+def get_metrics():
+    """
+    Internal metrics of this storage process. Ingest numbers cover the consumer
+    workers it started (threads, or processes reporting every second), so they
+    stay at zero with STORAGE_ROLE=api; the consumer role serves them on
+    consumer.metrics_port instead.
+    """
+    ingest = ingest_metrics.snapshot()
+    if worker_metrics:
+        ingest = combine_snapshots([ingest] + list(worker_metrics.values()))
+    return {
+        "ingest": ingest,
+        "cache": response_cache.snapshot(),
+        "pools": {"write": pool_snapshot(mysql), "read": pool_snapshot(mysql_read)},
+        **({"writer": _sqlite_writer.stats()} if _sqlite_writer is not None else {}),
+    }, 200
+
+
 #============Assignment 1
 def health():
     return {"status": "healthy"}, 200
 
 
+class MetricsHandler(BaseHTTPRequestHandler):
+    """/storage/metrics and /storage/health of a consumer-only process, which doesn't run the API"""
+
+    def do_GET(self):
+        routes = {"/storage/metrics": get_metrics, "/storage/health": health}
+        handler = routes.get(self.path.split("?")[0].rstrip("/"))
+        if handler is None:
+            self.send_error(404)
+            return
+        body, status = handler()
+        payload = serialize.dumps(body)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logger.debug(f"Metrics request: {format % args}")
+
+
+def setup_metrics_server(port):
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Serving consumer metrics on port {port}")
+    return server
+
+
+class NDJSONResponseValidator:
+    """
+    Lets NDJSON responses through without validation. connexion's JSON validator
+    would match the type and buffer the whole stream to parse it. Each line is
+    built by the same SERIALIZERS / ID_SERIALIZERS row serializer
+    (serialize.make_serializer) as the validated JSON responses of that
+    endpoint; only the framing differs (serialize.dumps_lines vs serialize.dumps).
+    """
+
+    def __init__(self, scope, **kwargs):
+        pass
+
+    def wrap_send(self, send):
+        return send
+
+
+RESPONSE_VALIDATORS = MediaTypeDict({**VALIDATOR_MAP["response"], NDJSON: NDJSONResponseValidator})
+
+
 app = connexion.App(__name__, specification_dir=".")
 # LAB 12: Add base_path
 app.add_api("openapi.yaml", 
             base_path="/storage",  # <--- ADD THIS
             strict_validation=True, 
-            validate_responses=True)
+            # Re-validating every row of large range responses is expensive, prod turns it off
+            validate_responses=API_CONFIG.get('validate_responses', True),
+            validator_map={"response": RESPONSE_VALIDATORS})
 # LAB 12: Conditional CORS (replace the existing CORS lines)
 if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
     from flask_cors import CORS
@@ -431,6 +1425,18 @@ if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
     logger.info("CORS enabled for all origins")
 
 if __name__ == "__main__":
-    logger.info("Database tables created/verified")
-    setup_kafka_thread()
-    app.run(port=8090, host="0.0.0.0")
\ No newline at end of file
+    # STORAGE_ROLE lets the consumer pool and the HTTP API run (and scale) separately:
+    # "all" runs both in this process, "api" only the HTTP API, "consumer" only the workers
+    role = os.environ.get("STORAGE_ROLE", "all")
+    logger.info(f"Starting storage with role {role}")
+    workers = []
+    if role in ("all", "consumer"):
+        workers = setup_kafka_thread()
+        if RETENTION_CONFIG.get('enabled', False):
+            setup_retention_thread()
+    if role in ("all", "api"):
+        app.run(port=8090, host="0.0.0.0")
+    else:
+        setup_metrics_server(CONSUMER_CONFIG.get('metrics_port', 8091))
+        for worker in workers:
+            worker.join()
\ No newline at end of file
@@ -0,0 +1,323 @@
+# STORAGE ARCHIVE.PY
+# Cold storage for old readings: columnar, compressed segment files under
+#   <archive_dir>/<table>/<YYYY-MM-DD>/<fire key>-<min_id>-<max_id>.seg
+# (day of date_created, fire key = sha256 hex of the fire_id, which is stored in
+# the segment itself), written by the retention job and read back with mmap.
+import datetime
+import hashlib
+import heapq
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+from array import array
+from collections import defaultdict
+from itertools import accumulate
+
+from sqlalchemy import select, delete, func, text
+
+# Column types: "i" int64, "f" float64 (None stored as NaN), "t" timestamp, "s" string
+COLUMNS = {
+    "temperature": (
+        ("id", "i"), ("trace_id", "i"), ("fire_id", "s"), ("latitude", "f"), ("longitude", "f"),
+        ("temperature_celsius", "f"), ("humidity_level", "f"),
+        ("batch_timestamp", "t"), ("reading_timestamp", "t"), ("date_created", "t"),
+    ),
+    "airquality": (
+        ("id", "i"), ("trace_id", "i"), ("fire_id", "s"), ("location_name", "s"),
+        ("particulate_level", "f"), ("air_quality", "f"), ("smoke_opacity", "f"),
+        ("batch_timestamp", "t"), ("reading_timestamp", "t"), ("date_created", "t"),
+    ),
+}
+
+MAGIC = b"FSEG"
+VERSION = 1
+# magic, version, row count, column count
+HEADER = struct.Struct("<4sBIH")
+# name length, type, offset, compressed length (followed by the name)
+COLUMN_ENTRY = struct.Struct("<B1sQQ")
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class SegmentError(ValueError):
+    """Raised when a segment file is not in the expected format"""
+
+
+def to_micros(value):
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return (value - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def from_micros(value):
+    return EPOCH + datetime.timedelta(microseconds=value)
+
+
+def _int_bytes(values):
+    data = array("q", values)
+    if sys.byteorder != "little":
+        data.byteswap()
+    return data.tobytes()
+
+
+def _int_values(raw):
+    data = array("q")
+    data.frombytes(raw)
+    if sys.byteorder != "little":
+        data.byteswap()
+    return data
+
+
+def encode_column(kind, values):
+    """
+    Encodes one column. ids and timestamps are stored as deltas from the
+    previous row, which are small and compress much better than the values.
+    """
+    if kind == "i" or kind == "t":
+        numbers = [to_micros(v) for v in values] if kind == "t" else list(values)
+        deltas = [b - a for a, b in zip([0] + numbers, numbers)]
+        return _int_bytes(deltas)
+    if kind == "f":
+        data = array("d", [math.nan if v is None else v for v in values])
+        if sys.byteorder != "little":
+            data.byteswap()
+        return data.tobytes()
+    if kind == "s":
+        return json.dumps(list(values)).encode("utf-8")
+    raise SegmentError(f"unknown column type {kind}")
+
+
+def decode_column(kind, raw):
+    if kind == "i":
+        return list(accumulate(_int_values(raw)))
+    if kind == "t":
+        return [from_micros(v) for v in accumulate(_int_values(raw))]
+    if kind == "f":
+        data = array("d")
+        data.frombytes(raw)
+        if sys.byteorder != "little":
+            data.byteswap()
+        return [None if math.isnan(v) else v for v in data]
+    if kind == "s":
+        return json.loads(bytes(raw))
+    raise SegmentError(f"unknown column type {kind}")
+
+
+def write_segment(path, columns, rows, level=6):
+    """
+    Writes rows (tuples in `columns` order, sorted by id) to a segment file.
+    The file is written under a temporary name, fsynced and renamed, so readers
+    only ever see complete segments.
+    """
+    blobs = [
+        zlib.compress(encode_column(kind, [row[i] for row in rows]), level)
+        for i, (_, kind) in enumerate(columns)
+    ]
+    names = [name.encode("utf-8") for name, _ in columns]
+    offset = HEADER.size + sum(COLUMN_ENTRY.size + len(name) for name in names)
+
+    directory = HEADER.pack(MAGIC, VERSION, len(rows), len(columns))
+    for name, (_, kind), blob in zip(names, columns, blobs):
+        directory += COLUMN_ENTRY.pack(len(name), kind.encode(), offset, len(blob)) + name
+        offset += len(blob)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(directory)
+        for blob in blobs:
+            f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    dir_fd = os.open(os.path.dirname(path), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def read_segment(path, wanted):
+    """
+    Reads the `wanted` columns of a segment through a read-only mmap. Only
+    those columns are decompressed; the rest of the file is never paged in.
+    Returns {column: list of values}.
+    """
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        with memoryview(mapped) as view:
+            magic, version, count, num_columns = HEADER.unpack_from(view, 0)
+            if magic != MAGIC or version != VERSION:
+                raise SegmentError(f"{path} is not a version {VERSION} segment")
+            position = HEADER.size
+            values = {}
+            for _ in range(num_columns):
+                name_length, kind, offset, length = COLUMN_ENTRY.unpack_from(view, position)
+                position += COLUMN_ENTRY.size
+                name = bytes(view[position:position + name_length]).decode("utf-8")
+                position += name_length
+                if name in wanted:
+                    values[name] = decode_column(kind.decode(), zlib.decompress(view[offset:offset + length]))
+    missing = set(wanted) - set(values)
+    if missing:
+        raise SegmentError(f"{path} has no column(s) {', '.join(sorted(missing))}")
+    return values
+
+
+def segment_path(archive_dir, table, day, fire_id, min_id, max_id):
+    """
+    Path of a segment. fire_id comes from client-submitted events, so it is
+    never used in the name as is: its hex digest can't contain "/", ".." or the
+    "-" find_segments() splits on.
+    """
+    fire_key = hashlib.sha256(str(fire_id).encode("utf-8")).hexdigest()
+    root = os.path.realpath(archive_dir)
+    path = os.path.realpath(os.path.join(root, table, day.isoformat(), f"{fire_key}-{min_id}-{max_id}.seg"))
+    if os.path.commonpath([root, path]) != root:
+        raise SegmentError(f"segment path {path} is outside {root}")
+    return path
+
+
+def find_segments(archive_dir, table, start, end, after_id=None):
+    """
+    Segment files whose day overlaps [start, end) and that can hold ids above
+    `after_id`, as (min_id, max_id, path). Pruning only needs directory and file names.
+    """
+    table_dir = os.path.join(archive_dir, table)
+    try:
+        days = os.listdir(table_dir)
+    except FileNotFoundError:
+        return []
+    first_day, last_day = start.date().isoformat(), end.date().isoformat()
+    segments = []
+    for day in days:
+        if not first_day <= day <= last_day:
+            continue
+        for filename in os.listdir(os.path.join(table_dir, day)):
+            if not filename.endswith(".seg"):
+                continue
+            _, min_id, max_id = filename[:-4].rsplit("-", 2)
+            if after_id is not None and int(max_id) <= after_id:
+                continue
+            segments.append((int(min_id), int(max_id), os.path.join(table_dir, day, filename)))
+    return segments
+
+
+def _segment_rows(path, columns, start, end, after_id):
+    values = read_segment(path, set(columns) | {"date_created"})
+    created = values["date_created"]
+    ordered = [values[column] for column in columns]
+    for i in range(len(created)):
+        if start <= created[i] < end and (after_id is None or ordered[0][i] > after_id):
+            yield tuple(column[i] for column in ordered)
+
+
+def iter_archived(archive_dir, table, columns, start, end, after_id=None):
+    """
+    Yields archived rows (tuples in `columns` order, id first) with date_created
+    in [start, end) and id > after_id, in id order across all matching segments.
+
+    A segment is only opened once its smallest id could be next, so only the
+    segments of the id range being read are decompressed at a time.
+    """
+    start = start.astimezone(datetime.timezone.utc).replace(tzinfo=None) if start.tzinfo else start
+    end = end.astimezone(datetime.timezone.utc).replace(tzinfo=None) if end.tzinfo else end
+    segments = sorted(find_segments(archive_dir, table, start, end, after_id))
+    heap = []
+    next_segment = 0
+    while True:
+        while next_segment < len(segments) and (not heap or segments[next_segment][0] <= heap[0][0]):
+            rows = _segment_rows(segments[next_segment][2], columns, start, end, after_id)
+            first = next(rows, None)
+            if first is not None:
+                heapq.heappush(heap, (first[0], next_segment, first, rows))
+            next_segment += 1
+        if not heap:
+            return
+        _, index, row, rows = heapq.heappop(heap)
+        following = next(rows, None)
+        if following is not None:
+            heapq.heappush(heap, (following[0], index, following, rows))
+        yield row
+
+
+def drop_repeated_ids(rows):
+    """
+    Skips rows whose id was just yielded. A retention pass interrupted between
+    writing segments and deleting rows leaves them in both places until it reruns.
+    """
+    last_id = None
+    for row in rows:
+        if row[0] != last_id:
+            last_id = row[0]
+            yield row
+
+
+def archive_table(engine, table, archive_dir, cutoff, chunk_rows=5000, delete_batch=1000, logger=None):
+    """
+    Moves rows of `table` with date_created before `cutoff` into segment files,
+    then deletes them from the database, oldest id first, chunk_rows at a time.
+
+    Each chunk is the chunk_rows lowest ids still in the table, so a run that
+    dies between writing segments and deleting rows picks the same chunk again
+    and rewrites the same files. Deletes go in delete_batch-sized transactions
+    to keep locks short on a live table. Returns the number of rows archived.
+    """
+    columns = COLUMNS[table.name]
+    names = [name for name, _ in columns]
+    archived = 0
+    while True:
+        with engine.connect() as conn:
+            rows = conn.execute(
+                select(*[table.c[name] for name in names])
+                .where(table.c.date_created < cutoff)
+                .order_by(table.c.id)
+                .limit(chunk_rows)
+            ).all()
+        if not rows:
+            return archived
+
+        groups = defaultdict(list)
+        for row in rows:
+            groups[(row.date_created.date(), row.fire_id)].append(tuple(row))
+        for (day, fire_id), group in groups.items():
+            write_segment(segment_path(archive_dir, table.name, day, fire_id, group[0][0], group[-1][0]), columns, group)
+
+        ids = [row.id for row in rows]
+        for i in range(0, len(ids), delete_batch):
+            with engine.begin() as conn:
+                conn.execute(delete(table).where(table.c.id.in_(ids[i:i + delete_batch])))
+        archived += len(rows)
+        if logger:
+            logger.info(f"Archived {len(rows)} {table.name} rows into {len(groups)} segments (ids {ids[0]}-{ids[-1]})")
+
+
+def run_retention(engine, tables, archive_dir, hot_days, chunk_rows=5000, delete_batch=1000, logger=None):
+    """
+    One retention pass over `tables`. On MySQL a named lock makes sure only
+    one storage process archives at a time; the others skip the pass.
+    """
+    with engine.connect() as lock_conn:
+        if engine.dialect.name == "mysql":
+            if not lock_conn.execute(text("SELECT GET_LOCK('storage_retention', 0)")).scalar():
+                if logger:
+                    logger.info("Retention pass already running in another process, skipping")
+                return {}
+        try:
+            # Use the database clock, it is the one date_created comes from
+            now = lock_conn.execute(select(func.now())).scalar()
+            cutoff = now - datetime.timedelta(days=hot_days)
+            started = time.monotonic()
+            archived = {
+                table.name: archive_table(engine, table, archive_dir, cutoff, chunk_rows, delete_batch, logger)
+                for table in tables
+            }
+            if logger:
+                logger.info(f"Retention pass archived {archived} rows older than {cutoff} in {time.monotonic() - started:.1f}s")
+            return archived
+        finally:
+            if engine.dialect.name == "mysql":
+                lock_conn.execute(text("SELECT RELEASE_LOCK('storage_retention')"))
@@ -0,0 +1,306 @@
+# BACKFILL.PY
+# Bulk replay of the events topic into the storage database, for rebuilding it
+# after a schema change or a lost database. Partitions are replayed in parallel,
+# written in large batches with the secondary indexes dropped, and at the end the
+# live consumer group's offsets are moved to where the replay stopped.
+# Stop the storage consumers first (the group must be empty to commit its offsets), then:
+#   python3 backfill.py                                    whole topic, earliest -> end at start time
+#   python3 backfill.py --since 2025-08-01T00:00:00Z       from the log segment holding that time
+#   python3 backfill.py --from-offset 120000 --workers 3   from an offset (the same on every partition)
+# Other options: --until <time>, --batch-size N, --keep-indexes, --no-handoff, --progress-s N, --idle-s N
+# Rows already stored are skipped (trace_id), so a backfill can be rerun or overlap the live data.
+import argparse
+import logging
+import multiprocessing
+import queue
+import sys
+import time
+from threading import Thread
+
+from pykafka import KafkaClient
+from pykafka.common import OffsetType
+
+from archive import to_micros
+from rollups import to_utc
+
+logger = logging.getLogger('basicLogger')
+
+# Dropped during the load and rebuilt after it. The trace_id unique index stays,
+# replays are deduplicated on it.
+SECONDARY_INDEXES = {
+    "temperature": (("ix_temperature_date_created", ["date_created"]),
+                    ("ix_temperature_fire_id_date_created", ["fire_id", "date_created"]),
+                    ("ix_temperature_geo_cell_reading_timestamp", ["geo_cell", "reading_timestamp"])),
+    "airquality": (("ix_airquality_date_created", ["date_created"]),
+                   ("ix_airquality_fire_id_date_created", ["fire_id", "date_created"])),
+}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Replay the events topic into the storage database")
+    start = parser.add_mutually_exclusive_group()
+    start.add_argument("--from-offset", default="earliest", help="'earliest' (default) or an offset, used on every partition")
+    start.add_argument("--since", help="start at the log segment holding this time (ISO 8601)")
+    parser.add_argument("--until", help="stop each partition at its first message produced at or after this time")
+    parser.add_argument("--workers", type=int, default=None, help="parallel workers (default: one per partition)")
+    parser.add_argument("--batch-size", type=int, default=5000, help="rows per database transaction")
+    parser.add_argument("--keep-indexes", action="store_true", help="don't drop the secondary indexes during the load")
+    parser.add_argument("--no-handoff", action="store_true", help="don't commit the live consumer group's offsets at the end")
+    parser.add_argument("--progress-s", type=float, default=5.0, help="seconds between progress reports")
+    parser.add_argument("--idle-s", type=int, default=10,
+                        help="stop a partition after this many seconds without a message before its end offset")
+    return parser.parse_args(argv)
+
+
+def to_millis(value):
+    return to_micros(value) // 1000
+
+
+def kafka_topic(app):
+    events = app.app_config['events']
+    hostname = f"{events['hostname']}:{events['port']}"
+    # Message timestamps (for --since/--until) need a 0.10+ protocol
+    client = KafkaClient(hosts=hostname, broker_version=events.get('broker_version', '0.10.0'))
+    return hostname, client.topics[str.encode(events['topic'])]
+
+
+def plan_partitions(topic, from_offset, since):
+    """
+    (start, end) offsets of every partition. end is the partition's next offset
+    when the backfill starts, so messages produced meanwhile are left to the live consumer.
+    """
+    plan = {}
+    for partition_id, partition in sorted(topic.partitions.items()):
+        earliest = partition.earliest_available_offset()
+        end = partition.latest_available_offset()
+        if since is not None:
+            # Offset of the last log segment that starts before `since`; messages
+            # before it are skipped by timestamp while replaying
+            offsets = partition.fetch_offset_limit(to_utc(since))
+            start = offsets[0] if offsets else earliest
+        elif from_offset == "earliest":
+            start = earliest
+        else:
+            start = max(int(from_offset), earliest)
+        plan[partition_id] = (min(start, end), end)
+    return plan
+
+
+def replay_partition(app, partition_id, start, end, options, progress):
+    """
+    Replays one partition from `start` up to `end` through the live ingest path
+    (collect_rows and store_batch: same conversion, dead letters and dedupe),
+    batch_size rows per transaction. Reports (partition, next offset, messages,
+    rows inserted, rows dead-lettered, done) on `progress`.
+    """
+    hostname, topic = kafka_topic(app)
+    partition = topic.partitions[partition_id]
+    consumer = topic.get_simple_consumer(
+        partitions=[partition],
+        auto_commit_enable=False,
+        reset_offset_on_start=False,
+        auto_offset_reset=OffsetType.EARLIEST,
+        consumer_timeout_ms=1000,
+    )
+    # reset_offsets takes the last consumed offset. For offset 0 that would be -1,
+    # which pykafka reads as OffsetType.LATEST, so the start of the log is asked for by name.
+    consumer.reset_offsets([(partition, start - 1 if start > 0 else OffsetType.EARLIEST)])
+    dead_letters = app.deadletter.make_sink(app.DEAD_LETTER_CONFIG, hostname)
+    since_ms = to_millis(options.since) if options.since else None
+    until_ms = to_millis(options.until) if options.until else None
+    label = f"Backfill partition {partition_id}"
+
+    temperature_rows = []
+    airquality_rows = []
+    offset = start
+    messages = inserted = failed = 0
+    idle_seconds = 0
+    last_report = time.monotonic()
+
+    def flush():
+        nonlocal inserted, failed, temperature_rows, airquality_rows
+        if temperature_rows or airquality_rows:
+            stored, rejected = app.store_batch(temperature_rows, airquality_rows, dead_letters)
+            inserted += stored
+            failed += rejected
+            temperature_rows = []
+            airquality_rows = []
+
+    try:
+        while offset < end:
+            msg = consumer.consume(block=True)
+            if msg is None:
+                # consume() gives up after consumer_timeout_ms (1s). Offsets can have gaps
+                # (compaction, deleted segments), so `end` may never be reached exactly.
+                idle_seconds += 1
+                if idle_seconds >= options.idle_s:
+                    logger.warning(f"{label}: no message for {idle_seconds}s at offset {offset}, "
+                                   f"stopping before the planned end {end}")
+                    break
+                continue
+            idle_seconds = 0
+            if msg.offset >= end:
+                break
+            # timestamp is 0 when the broker or producer doesn't set one, then the range can't be applied
+            if until_ms is not None and msg.timestamp and msg.timestamp >= until_ms:
+                break
+            offset = msg.offset + 1
+            if since_ms is not None and msg.timestamp and msg.timestamp < since_ms:
+                continue
+
+            app.collect_rows(msg, temperature_rows, airquality_rows, dead_letters, label)
+            messages += 1
+            if len(temperature_rows) + len(airquality_rows) >= options.batch_size:
+                flush()
+                if time.monotonic() - last_report >= 1:
+                    progress.put((partition_id, offset, messages, inserted, failed, False))
+                    last_report = time.monotonic()
+        flush()
+    finally:
+        consumer.stop()
+    progress.put((partition_id, offset, messages, inserted, failed, True))
+
+
+def run_worker(partitions, options, progress, in_child_process):
+    """Replays partitions from the shared queue until it is empty"""
+    import app
+    if in_child_process:
+        # Connections inherited from the parent process can't be shared, start a fresh pool
+        app.mysql.dispose(close=False)
+    while True:
+        try:
+            partition_id, start, end = partitions.get(timeout=1)
+        except queue.Empty:
+            return
+        try:
+            replay_partition(app, partition_id, start, end, options, progress)
+        except Exception as e:
+            logger.exception(f"Backfill of partition {partition_id} failed: {e}")
+            progress.put((partition_id, None, 0, 0, 0, True))
+
+
+def report(state, plan, started):
+    """One progress line: offsets replayed out of the planned total, rows stored and throughput"""
+    total = sum(end - start for start, end in plan.values()) or 1
+    replayed = sum(s["offset"] - plan[p][0] for p, s in state.items())
+    rows = sum(s["inserted"] for s in state.values())
+    elapsed = max(time.monotonic() - started, 1e-6)
+    rate = replayed / elapsed
+    done = sum(s["done"] for s in state.values())
+    print(f"{done}/{len(plan)} partitions, {replayed:,}/{total:,} messages ({100 * replayed / total:.1f}%), "
+          f"{rows:,} rows stored, {rows / elapsed:,.0f} rows/s, ETA {f'{(total - replayed) / rate:,.0f}s' if rate else '-'}", flush=True)
+
+
+def hand_off(app, topic, state):
+    """
+    Commits where each partition's replay stopped as the live group's offsets,
+    unless the group is already further (never moves it backwards).
+    """
+    consumer = topic.get_simple_consumer(
+        consumer_group=app.CONSUMER_GROUP,
+        auto_commit_enable=False,
+        reset_offset_on_start=False,
+        auto_offset_reset=OffsetType.LATEST,
+    )
+    try:
+        committed = {partition_id: response.offset for partition_id, response in consumer.fetch_offsets()}
+        offsets = []
+        for partition_id, partition in topic.partitions.items():
+            offset = max(state[partition_id]["offset"], committed.get(partition_id, -1))
+            offsets.append((partition, offset))
+            print(f"Partition {partition_id}: live consumers resume at offset {offset}")
+        consumer.commit_offsets(offsets)
+    finally:
+        consumer.stop()
+
+
+def set_indexes(app, create):
+    from migrations import create_index, drop_index
+    with app.mysql.begin() as conn:
+        for table, indexes in SECONDARY_INDEXES.items():
+            for name, columns in indexes:
+                if create:
+                    create_index(conn, table, name, columns)
+                else:
+                    drop_index(conn, table, name)
+
+
+def main(argv):
+    options = parse_args(argv)
+    # Imported here: importing app sets up logging and the engines
+    import app
+    import migrate
+
+    options.since = app.parse_timestamp(options.since) if options.since else None
+    options.until = app.parse_timestamp(options.until) if options.until else None
+    pending = migrate.pending_migrations(app.mysql)
+    if pending:
+        print(f"Database schema is behind ({', '.join(m.revision for m in pending)} pending), run 'python3 migrate.py upgrade' first")
+        return 1
+
+    _, topic = kafka_topic(app)
+    plan = plan_partitions(topic, options.from_offset, options.since)
+    for partition_id, (start, end) in plan.items():
+        print(f"Partition {partition_id}: offsets {start} -> {end} ({end - start:,} messages)")
+
+    # The embedded SQLite backend has a single writer thread, so it is replayed with threads
+    if app.EMBEDDED:
+        partitions, progress, start_worker = queue.Queue(), queue.Queue(), Thread
+    else:
+        context = multiprocessing.get_context("fork")
+        partitions, progress, start_worker = context.Queue(), context.Queue(), context.Process
+    for partition_id, (start, end) in plan.items():
+        partitions.put((partition_id, start, end))
+
+    if not options.keep_indexes:
+        print("Dropping secondary indexes for the load")
+        set_indexes(app, create=False)
+
+    state = {p: {"offset": start, "messages": 0, "inserted": 0, "failed": 0, "done": False, "error": False}
+             for p, (start, _) in plan.items()}
+    started = time.monotonic()
+    try:
+        num_workers = min(options.workers or len(plan), len(plan))
+        workers = [start_worker(target=run_worker, args=(partitions, options, progress, not app.EMBEDDED), daemon=True)
+                   for _ in range(num_workers)]
+        for worker in workers:
+            worker.start()
+
+        last_report = time.monotonic()
+        while not all(s["done"] for s in state.values()):
+            try:
+                partition_id, offset, messages, inserted, failed, done = progress.get(timeout=options.progress_s)
+                partition = state[partition_id]
+                if offset is None:
+                    partition["error"] = True
+                else:
+                    partition.update(offset=offset, messages=messages, inserted=inserted, failed=failed)
+                partition["done"] = done
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    break
+            if time.monotonic() - last_report >= options.progress_s:
+                report(state, plan, started)
+                last_report = time.monotonic()
+        report(state, plan, started)
+    finally:
+        if not options.keep_indexes:
+            print("Rebuilding secondary indexes")
+            index_started = time.monotonic()
+            set_indexes(app, create=True)
+            print(f"Indexes rebuilt in {time.monotonic() - index_started:.1f}s")
+
+    failed_partitions = sorted(p for p, s in state.items() if s["error"] or not s["done"])
+    dead_lettered = sum(s["failed"] for s in state.values())
+    print(f"Backfill finished in {time.monotonic() - started:.1f}s, "
+          f"{sum(s['inserted'] for s in state.values()):,} rows stored, {dead_lettered:,} rows rejected by the database (dead-lettered)")
+    if failed_partitions:
+        print(f"Partitions {failed_partitions} did not finish, offsets not handed off. Rerun the backfill, rows already stored are skipped")
+        return 1
+    if not options.no_handoff:
+        hand_off(app, topic, state)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,87 @@
+# BENCHMARK_READS.PY
+# Compares the range query read paths on a throwaway SQLite database:
+#   before: ORM objects -> to_dict() -> json.dumps
+#   after:  column tuples -> precompiled serializer -> serialize.dumps (orjson if installed)
+# Usage: python3 benchmark_reads.py [rows ...]   (default: 10000 100000)
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, insert, select
+from sqlalchemy.orm import Session
+
+import serialize
+from app import Base, Temperature, READ_COLUMNS, SERIALIZERS
+
+READINGS_PER_BATCH = 10
+RUNS = 3
+
+
+def fill(engine, count):
+    start = datetime(2025, 8, 29, 9, 0, 0)
+    rows = []
+    for i in range(count):
+        batch_time = start + timedelta(seconds=i // READINGS_PER_BATCH)
+        rows.append({
+            "trace_id": i,
+            "fire_id": f"fire-{i % 20}",
+            "latitude": 49.39 + i * 1e-6,
+            "longitude": -123.04 - i * 1e-6,
+            "temperature_celsius": 20 + (i % 300) / 3,
+            "humidity_level": None if i % 7 == 0 else 40 + (i % 50),
+            "batch_timestamp": batch_time,
+            "reading_timestamp": batch_time + timedelta(milliseconds=i % 1000),
+            "date_created": batch_time,
+        })
+    with engine.begin() as conn:
+        conn.execute(insert(Temperature), rows)
+
+
+def before(engine):
+    with Session(engine) as session:
+        results = [result.to_dict() for result in session.execute(select(Temperature).order_by(Temperature.id)).scalars().all()]
+    return json.dumps(results).encode("utf-8")
+
+
+def after(engine):
+    serializer = SERIALIZERS[Temperature]
+    statement = select(Temperature.id, *[getattr(Temperature, column) for column in READ_COLUMNS[Temperature]])
+    with engine.connect() as conn:
+        rows = conn.execute(statement.order_by(Temperature.id)).all()
+    return serialize.dumps([serializer(row[1:]) for row in rows])
+
+
+def best_time(path, engine):
+    best = None
+    for _ in range(RUNS):
+        serialize.format_timestamp.cache_clear()
+        started = time.perf_counter()
+        body = path(engine)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, body
+
+
+def main(sizes):
+    print(f"JSON encoder for the new path: {'orjson' if serialize.orjson else 'json'}")
+    print(f"{'rows':>8}  {'before rows/s':>14}  {'after rows/s':>14}  {'speedup':>7}")
+    with tempfile.TemporaryDirectory() as directory:
+        for count in sizes:
+            engine = create_engine(f"sqlite:///{os.path.join(directory, f'bench_{count}.db')}")
+            Base.metadata.create_all(engine)
+            fill(engine, count)
+
+            before_time, before_body = best_time(before, engine)
+            after_time, after_body = best_time(after, engine)
+            # Both paths have to produce the same response
+            assert json.loads(before_body) == json.loads(after_body)
+
+            print(f"{count:>8}  {count / before_time:>14,.0f}  {count / after_time:>14,.0f}  {before_time / after_time:>6.1f}x")
+            engine.dispose()
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [10000, 100000])
@@ -0,0 +1,72 @@
+# STORAGE CACHE.PY
+# In-process LRU cache of serialized range query responses, bounded by bytes.
+from collections import OrderedDict
+from threading import Lock
+
+
+class ResponseCache:
+    """
+    Keeps up to `max_bytes` of response bodies, dropping the least recently
+    used ones first. Bodies bigger than `max_entry_bytes` are never stored, so
+    one huge window can't flush everything else.
+    Only meant for responses that can't change anymore (closed windows).
+    """
+
+    def __init__(self, max_bytes, max_entry_bytes):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.evictions = 0
+        self.too_large = 0
+
+    def get(self, key):
+        """Returns (body, mimetype, headers) or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, body, mimetype, headers):
+        if len(body) > self.max_entry_bytes:
+            with self._lock:
+                self.too_large += 1
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old[0])
+            self._entries[key] = (body, mimetype, dict(headers))
+            self.bytes += len(body)
+            while self.bytes > self.max_bytes:
+                _, (evicted, _, _) = self._entries.popitem(last=False)
+                self.bytes -= len(evicted)
+                self.evictions += 1
+
+    def bypass(self):
+        """Counts a request that couldn't use the cache (open window)"""
+        with self._lock:
+            self.bypasses += 1
+
+    def snapshot(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "bypasses": self.bypasses,
+                "evictions": self.evictions,
+                "too_large": self.too_large,
+            }
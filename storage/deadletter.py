@@ -0,0 +1,82 @@
+# STORAGE DEADLETTER.PY
+# Where the consumer puts messages and rows it can't store (malformed JSON,
+# missing fields, bad timestamps, values the database rejects), so one bad
+# event is set aside instead of stopping ingest.
+import base64
+import json
+import os
+from datetime import datetime, timezone
+from threading import Lock
+
+from pykafka import KafkaClient
+
+
+def dead_letter_record(stage, error, raw=None, event_type=None, payload=None, partition=None, offset=None):
+    """
+    One dead letter as JSON bytes. `stage` says where it failed (decode, convert
+    or write). The raw Kafka value is kept as text when it is UTF-8, base64 otherwise
+    (compact binary messages), so the message can be replayed as it was.
+    """
+    record = {
+        "stage": stage,
+        "error": f"{type(error).__name__}: {error}",
+        "dead_lettered_at": datetime.now(timezone.utc).isoformat(),
+        "partition": partition,
+        "offset": offset,
+        "event_type": event_type,
+    }
+    if payload is not None:
+        record["payload"] = payload
+    if raw is not None:
+        try:
+            record["value"] = raw.decode("utf-8")
+        except UnicodeDecodeError:
+            record["value_b64"] = base64.b64encode(raw).decode("ascii")
+    # default=str covers the datetimes of converted rows
+    return json.dumps(record, default=str).encode("utf-8")
+
+
+class DeadLetterFile:
+    """Appends dead letters as JSON lines to a file"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def send(self, record):
+        # One write per line in append mode, so workers in other processes don't interleave lines
+        with self._lock, open(self.path, "ab") as f:
+            f.write(record + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class DeadLetterTopic:
+    """Produces dead letters to a Kafka topic, synchronously so they are acked before offsets are committed"""
+
+    def __init__(self, hostname, topic):
+        self.hostname = hostname
+        self.topic = topic
+        self._lock = Lock()
+        self._producer = None
+
+    def send(self, record):
+        with self._lock:
+            if self._producer is None:
+                client = KafkaClient(hosts=self.hostname)
+                self._producer = client.topics[str.encode(self.topic)].get_sync_producer()
+            try:
+                self._producer.produce(record)
+            except Exception:
+                # Reconnect on the next dead letter
+                self._producer = None
+                raise
+
+
+def make_sink(config, kafka_hostname):
+    """Dead letter sink from the dead_letter config: target file (default) or topic"""
+    if config.get("target", "file") == "topic":
+        return DeadLetterTopic(kafka_hostname, config.get("topic", "events_dead_letter"))
+    return DeadLetterFile(config.get("path", "/data/dead_letter/events.jsonl"))
+
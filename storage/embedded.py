@@ -0,0 +1,116 @@
+# STORAGE EMBEDDED.PY
+# Embedded SQLite backend for single-node deployments without a MySQL container:
+# WAL journal, tuned pragmas, one writer thread and concurrent read-only readers.
+import logging
+import time
+from concurrent.futures import Future
+from queue import Queue, Empty
+from threading import Thread, Lock
+
+from sqlalchemy import event
+
+logger = logging.getLogger('basicLogger')
+
+
+def apply_pragmas(engine, settings, read_only=False):
+    """
+    Sets the pragmas on every new connection of `engine`. WAL lets readers run
+    while the writer commits; synchronous=NORMAL is safe with WAL (a power cut
+    can lose the last commits, never corrupt the file).
+    """
+    pragmas = [
+        "PRAGMA journal_mode=WAL",
+        f"PRAGMA synchronous={settings.get('synchronous', 'NORMAL')}",
+        f"PRAGMA cache_size=-{int(settings.get('cache_mb', 64) * 1024)}",
+        f"PRAGMA mmap_size={int(settings.get('mmap_mb', 256) * 1024 * 1024)}",
+        "PRAGMA temp_store=MEMORY",
+        f"PRAGMA busy_timeout={int(settings.get('busy_timeout_ms', 5000))}",
+    ]
+    if read_only:
+        pragmas.append("PRAGMA query_only=ON")
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+
+class SQLiteWriter:
+    """
+    Single writer thread for the embedded backend. SQLite allows one writer at a
+    time, so instead of every consumer worker fighting for the lock, they queue
+    their batches here. The thread commits whatever is queued (up to
+    max_group_batches) in one transaction, so one fsync covers many batches.
+
+    `write_fn(session, *args)` does the actual writing inside the open transaction.
+    """
+
+    def __init__(self, session_factory, write_fn, max_group_batches=32, queue_size=256):
+        self.session_factory = session_factory
+        self.write_fn = write_fn
+        self.max_group_batches = max_group_batches
+        self._queue = Queue(maxsize=queue_size)
+        self._lock = Lock()
+        self.batches = 0
+        self.groups = 0
+        self.failed = 0
+        self.last_commit_ms = 0.0
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, *args):
+        """Queues one batch and waits until it is committed. Returns write_fn's result."""
+        future = Future()
+        self._queue.put((args, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            jobs = [self._queue.get()]
+            while len(jobs) < self.max_group_batches:
+                try:
+                    jobs.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            self._commit_group(jobs)
+
+    def _commit_group(self, jobs):
+        started = time.perf_counter()
+        session = self.session_factory()
+        try:
+            results = [self.write_fn(session, *args) for args, _ in jobs]
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            session.close()
+            if len(jobs) > 1:
+                # Retry one by one so a bad batch only fails its own caller
+                logger.warning(f"Group commit of {len(jobs)} batches failed ({e}), retrying them separately")
+                for job in jobs:
+                    self._commit_group([job])
+            else:
+                with self._lock:
+                    self.failed += 1
+                jobs[0][1].set_exception(e)
+            return
+        session.close()
+
+        with self._lock:
+            self.batches += len(jobs)
+            self.groups += 1
+            self.last_commit_ms = (time.perf_counter() - started) * 1000
+        for (_, future), result in zip(jobs, results):
+            future.set_result(result)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queued": self._queue.qsize(),
+                "batches": self.batches,
+                "groups": self.groups,
+                "avg_group_size": round(self.batches / self.groups, 2) if self.groups else 0.0,
+                "failed": self.failed,
+                "last_commit_ms": round(self.last_commit_ms, 3),
+            }
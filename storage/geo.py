@@ -0,0 +1,67 @@
+# STORAGE GEO.PY
+# Fixed latitude/longitude grid used to find readings by area. Every temperature
+# reading stores the id of its grid cell (geo_cell); an area query turns its
+# bounding box into the cells it overlaps and reads them through the
+# (geo_cell, reading_timestamp) index instead of scanning the table.
+import math
+import struct
+
+from sqlalchemy import or_
+
+# 0.1 degree cells, about 11 km north-south
+CELL_DEGREES = 0.1
+GRID_COLUMNS = round(360 / CELL_DEGREES)
+GRID_ROWS = round(180 / CELL_DEGREES)
+
+
+def _row(latitude):
+    return min(max(math.floor((latitude + 90) / CELL_DEGREES), 0), GRID_ROWS - 1)
+
+
+def _column(longitude):
+    return min(max(math.floor((longitude + 180) / CELL_DEGREES), 0), GRID_COLUMNS - 1)
+
+
+def float32(value):
+    """value rounded to single precision, as a MySQL FLOAT column stores it"""
+    return struct.unpack("f", struct.pack("f", value))[0]
+
+
+def cell_id(latitude, longitude):
+    """Grid cell of a point. Cells are numbered row by row from the south-west corner."""
+    return _row(latitude) * GRID_COLUMNS + _column(longitude)
+
+
+def cell_bounds(cell):
+    """(min_latitude, min_longitude, max_latitude, max_longitude) of a cell"""
+    row, column = divmod(cell, GRID_COLUMNS)
+    return (
+        row * CELL_DEGREES - 90,
+        column * CELL_DEGREES - 180,
+        (row + 1) * CELL_DEGREES - 90,
+        (column + 1) * CELL_DEGREES - 180,
+    )
+
+
+def cell_ranges(min_latitude, min_longitude, max_latitude, max_longitude):
+    """
+    (first, last) cell ids of every grid row the box overlaps. Within a row the
+    cells are numbered consecutively, so each row is a single id range.
+    """
+    first_column, last_column = _column(min_longitude), _column(max_longitude)
+    return [
+        (row * GRID_COLUMNS + first_column, row * GRID_COLUMNS + last_column)
+        for row in range(_row(min_latitude), _row(max_latitude) + 1)
+    ]
+
+
+def cell_condition(column, ranges, max_cells):
+    """
+    WHERE clause selecting the cells of `ranges`. Up to max_cells cells it is an
+    IN list, which the database reads as one (geo_cell, reading_timestamp) index
+    range per cell. Bigger boxes use one BETWEEN per grid row, where the index
+    only narrows by cell and the time range is checked on each row.
+    """
+    if sum(last - first + 1 for first, last in ranges) <= max_cells:
+        return column.in_([cell for first, last in ranges for cell in range(first, last + 1)])
+    return or_(*[column.between(first, last) for first, last in ranges])
@@ -0,0 +1,162 @@
+# MIGRATE.PY
+# Versioned schema migrations for the storage database (replaces create_tables.py / drop_tables.py).
+#   python3 migrate.py upgrade [revision]    apply pending migrations (up to revision)
+#   python3 migrate.py downgrade <revision>  undo migrations newer than revision ("base" undoes all)
+#   python3 migrate.py current               show the applied revision
+#   python3 migrate.py history               list every migration and whether it is applied
+import datetime
+import importlib.util
+import logging
+import logging.config
+import os
+import sys
+
+import yaml
+from sqlalchemy import MetaData, Table, Column, String, DateTime, create_engine, select, insert, delete
+
+from embedded import apply_pragmas
+from pools import mysql_url
+
+logger = logging.getLogger('basicLogger')
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+metadata = MetaData()
+schema_version = Table(
+    "schema_version", metadata,
+    Column("revision", String(32), primary_key=True),
+    Column("description", String(250), nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+
+def load_migrations():
+    """Loads the NNNN_name.py files from migrations/, sorted by revision"""
+    # The migration files import their helpers from the migrations package
+    if os.path.dirname(MIGRATIONS_DIR) not in sys.path:
+        sys.path.insert(0, os.path.dirname(MIGRATIONS_DIR))
+
+    migrations = []
+    for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+        if not filename.endswith(".py") or not filename[0].isdigit():
+            continue
+        spec = importlib.util.spec_from_file_location(f"migrations.m{filename[:-3]}", os.path.join(MIGRATIONS_DIR, filename))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        migrations.append(module)
+
+    revisions = [m.revision for m in migrations]
+    if len(set(revisions)) != len(revisions):
+        raise RuntimeError(f"Duplicate migration revisions in {MIGRATIONS_DIR}: {revisions}")
+    return migrations
+
+
+def applied_revisions(engine):
+    with engine.begin() as conn:
+        schema_version.create(conn, checkfirst=True)
+        return set(conn.execute(select(schema_version.c.revision)).scalars())
+
+
+def current_revision(engine):
+    applied = applied_revisions(engine)
+    return max(applied) if applied else None
+
+
+def pending_migrations(engine):
+    applied = applied_revisions(engine)
+    return [m for m in load_migrations() if m.revision not in applied]
+
+
+def record_revision(conn, migration):
+    conn.execute(insert(schema_version).values(
+        revision=migration.revision,
+        description=migration.description[:250],
+        applied_at=datetime.datetime.now(),
+    ))
+
+
+def upgrade(engine, target=None):
+    """Applies every pending migration up to and including `target` (default: all)"""
+    applied = []
+    for migration in pending_migrations(engine):
+        if target is not None and migration.revision > target:
+            break
+        logger.info(f"Applying migration {migration.revision}: {migration.description}")
+        # Each migration and its schema_version row go in one transaction. MySQL
+        # commits DDL on its own, which is why migration steps must be re-runnable.
+        # A backfill commits in chunks, so the revision is recorded once it is done.
+        backfill = getattr(migration, "backfill", None)
+        with engine.begin() as conn:
+            migration.upgrade(conn)
+            if backfill is None:
+                record_revision(conn, migration)
+        if backfill is not None:
+            backfill(engine)
+            with engine.begin() as conn:
+                record_revision(conn, migration)
+        applied.append(migration.revision)
+    return applied
+
+
+def downgrade(engine, target):
+    """Undoes applied migrations newer than `target`, newest first. "base" undoes all of them."""
+    applied = applied_revisions(engine)
+    undone = []
+    for migration in reversed(load_migrations()):
+        if migration.revision not in applied or (target != "base" and migration.revision <= target):
+            continue
+        logger.info(f"Reverting migration {migration.revision}: {migration.description}")
+        with engine.begin() as conn:
+            migration.downgrade(conn)
+            conn.execute(delete(schema_version).where(schema_version.c.revision == migration.revision))
+        undone.append(migration.revision)
+    return undone
+
+
+def engine_from_config(config_path="/config/storage_conf.yml"):
+    """
+    Engine on the database storage_conf.yml points at. Built here rather than
+    taken from app.py, which would also start its pools, cache and API just to
+    run a migration.
+    """
+    with open(config_path, "r") as f:
+        db_config = yaml.safe_load(f.read())['datastore']
+    if db_config.get('backend', 'mysql') == 'sqlite':
+        sqlite_config = db_config.get('sqlite', {})
+        engine = create_engine(f"sqlite:///{sqlite_config.get('path', '/data/storage.db')}")
+        apply_pragmas(engine, sqlite_config)
+        return engine
+    return create_engine(mysql_url(db_config), pool_pre_ping=True)
+
+
+def main(argv):
+    if not argv or argv[0] not in ("upgrade", "downgrade", "current", "history"):
+        print("usage: migrate.py upgrade [revision] | downgrade <revision> | current | history")
+        return 2
+
+    with open("/config/storage_log_conf.yml", "r") as f:
+        logging.config.dictConfig(yaml.safe_load(f.read()))
+    mysql = engine_from_config()
+
+    command = argv[0]
+    if command == "upgrade":
+        applied = upgrade(mysql, argv[1] if len(argv) > 1 else None)
+        print(f"Applied {', '.join(applied)}" if applied else "Already up to date")
+    elif command == "downgrade":
+        if len(argv) < 2:
+            print("downgrade needs a target revision, or 'base' to undo everything")
+            return 2
+        undone = downgrade(mysql, argv[1])
+        print(f"Reverted {', '.join(undone)}" if undone else "Nothing to revert")
+    elif command == "current":
+        print(current_revision(mysql) or "base")
+    else:
+        applied = applied_revisions(mysql)
+        for migration in load_migrations():
+            status = "applied" if migration.revision in applied else "pending"
+            print(f"{migration.revision}  {status:8}  {migration.description}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,50 @@
+# Creates the temperature and airquality tables as they were first defined.
+# Databases created before migrations existed already have them and are left alone.
+from sqlalchemy import MetaData, Table, Column, Integer, BigInteger, String, Float, DateTime, func
+
+from migrations import table_exists
+
+revision = "0001"
+description = "initial temperature and airquality tables"
+
+metadata = MetaData()
+
+temperature = Table(
+    "temperature", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("trace_id", BigInteger, nullable=False),
+    Column("fire_id", String(250), nullable=False),
+    Column("latitude", Float, nullable=False),
+    Column("longitude", Float, nullable=False),
+    Column("temperature_celsius", Float, nullable=False),
+    Column("humidity_level", Float, nullable=True),
+    Column("batch_timestamp", DateTime, nullable=False),
+    Column("reading_timestamp", DateTime, nullable=False),
+    Column("date_created", DateTime, nullable=False, server_default=func.now()),
+)
+
+airquality = Table(
+    "airquality", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("trace_id", BigInteger, nullable=False),
+    Column("fire_id", String(250), nullable=False),
+    Column("location_name", String(250), nullable=False),
+    Column("particulate_level", Float, nullable=False),
+    Column("air_quality", Float, nullable=False),
+    Column("smoke_opacity", Float, nullable=False),
+    Column("batch_timestamp", DateTime, nullable=False),
+    Column("reading_timestamp", DateTime, nullable=False),
+    Column("date_created", DateTime, nullable=False, server_default=func.now()),
+)
+
+
+def upgrade(conn):
+    for table in (temperature, airquality):
+        if not table_exists(conn, table.name):
+            table.create(conn)
+
+
+def downgrade(conn):
+    for table in (temperature, airquality):
+        if table_exists(conn, table.name):
+            table.drop(conn)
@@ -0,0 +1,27 @@
+# Makes trace_id unique so redelivered events can't be stored twice.
+# Duplicates that got in before the index existed are removed, keeping the first row.
+from sqlalchemy import text
+
+from migrations import create_index, drop_index, index_exists
+
+revision = "0002"
+description = "unique index on trace_id"
+
+TABLES = ("temperature", "airquality")
+
+
+def upgrade(conn):
+    for table in TABLES:
+        name = f"ix_{table}_trace_id"
+        if index_exists(conn, table, name):
+            continue
+        conn.execute(text(
+            f"DELETE FROM {table} WHERE id NOT IN "
+            f"(SELECT id FROM (SELECT MIN(id) AS id FROM {table} GROUP BY trace_id) AS keep_rows)"
+        ))
+        create_index(conn, table, name, ["trace_id"], unique=True)
+
+
+def downgrade(conn):
+    for table in TABLES:
+        drop_index(conn, table, f"ix_{table}_trace_id")
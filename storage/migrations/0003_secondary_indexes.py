@@ -0,0 +1,19 @@
+# Indexes for the range queries (date_created) and per-fire lookups (fire_id, date_created).
+from migrations import create_index, drop_index
+
+revision = "0003"
+description = "date_created and fire_id indexes"
+
+TABLES = ("temperature", "airquality")
+
+
+def upgrade(conn):
+    for table in TABLES:
+        create_index(conn, table, f"ix_{table}_date_created", ["date_created"])
+        create_index(conn, table, f"ix_{table}_fire_id_date_created", ["fire_id", "date_created"])
+
+
+def downgrade(conn):
+    for table in TABLES:
+        drop_index(conn, table, f"ix_{table}_fire_id_date_created")
+        drop_index(conn, table, f"ix_{table}_date_created")
@@ -0,0 +1,37 @@
+# Per-type, per-fire event counters kept up to date by the ingest path, so
+# /stats doesn't have to COUNT(*) the tables. Existing rows are counted once here.
+from sqlalchemy import MetaData, Table, Column, String, BigInteger, DateTime, text
+
+from migrations import table_exists
+
+revision = "0004"
+description = "event_counters table"
+
+metadata = MetaData()
+
+event_counters = Table(
+    "event_counters", metadata,
+    Column("event_type", String(32), primary_key=True),
+    Column("fire_id", String(250), primary_key=True),
+    Column("count", BigInteger, nullable=False),
+    Column("last_ingested", DateTime, nullable=False),
+)
+
+# event_type stored in the counters for each table
+TABLES = {"temperature": "temperature_reading", "airquality": "airquality_reading"}
+
+
+def upgrade(conn):
+    if table_exists(conn, "event_counters"):
+        return
+    event_counters.create(conn)
+    for table, event_type in TABLES.items():
+        conn.execute(text(
+            f"INSERT INTO event_counters (event_type, fire_id, count, last_ingested) "
+            f"SELECT :event_type, fire_id, COUNT(*), MAX(date_created) FROM {table} GROUP BY fire_id"
+        ), {"event_type": event_type})
+
+
+def downgrade(conn):
+    if table_exists(conn, "event_counters"):
+        event_counters.drop(conn)
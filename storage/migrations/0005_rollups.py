@@ -0,0 +1,62 @@
+# Minute, hour and day rollup tables per fire_id and metric, backfilled from the stored readings.
+from sqlalchemy import MetaData, Table, Column, String, BigInteger, Float, DateTime, text
+
+from migrations import table_exists
+
+revision = "0005"
+description = "minute, hour and day rollup tables"
+
+metadata = MetaData()
+
+# Bucket start formats per resolution, for MySQL DATE_FORMAT and SQLite strftime.
+# The SQLite ones match how SQLAlchemy writes datetimes there, so the app's upserts hit the same keys.
+RESOLUTIONS = {
+    "rollup_minute": ("%Y-%m-%d %H:%i:00", "%Y-%m-%d %H:%M:00.000000"),
+    "rollup_hour": ("%Y-%m-%d %H:00:00", "%Y-%m-%d %H:00:00.000000"),
+    "rollup_day": ("%Y-%m-%d 00:00:00", "%Y-%m-%d 00:00:00.000000"),
+}
+
+METRICS = {
+    "temperature": ("temperature_celsius", "humidity_level"),
+    "airquality": ("air_quality", "smoke_opacity"),
+}
+
+tables = [
+    Table(
+        name, metadata,
+        Column("fire_id", String(250), primary_key=True),
+        Column("metric", String(32), primary_key=True),
+        Column("bucket_start", DateTime, primary_key=True),
+        Column("count", BigInteger, nullable=False),
+        Column("min_value", Float, nullable=False),
+        Column("max_value", Float, nullable=False),
+        Column("sum_value", Float, nullable=False),
+        Column("sumsq_value", Float, nullable=False),
+    )
+    for name in RESOLUTIONS
+]
+
+
+def upgrade(conn):
+    for table in tables:
+        if table_exists(conn, table.name):
+            continue
+        table.create(conn)
+        mysql_format, sqlite_format = RESOLUTIONS[table.name]
+        if conn.dialect.name == "mysql":
+            bucket = f"DATE_FORMAT(reading_timestamp, '{mysql_format}')"
+        else:
+            bucket = f"strftime('{sqlite_format}', reading_timestamp)"
+        for source, metrics in METRICS.items():
+            for metric in metrics:
+                conn.execute(text(
+                    f"INSERT INTO {table.name} (fire_id, metric, bucket_start, count, min_value, max_value, sum_value, sumsq_value) "
+                    f"SELECT fire_id, :metric, {bucket}, COUNT(*), MIN({metric}), MAX({metric}), SUM({metric}), SUM({metric} * {metric}) "
+                    f"FROM {source} WHERE {metric} IS NOT NULL GROUP BY fire_id, {bucket}"
+                ), {"metric": metric})
+
+
+def downgrade(conn):
+    for table in tables:
+        if table_exists(conn, table.name):
+            table.drop(conn)
@@ -0,0 +1,29 @@
+# Grid cell of every temperature reading (see geo.py) and the (geo_cell, reading_timestamp)
+# index the area endpoint reads through. Existing rows get their cell here.
+from migrations import add_column, drop_column, create_index, drop_index, update_in_chunks
+
+revision = "0006"
+description = "geo_cell column and index on temperature"
+
+# Same grid as geo.py: 0.1 degree cells, 3600 per row, clamped to the last row/column
+CELL_SQL = {
+    "mysql": "LEAST(FLOOR((latitude + 90) / 0.1), 1799) * 3600 + LEAST(FLOOR((longitude + 180) / 0.1), 3599)",
+    # SQLite may be built without FLOOR(); the values are never negative, so CAST truncates the same way
+    "sqlite": "min(CAST((latitude + 90) / 0.1 AS INTEGER), 1799) * 3600 + min(CAST((longitude + 180) / 0.1 AS INTEGER), 3599)",
+}
+
+
+def upgrade(conn):
+    add_column(conn, "temperature", "geo_cell", "BIGINT NULL")
+
+
+def backfill(engine):
+    # 10k rows per transaction; the index is built once every row has its cell
+    update_in_chunks(engine, "temperature", f"geo_cell = {CELL_SQL[engine.dialect.name]}", "geo_cell IS NULL")
+    with engine.begin() as conn:
+        create_index(conn, "temperature", "ix_temperature_geo_cell_reading_timestamp", ["geo_cell", "reading_timestamp"])
+
+
+def downgrade(conn):
+    drop_index(conn, "temperature", "ix_temperature_geo_cell_reading_timestamp")
+    drop_column(conn, "temperature", "geo_cell")
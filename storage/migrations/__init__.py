@@ -0,0 +1,86 @@
+# STORAGE MIGRATIONS
+# Versioned schema changes, applied in file name order by migrate.py.
+# Every migration file defines `revision`, `description`, `upgrade(conn)` and
+# `downgrade(conn)`, and optionally `backfill(engine)` for data changes too big
+# for one transaction (run after upgrade, committing as it goes). Steps should
+# be safe to re-run: MySQL commits DDL implicitly, so a migration that dies
+# halfway is simply run again.
+import logging
+
+from sqlalchemy import inspect, text
+
+logger = logging.getLogger('basicLogger')
+
+
+def table_exists(conn, table):
+    return inspect(conn).has_table(table)
+
+
+def index_exists(conn, table, name):
+    return any(index["name"] == name for index in inspect(conn).get_indexes(table))
+
+
+def create_index(conn, table, name, columns, unique=False):
+    """
+    Adds an index unless it is already there. On MySQL this is an online
+    ALTER (ALGORITHM=INPLACE, LOCK=NONE) so inserts and reads keep going
+    while a large table is indexed.
+    """
+    if index_exists(conn, table, name):
+        return
+    kind = "UNIQUE INDEX" if unique else "INDEX"
+    column_list = ", ".join(columns)
+    if conn.dialect.name == "mysql":
+        conn.execute(text(f"ALTER TABLE {table} ADD {kind} {name} ({column_list}), ALGORITHM=INPLACE, LOCK=NONE"))
+    else:
+        conn.execute(text(f"CREATE {kind} {name} ON {table} ({column_list})"))
+
+
+def drop_index(conn, table, name):
+    if not index_exists(conn, table, name):
+        return
+    if conn.dialect.name == "mysql":
+        conn.execute(text(f"ALTER TABLE {table} DROP INDEX {name}, ALGORITHM=INPLACE, LOCK=NONE"))
+    else:
+        conn.execute(text(f"DROP INDEX {name}"))
+
+
+def column_exists(conn, table, name):
+    return any(column["name"] == name for column in inspect(conn).get_columns(table))
+
+
+def add_column(conn, table, name, definition):
+    """Adds a column unless it is already there, online on MySQL like create_index"""
+    if column_exists(conn, table, name):
+        return
+    if conn.dialect.name == "mysql":
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {definition}, ALGORITHM=INPLACE, LOCK=NONE"))
+    else:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {definition}"))
+
+
+def drop_column(conn, table, name):
+    if not column_exists(conn, table, name):
+        return
+    conn.execute(text(f"ALTER TABLE {table} DROP COLUMN {name}"))
+
+
+def update_in_chunks(engine, table, assignments, where, chunk_rows=10000):
+    """
+    Runs `UPDATE table SET assignments WHERE where` over id ranges of
+    chunk_rows, committing each one, so a large table is never locked (or held
+    in the undo log) as a whole. `where` must stop matching updated rows so an
+    interrupted run can be resumed.
+    """
+    with engine.connect() as conn:
+        first_id, last_id = conn.execute(text(f"SELECT MIN(id), MAX(id) FROM {table}")).one()
+    if first_id is None:
+        return 0
+    updated = 0
+    for start in range(first_id, last_id + 1, chunk_rows):
+        with engine.begin() as conn:
+            updated += conn.execute(text(
+                f"UPDATE {table} SET {assignments} WHERE id >= :start AND id < :end AND {where}"
+            ), {"start": start, "end": start + chunk_rows}).rowcount
+        logger.info(f"{table}: updated {updated} rows, up to id {min(start + chunk_rows - 1, last_id)} of {last_id}")
+    return updated
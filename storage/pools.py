@@ -0,0 +1,100 @@
+# STORAGE POOLS.PY
+# Database engines with their own connection pools, instrumented so we can
+# see how long requests wait for a connection and how full each pool is.
+import time
+from threading import Lock
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+
+class PoolMetrics:
+    """Checkout wait times and timeouts of one pool"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+        self.last_wait_ms = 0.0
+
+    def record(self, wait_ms, timed_out=False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+                return
+            self.checkouts += 1
+            self.total_wait_ms += wait_ms
+            self.last_wait_ms = wait_ms
+            self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "avg_wait_ms": round(self.total_wait_ms / self.checkouts, 3) if self.checkouts else 0.0,
+                "last_wait_ms": round(self.last_wait_ms, 3),
+                "max_wait_ms": round(self.max_wait_ms, 3),
+            }
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that times every checkout (including waiting for a free connection)"""
+
+    metrics = None
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            self.metrics.record(0.0, timed_out=True)
+            raise
+        self.metrics.record((time.perf_counter() - started) * 1000)
+        return connection
+
+
+def mysql_url(db_config):
+    """SQLAlchemy URL of the MySQL primary described by the datastore section of storage_conf.yml"""
+    return (f"mysql+pymysql://{db_config['user']}:{db_config['password']}"
+            f"@{db_config['hostname']}:{db_config['port']}/{db_config['db']}")
+
+
+def make_engine(url, pool_config, **engine_args):
+    """
+    Creates an engine with its own instrumented pool, sized by `pool_config`
+    (size, max_overflow, timeout_s, recycle_s). Other keyword arguments go to create_engine.
+    """
+    metrics = PoolMetrics()
+    # A subclass per engine, so each pool reports into its own metrics
+    pool_class = type("TimedQueuePool", (TimedQueuePool,), {"metrics": metrics})
+    engine = create_engine(
+        url,
+        poolclass=pool_class,
+        pool_size=pool_config.get('size', 10),
+        max_overflow=pool_config.get('max_overflow', 5),
+        pool_timeout=pool_config.get('timeout_s', 30),
+        pool_recycle=pool_config.get('recycle_s', 3600),
+        pool_pre_ping=True,
+        **engine_args,
+    )
+    engine.pool_metrics = metrics
+    return engine
+
+
+def pool_snapshot(engine):
+    """Current usage of an engine's pool plus its checkout metrics"""
+    pool = engine.pool
+    capacity = pool.size() + max(pool._max_overflow, 0)
+    checked_out = pool.checkedout()
+    return {
+        "size": pool.size(),
+        "max_overflow": pool._max_overflow,
+        "checked_out": checked_out,
+        "idle": pool.checkedin(),
+        "saturation": round(checked_out / capacity, 4) if capacity else 0.0,
+        **engine.pool_metrics.snapshot(),
+    }
@@ -0,0 +1,149 @@
+# STORAGE ROLLUPS.PY
+# Per-fire time-bucket aggregates (minute, hour, day) of the reading metrics,
+# updated with every written batch so long ranges can be answered without the raw rows.
+import datetime
+import math
+
+from sqlalchemy import MetaData, Table, Column, String, BigInteger, Float, DateTime, func, select
+from sqlalchemy.dialects import mysql as mysql_dialect, sqlite as sqlite_dialect
+
+# Metrics rolled up for each event type
+METRICS = {
+    "temperature_reading": ("temperature_celsius", "humidity_level"),
+    "airquality_reading": ("air_quality", "smoke_opacity"),
+}
+
+metadata = MetaData()
+
+
+def rollup_table(name):
+    return Table(
+        name, metadata,
+        Column("fire_id", String(250), primary_key=True),
+        Column("metric", String(32), primary_key=True),
+        Column("bucket_start", DateTime, primary_key=True),
+        Column("count", BigInteger, nullable=False),
+        Column("min_value", Float, nullable=False),
+        Column("max_value", Float, nullable=False),
+        Column("sum_value", Float, nullable=False),
+        Column("sumsq_value", Float, nullable=False),
+    )
+
+
+# resolution name -> (table, function giving the start of a timestamp's bucket)
+RESOLUTIONS = {
+    "minute": (rollup_table("rollup_minute"), lambda ts: ts.replace(second=0, microsecond=0)),
+    "hour": (rollup_table("rollup_hour"), lambda ts: ts.replace(minute=0, second=0, microsecond=0)),
+    "day": (rollup_table("rollup_day"), lambda ts: ts.replace(hour=0, minute=0, second=0, microsecond=0)),
+}
+
+
+def to_utc(ts):
+    """Timestamps are stored as naive UTC"""
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return ts
+
+
+def aggregate(event_type, rows):
+    """
+    Folds a batch of rows into bucket aggregates, keyed by resolution, then
+    (fire_id, metric, bucket_start). Buckets are by reading_timestamp; empty
+    (None) metric values are left out.
+    """
+    aggregates = {resolution: {} for resolution in RESOLUTIONS}
+    metrics = METRICS[event_type]
+    for row in rows:
+        reading_time = to_utc(row["reading_timestamp"])
+        for metric in metrics:
+            value = row.get(metric)
+            if value is None:
+                continue
+            for resolution, (_, bucket) in RESOLUTIONS.items():
+                key = (row["fire_id"], metric, bucket(reading_time))
+                current = aggregates[resolution].get(key)
+                if current is None:
+                    aggregates[resolution][key] = [1, value, value, value, value * value]
+                else:
+                    current[0] += 1
+                    current[1] = min(current[1], value)
+                    current[2] = max(current[2], value)
+                    current[3] += value
+                    current[4] += value * value
+    return aggregates
+
+
+def upsert_statement(table, dialect_name):
+    """INSERT that merges into an existing bucket: counts and sums add up, min/max are kept"""
+    if dialect_name == "mysql":
+        statement = mysql_dialect.insert(table)
+        new = statement.inserted
+        return statement.on_duplicate_key_update(
+            count=table.c.count + new.count,
+            min_value=func.least(table.c.min_value, new.min_value),
+            max_value=func.greatest(table.c.max_value, new.max_value),
+            sum_value=table.c.sum_value + new.sum_value,
+            sumsq_value=table.c.sumsq_value + new.sumsq_value,
+        )
+    statement = sqlite_dialect.insert(table)
+    new = statement.excluded
+    # SQLite's two-argument min()/max() are scalar, like LEAST/GREATEST
+    return statement.on_conflict_do_update(
+        index_elements=["fire_id", "metric", "bucket_start"],
+        set_={
+            "count": table.c.count + new.count,
+            "min_value": func.min(table.c.min_value, new.min_value),
+            "max_value": func.max(table.c.max_value, new.max_value),
+            "sum_value": table.c.sum_value + new.sum_value,
+            "sumsq_value": table.c.sumsq_value + new.sumsq_value,
+        },
+    )
+
+
+def write_rollups(connection, event_type, rows):
+    """Adds a batch of new rows to every rollup table, in the caller's transaction"""
+    dialect_name = connection.dialect.name
+    for resolution, buckets in aggregate(event_type, rows).items():
+        if not buckets:
+            continue
+        table = RESOLUTIONS[resolution][0]
+        # Sorted so concurrent writers always lock bucket rows in the same order
+        connection.execute(upsert_statement(table, dialect_name), [
+            {"fire_id": fire_id, "metric": metric, "bucket_start": bucket_start,
+             "count": count, "min_value": low, "max_value": high, "sum_value": total, "sumsq_value": total_sq}
+            for (fire_id, metric, bucket_start), (count, low, high, total, total_sq) in sorted(buckets.items())
+        ])
+
+
+def query_rollups(connection, resolution, metric, start, end, fire_id=None):
+    """Buckets of one metric with bucket_start in [start, end), with mean and standard deviation added"""
+    table = RESOLUTIONS[resolution][0]
+    statement = select(table).where(
+        table.c.metric == metric
+    ).where(
+        table.c.bucket_start >= to_utc(start)
+    ).where(
+        table.c.bucket_start < to_utc(end)
+    )
+    if fire_id is not None:
+        statement = statement.where(table.c.fire_id == fire_id)
+    statement = statement.order_by(table.c.fire_id, table.c.bucket_start)
+
+    results = []
+    for row in connection.execute(statement):
+        mean = row.sum_value / row.count
+        # Population variance from the sums; clamped because rounding can make it slightly negative
+        variance = max(row.sumsq_value / row.count - mean * mean, 0.0)
+        results.append({
+            "fire_id": row.fire_id,
+            "metric": row.metric,
+            "bucket_start": row.bucket_start,
+            "count": row.count,
+            "min": row.min_value,
+            "max": row.max_value,
+            "sum": row.sum_value,
+            "sum_squares": row.sumsq_value,
+            "mean": mean,
+            "stddev": math.sqrt(variance),
+        })
+    return results
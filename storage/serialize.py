@@ -0,0 +1,51 @@
+# STORAGE SERIALIZE.PY
+# Fast path for turning query rows into JSON: plain column tuples instead of
+# ORM objects, one precompiled serializer per table and cached timestamps.
+import json
+from functools import lru_cache
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the standard json module is the fallback
+    orjson = None
+
+
+@lru_cache(maxsize=65536)
+def format_timestamp(value):
+    """
+    Formats a datetime the way the API returns it (2025-08-29T09:12:33.001Z).
+    Readings of one batch share their batch_timestamp, so most calls are cache hits.
+    """
+    return value.isoformat(timespec="milliseconds") + "Z"
+
+
+def make_serializer(columns, timestamp_columns=()):
+    """
+    Builds a function that turns one row tuple (in `columns` order) into the
+    response dict. The column positions are worked out once here instead of
+    per row, and only the timestamp positions are touched.
+    """
+    columns = tuple(columns)
+    timestamp_positions = tuple(i for i, column in enumerate(columns) if column in timestamp_columns)
+
+    def serialize(row):
+        values = list(row)
+        for i in timestamp_positions:
+            values[i] = format_timestamp(values[i])
+        return dict(zip(columns, values))
+
+    return serialize
+
+
+def dumps(value):
+    """Encodes to JSON bytes, with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+
+def dumps_lines(values):
+    """Encodes a list of dicts as NDJSON bytes, one per line"""
+    if orjson is not None:
+        return b"".join(orjson.dumps(value, option=orjson.OPT_APPEND_NEWLINE) for value in values)
+    return "".join(json.dumps(value, separators=(",", ":")) + "\n" for value in values).encode("utf-8")
@@ -0,0 +1,36 @@
+import datetime
+import os
+
+import pytest
+
+import archive
+
+COLUMNS = archive.COLUMNS["airquality"]
+CREATED = datetime.datetime(2025, 8, 29, 10, 0)
+
+
+def row(row_id, fire_id):
+    return (row_id, row_id, fire_id, "Vancouver", 34.0, 160.0, 30.0, CREATED, CREATED, CREATED)
+
+
+def test_hostile_fire_id_stays_inside_archive_dir(tmp_path):
+    archive_dir = str(tmp_path / "archive")
+    day = CREATED.date()
+    hostile = ["../../../escaped", "/etc/passwd", "a-1-2", "..", "x/../../y"]
+
+    for i, fire_id in enumerate(hostile):
+        path = archive.segment_path(archive_dir, "airquality", day, fire_id, i + 1, i + 1)
+        assert os.path.dirname(path) == os.path.realpath(os.path.join(archive_dir, "airquality", day.isoformat()))
+        archive.write_segment(path, COLUMNS, [row(i + 1, fire_id)])
+
+    assert sorted(os.listdir(tmp_path)) == ["archive"]
+    segments = archive.find_segments(archive_dir, "airquality", CREATED, CREATED + datetime.timedelta(days=1))
+    assert sorted((min_id, max_id) for min_id, max_id, _ in segments) == [(i, i) for i in range(1, len(hostile) + 1)]
+
+    rows = archive.iter_archived(archive_dir, "airquality", ("id", "fire_id"), CREATED, CREATED + datetime.timedelta(days=1))
+    assert [fire_id for _, fire_id in rows] == hostile
+
+
+def test_segment_path_outside_archive_dir_is_rejected(tmp_path):
+    with pytest.raises(archive.SegmentError):
+        archive.segment_path(str(tmp_path / "archive"), "../elsewhere/..", CREATED.date(), "fire", 1, 1)